@@ -1,6 +1,6 @@
 from django.contrib import admin
-from .models import Contact, Email, Label, Thread, ThreadSummary, SystemParameter, EmailAddress, EmailString
-from core.llm import get_langgraph_helper
+from .models import Contact, Email, Label, Thread, ThreadSummary, SystemParameter, EmailAddress, EmailString, SummaryJob
+from core import summary_queue
 from django import forms
 from django.utils.html import format_html
 import json
@@ -37,28 +37,22 @@ class LabelAdmin(admin.ModelAdmin):
     list_display = ("name",)
     search_fields = ("name",)
 
+def _summarize_threads(modeladmin, request, queryset, force_refresh):
+    # The summaries are made by the run_workers command, the threads already queued keep their job
+    queued = [summary_queue.enqueue(thread, force_refresh=force_refresh)[1] for thread in queryset]
+    modeladmin.message_user(
+        request,
+        f"{queued.count(True)} threads queued for summary, {queued.count(False)} already queued. "
+        f"Run ./manage.py run_workers to summarize them."
+    )
+
 @admin.action(description="Create Thread Summary")
 def create_thread_summary(modeladmin, request, queryset):
-    # Get the langgraph helper on demand
-    langgraph_helper = get_langgraph_helper()
-    
-    for thread in queryset:
-        # We log the names of the thread included on print
-        print(f"Thread ID: {thread.id} - Subject: {thread.subject} - Date: {thread.date}")
-        summary_data = langgraph_helper.invoke({"thread":thread})
-        # We create a ThreadSummary object for each thread
-        thread_summary = ThreadSummary.objects.create(
-            thread=thread,
-            email=thread.email_set.last(),
-            summary=summary_data["summary"],
-            action=summary_data["action"],
-            rationale=summary_data["rationale"],
-            participants=summary_data["participants"]
-        )
-        # We log the summary created
-        print(f"Thread Summary: {thread_summary.summary}")
-
-        modeladmin.message_user(request, f"Thread summary created for {thread}")
+    _summarize_threads(modeladmin, request, queryset, force_refresh=False)
+
+@admin.action(description="Create Thread Summary (ignore the cached summary)")
+def refresh_thread_summary(modeladmin, request, queryset):
+    _summarize_threads(modeladmin, request, queryset, force_refresh=True)
 
 @admin.register(Thread)
 class ThreadAdmin(admin.ModelAdmin):
@@ -69,7 +63,7 @@ class ThreadAdmin(admin.ModelAdmin):
 
     change_form_template = "admin/thread_form.html"
 
-    actions = [create_thread_summary]
+    actions = [create_thread_summary, refresh_thread_summary]
 
 class ThreadSummaryForm(forms.ModelForm):
     class Meta:
@@ -131,3 +125,15 @@ class ThreadSummaryAdmin(admin.ModelAdmin):
 @admin.register(SystemParameter)
 class SystemParameterAdmin(admin.ModelAdmin):
     list_display = ("key", "value")
+
+@admin.action(description="Queue again")
+def retry_summary_jobs(modeladmin, request, queryset):
+    for job in queryset.select_related('thread'):
+        summary_queue.enqueue(job.thread, force_refresh=job.force_refresh)
+
+@admin.register(SummaryJob)
+class SummaryJobAdmin(admin.ModelAdmin):
+    list_display = ("id", "thread", "status", "attempts", "run_after", "locked_by", "updated_at")
+    list_filter = ("status", "force_refresh")
+    readonly_fields = ("thread", "thread_summary", "locked_by", "locked_at", "heartbeat_at", "error")
+    actions = [retry_summary_jobs]
@@ -0,0 +1,18 @@
+"""
+Offline benchmarks for the email assistant.
+Each module exposes a run(stdout, size) function and can be started with
+./manage.py benchmark <module name>
+"""
+from contextlib import contextmanager
+from django.db import connection
+
+@contextmanager
+def benchmark_database():
+    """Run the block against a new, migrated, test database which is destroyed at the end,
+    so benchmarks never write to the real database"""
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
@@ -0,0 +1,80 @@
+"""
+Compare the previous handling of To and Cc headers (split on every comma, then
+extract_email_and_name without memoization) with split_addresses and the memoized
+extract_email_and_name of core.utils.contacts, on headers with 50 to 150 recipients.
+"""
+import random
+import re
+import time
+import unicodedata
+from core.utils import extract_email_and_name, split_addresses
+
+DEFAULT_SIZE = 1000
+
+# Number of distinct correspondents the recipients are drawn from
+CORRESPONDENTS = 400
+
+def _previous_extract_email_and_name(original_string):
+    """extract_email_and_name before the memoization, kept here as the reference"""
+    name = ""
+    email = ""
+    if "<" in original_string:
+        name = original_string.split("<")[0].strip()
+        email = original_string.split("<")[1].split(">")[0].strip()
+    else:
+        email = original_string.strip()
+    if not name:
+        name = email.strip()
+    if "@" in name:
+        name = name.split("@")[0]
+    name = re.sub(r'-', ' ', name)
+    name = re.sub(r'\.', ' ', name)
+    name = re.sub(r'_', ' ', name)
+    name = re.sub(r'\'', ' ', name)
+    name = re.sub(r'"', '', name)
+    name = name.strip()
+    name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode('ascii')
+    name = re.sub(r'\s+', ' ', name)
+    name = name.title()
+    return (name, email)
+
+def _previous_parse(header):
+    return [_previous_extract_email_and_name(receiver.strip()) for receiver in header.split(",") if receiver.strip()]
+
+def _parse(header):
+    return [extract_email_and_name(address) for address in split_addresses(header)]
+
+def _correspondent(rng, index):
+    first = rng.choice(["John", "Émilie", "Jean-Pierre", "Mary", "O'Neil", "Zoë", "Li", "Ana"])
+    last = rng.choice(["Doe", "Martin", "Smith", "Müller", "García", "Dupont"])
+    email = f"{first.lower()}.{last.lower()}{index}@example.com"
+    kind = index % 4
+    if kind == 0:
+        return email
+    if kind == 1:
+        # The comma in the quoted name was splitting the address in two
+        return f'"{last}, {first}" <{email}>'
+    return f"{first} {last} <{email}>"
+
+def run(stdout, size=DEFAULT_SIZE):
+    rng = random.Random(42)
+    correspondents = [_correspondent(rng, index) for index in range(CORRESPONDENTS)]
+    headers = [", ".join(rng.sample(correspondents, rng.randint(50, 150))) for _ in range(size)]
+    recipients = sum(len(split_addresses(header)) for header in headers)
+    stdout.write(f"{size} headers, {recipients / size:.0f} recipients on average, {CORRESPONDENTS} distinct correspondents")
+
+    split_addresses.cache_clear()
+    extract_email_and_name.cache_clear()
+    timings = []
+    for parse in (_previous_parse, _parse):
+        start = time.perf_counter()
+        results = [parse(header) for header in headers]
+        timings.append(time.perf_counter() - start)
+    previous_count = sum(len(r) for r in [_previous_parse(header) for header in headers])
+    assert sum(len(r) for r in results) == recipients
+
+    stdout.write(f"previous {timings[0] / size * 1000:7.3f}ms  split_addresses {timings[1] / size * 1000:7.3f}ms per header  "
+                 f"{timings[0] / timings[1]:5.1f}x")
+    stdout.write(f"Address strings: previous {previous_count}, split_addresses {recipients} "
+                 f"({previous_count - recipients} bogus strings avoided)")
+    stdout.write(f"extract_email_and_name cache: {extract_email_and_name.cache_info()}")
@@ -0,0 +1,118 @@
+"""
+Compare the previous body extraction (bleach, display:none regex and markdownify on single-part HTML,
+every part decoded) with core.utils.mime.extract_body over a corpus of common message shapes,
+with an empty HTML conversion cache and with the same HTML already converted.
+"""
+import base64
+import random
+import re
+import time
+import bleach
+import markdownify
+from core.utils import extract_body, normalize_whitespace
+from core.utils import mime
+
+DEFAULT_SIZE = 50
+
+def _previous_extract_body(payload):
+    """The extraction used before core.utils.mime, kept here as the reference"""
+    text_body = None
+    html_body = None
+
+    def extract_parts(parts):
+        nonlocal text_body, html_body
+        for part in parts:
+            mime_type = part.get("mimeType")
+            data = part.get("body", {}).get("data")
+            if data:
+                decoded = base64.urlsafe_b64decode(data.encode("utf-8")).decode("utf-8", errors="replace")
+                if mime_type == "text/html" and not html_body:
+                    html_body = decoded
+                elif mime_type == "text/plain" and not text_body:
+                    text_body = decoded
+            if "parts" in part:
+                extract_parts(part["parts"])
+
+    md_body = None
+    if payload.get("mimeType", "").startswith("multipart/"):
+        extract_parts(payload["parts"])
+    else:
+        data = payload.get("body", {}).get("data")
+        if data:
+            decoded = base64.urlsafe_b64decode(data.encode("utf-8")).decode("utf-8", errors="replace")
+            if payload["mimeType"] == "text/html":
+                cleaned_html = bleach.clean(decoded,
+                    strip=False,
+                    tags=['div', 'span', 'p', 'br', 'b', 'i', 'u', 'em', 'strong', 'a', 'ul', 'ol', 'li', 'blockquote', 'pre', 'code', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'table', 'tr', 'td', 'th', 'thead', 'tbody'],
+                    attributes={'*': ['style', 'class', 'id', 'href', 'src', 'alt', 'title']}
+                )
+                cleaned_html = re.sub(r'<[^>]*style="[^"]*display:\s*none[^"]*"[^>]*>.*?</[^>]*>', '', cleaned_html, flags=re.DOTALL)
+                md_body = markdownify.markdownify(cleaned_html)
+            elif payload["mimeType"] == "text/plain":
+                text_body = decoded
+    return normalize_whitespace(text_body or md_body or "")
+
+def _part(mime_type, content, **extra):
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return {'mimeType': mime_type, 'headers': [], 'body': {'data': base64.urlsafe_b64encode(content).decode('ascii')}, **extra}
+
+def _multipart(mime_type, *parts):
+    return {'mimeType': mime_type, 'headers': [], 'body': {'size': 0}, 'parts': list(parts)}
+
+def _words(rng, count):
+    vocabulary = ["meeting", "invoice", "project", "update", "please", "review", "attached", "thanks", "schedule", "report"]
+    return " ".join(rng.choice(vocabulary) for _ in range(count))
+
+def _newsletter(rng, articles):
+    blocks = ['<html><head><style>td { padding: 0 }</style></head><body>',
+              f'<div style="display:none;max-height:0;overflow:hidden">{_words(rng, 30)}</div>',
+              '<table width="100%" cellpadding="0" cellspacing="0"><tr><td align="center"><table width="600">']
+    for i in range(articles):
+        blocks.append(
+            f'<tr><td style="padding:20px;font-family:Arial"><h2 style="color:#333">Article {i}</h2>'
+            f'<p style="line-height:1.5">{_words(rng, 80)} <a href="https://example.com/{i}" style="color:#06c">Read more</a></p>'
+            f'<img src="https://example.com/{i}.png" width="560"><span style="display:none">tracking {i}</span></td></tr>'
+        )
+    blocks.append('</table></td></tr></table></body></html>')
+    return "".join(blocks)
+
+def _corpus(rng):
+    """(shape name, payload) of the message shapes we receive the most"""
+    plain = _words(rng, 120) + "\n\nOn Mon, John wrote:\n> " + _words(rng, 60)
+    html = "<div dir='ltr'>" + "".join(f"<div>{_words(rng, 20)}</div>" for _ in range(6)) + "</div>"
+    return [
+        ("plain reply", _part('text/plain', plain)),
+        ("alternative", _multipart('multipart/alternative', _part('text/plain', plain), _part('text/html', html))),
+        ("html newsletter", _part('text/html', _newsletter(rng, 150))),
+        ("html-only multipart", _multipart('multipart/related', _part('text/html', _newsletter(rng, 40)),
+                                           _part('image/png', rng.randbytes(50000), filename="logo.png"))),
+        ("mixed + attachment", _multipart('multipart/mixed',
+                                          _multipart('multipart/alternative', _part('text/plain', plain), _part('text/html', html)),
+                                          _part('application/pdf', rng.randbytes(500000), filename="report.pdf"))),
+    ]
+
+def _extract_body_uncached(payload):
+    mime.conversion_cache.memory.clear()
+    return extract_body(payload)
+
+def run(stdout, size=DEFAULT_SIZE):
+    corpus = _corpus(random.Random(42))
+    stdout.write(f"{size} messages of each shape, time per message")
+    stdout.write(f"{'shape':<22} {'previous':>10} {'extract_body':>13} {'cached':>10}  speedup")
+    totals = [0.0, 0.0, 0.0]
+    for name, payload in corpus:
+        timings = []
+        for extract in (_previous_extract_body, _extract_body_uncached, extract_body):
+            start = time.perf_counter()
+            for _ in range(size):
+                extract(payload)
+            timings.append((time.perf_counter() - start) / size)
+        for i, timing in enumerate(timings):
+            totals[i] += timing
+        # the previous extraction did not convert the HTML of multipart messages
+        note = "  (previous body is empty)" if not _previous_extract_body(payload) else ""
+        stdout.write(f"{name:<22} {timings[0] * 1000:8.2f}ms {timings[1] * 1000:11.2f}ms {timings[2] * 1000:8.2f}ms  "
+                     f"{timings[0] / timings[1]:6.1f}x{note}")
+    stdout.write(f"{'all shapes':<22} {totals[0] * 1000:8.2f}ms {totals[1] * 1000:11.2f}ms {totals[2] * 1000:8.2f}ms  "
+                 f"{totals[0] / totals[1]:6.1f}x")
@@ -0,0 +1,66 @@
+"""
+Compare the previous is_calendar_invite (lists rebuilt on each call, the lowercased body scanned once
+per indicator) with the precompiled classifier of core.utils.email.
+"""
+import random
+import time
+from core.utils import classify_calendar_invites
+
+DEFAULT_SIZE = 2000
+
+def _previous_is_calendar_invite(subject, body, headers=None):
+    """is_calendar_invite before the precompiled classifier, kept here as the reference"""
+    if headers:
+        for header in headers:
+            header_name = header.get('name', '').lower()
+            header_value = header.get('value', '').lower()
+            if header_name in ['x-microsoft-cdo-busystatus', 'x-microsoft-cdo-intendedbusystatus',
+                               'x-microsoft-cdo-all-day-event', 'x-microsoft-cdo-instance-type',
+                               'x-microsoft-cdo-importance', 'x-microsoft-cdo-appt-sequence',
+                               'x-microsoft-cdo-appt-state']:
+                return True
+            if header_name == 'content-class' and header_value == 'urn:content-classes:calendarmessage':
+                return True
+            if header_name == 'x-microsoft-cdo-message-class' and 'calendar' in header_value:
+                return True
+    subject = subject.lower().strip()
+    for indicator in ['accepted', 'declined', 'tentative', 'canceled', 'cancelled', 'updated', 'rescheduled',
+                      're-scheduled', 'postponed', 'moved', 'changed']:
+        if subject.startswith(indicator) or subject.startswith(f"{indicator}:"):
+            return True
+    body = body.lower()
+    for indicator in ['calendar invitation', 'calendar event', 'meeting invitation', 'meeting request',
+                      'invitation to', 'invited you to', 'invited to a meeting', 'invited to the meeting',
+                      'invited to meeting', 'has accepted this invitation', 'has declined this invitation',
+                      'has tentatively accepted this invitation', 'has responded to this invitation',
+                      'accepted:', 'declined:', 'tentative:', 'when:', 'where:', 'organizer:', 'attendees:',
+                      'calendar.ics', 'calendar.ical', 'calendar.vcs', 'calendar.vcal']:
+        if indicator in body:
+            return True
+    return False
+
+def _emails(rng, size):
+    vocabulary = ["the", "project", "is", "on", "schedule", "and", "we", "will", "send", "the", "report", "before",
+                  "Friday", "meeting", "with", "a", "budget", "review", "at", "10:00", "https://example.com/a"]
+    headers = [{'name': name, 'value': "value"} for name in ("From", "To", "Subject", "Date", "Message-ID",
+                                                              "Received", "DKIM-Signature", "Content-Type")]
+    emails = []
+    for i in range(size):
+        body = " ".join(rng.choice(vocabulary) for _ in range(rng.choice((50, 300, 3000))))
+        if i % 10 == 0:
+            body += "\nWhen: Monday\nWhere: Room 4"
+        emails.append({'subject': f"Subject {i}", 'body': body, 'headers': headers})
+    return emails
+
+def run(stdout, size=DEFAULT_SIZE):
+    emails = _emails(random.Random(42), size)
+    start = time.perf_counter()
+    previous = [_previous_is_calendar_invite(e['subject'], e['body'], e['headers']) for e in emails]
+    previous_time = time.perf_counter() - start
+    start = time.perf_counter()
+    results = classify_calendar_invites(emails)
+    new_time = time.perf_counter() - start
+    assert results == previous
+    stdout.write(f"{size} emails, {sum(results)} calendar messages")
+    stdout.write(f"previous               {previous_time / size * 1e6:8.1f}us per email")
+    stdout.write(f"classify_calendar_invites {new_time / size * 1e6:5.1f}us per email  {previous_time / new_time:5.1f}x")
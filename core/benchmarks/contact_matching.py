@@ -0,0 +1,81 @@
+"""
+Compare the previous search_similar_contacts (two queries on the exact name, then on the exact name
+and email) with the in-memory index of core.utils.contact_index, on a test database filled with
+generated contacts. The index also finds the similar names ("Jon Smyth" for "Jonathan Smith")
+which the previous search did not.
+"""
+import random
+import time
+from core.benchmarks import benchmark_database
+from core.models import Contact, EmailAddress
+from core.utils.contact_index import contact_index
+
+DEFAULT_SIZE = 20000
+
+# Number of lookups timed
+LOOKUPS = 2000
+
+FIRST_NAMES = ["John", "Jonathan", "Mary", "Marie", "Stephen", "Steven", "Catherine", "Katherine", "Ana",
+               "Émilie", "Jean", "Pierre", "Li", "Wei", "Aisha", "Omar", "Sofia", "Lucas", "Zoë", "Raphael"]
+INSERT_CHUNK_SIZE = 5000
+
+def _last_name(rng):
+    return rng.choice(["Smith", "Smyth", "Martin", "Dupont", "García", "Müller", "Nguyen", "Brown"]) + str(rng.randrange(2000))
+
+def _fill(size, rng):
+    people = [(rng.choice(FIRST_NAMES), _last_name(rng)) for _ in range(size)]
+    contacts = []
+    for start in range(0, size, INSERT_CHUNK_SIZE):
+        contacts += Contact.objects.bulk_create([Contact(name=f"{first} {last}") for first, last in people[start:start + INSERT_CHUNK_SIZE]])
+    addresses = EmailAddress.objects.bulk_create([
+        EmailAddress(email=f"{first.lower()}.{last.lower()}{i}@example.com") for i, (first, last) in enumerate(people)
+    ], batch_size=INSERT_CHUNK_SIZE)
+    Contact.emails.through.objects.bulk_create([
+        Contact.emails.through(contact_id=contact.id, emailaddress_id=address.id) for contact, address in zip(contacts, addresses)
+    ], batch_size=INSERT_CHUNK_SIZE)
+    return [(contact.id, contact.name, address.email) for contact, address in zip(contacts, addresses)]
+
+def _previous_search(name, email):
+    possible_contacts = Contact.objects.filter(name=name, emails__email=email)
+    if len(possible_contacts) == 1:
+        return possible_contacts.first().id
+    elif len(possible_contacts) > 1:
+        return None
+    possible_contacts = Contact.objects.filter(name=name)
+    if len(possible_contacts) == 1:
+        return possible_contacts.first().id
+    return None
+
+def _index_search(name, email):
+    candidates = contact_index.candidates(name, email, limit=5)
+    return candidates[0][0] if candidates else None
+
+def _time(lookup, queries):
+    """Return the time per lookup and the number of lookups which found the right contact"""
+    start = time.perf_counter()
+    results = [lookup(name, email) for contact_id, name, email in queries]
+    elapsed = time.perf_counter() - start
+    return elapsed / len(queries), sum(1 for result, query in zip(results, queries) if result == query[0])
+
+def run(stdout, size=DEFAULT_SIZE):
+    rng = random.Random(42)
+    with benchmark_database():
+        people = _fill(size, rng)
+        # Half of the lookups with the exact name, half with a nickname or a misspelling
+        queries = []
+        for contact_id, name, email in rng.sample(people, min(LOOKUPS, size)):
+            if rng.random() < 0.5:
+                first, last = name.split(" ", 1)
+                name = {"Jonathan": "Jon", "Stephen": "Steven", "Katherine": "Catherine"}.get(first, first[0]) + " " + last
+            queries.append((contact_id, name, email))
+
+        start = time.perf_counter()
+        contact_index.build()
+        stdout.write(f"{size} contacts indexed in {(time.perf_counter() - start) * 1000:.0f}ms")
+
+        previous, previous_found = _time(_previous_search, queries)
+        candidates, candidates_found = _time(_index_search, queries)
+        stdout.write(f"previous search       {previous * 1000:7.3f}ms per lookup, {previous_found} of {len(queries)} right")
+        stdout.write(f"index candidates      {candidates * 1000:7.3f}ms per lookup, {candidates_found} of {len(queries)} right  "
+                     f"{previous / candidates:6.1f}x")
+        contact_index.clear()
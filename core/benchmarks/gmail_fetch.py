@@ -0,0 +1,43 @@
+"""
+Compare the ways of downloading messages against the local fake Gmail server:
+- one messages.get request at a time versus batched retrieval
+- new threads fetched one after the other versus with a pool of workers
+"""
+import time
+from core.gmail_helper import DEFAULT_FETCH_WORKERS
+from core.tests_core.fake_gmail import FakeGmailServer, make_message
+
+DEFAULT_SIZE = 500
+
+# Round trip time emulated by the fake server for each HTTP request
+LATENCY = 0.02
+
+# Number of messages in each generated thread
+THREAD_LENGTH = 5
+
+def _timed(server, function):
+    server.http_requests = 0
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start, server.http_requests
+
+def run(stdout, size=DEFAULT_SIZE):
+    messages = {}
+    for i in range(size):
+        message_id = f"m{i:06d}"
+        messages[message_id] = make_message(message_id, thread_id=f"t{i // THREAD_LENGTH:06d}", body=f"Body {i}")
+    ids = list(messages)
+    thread_ids = sorted({m['threadId'] for m in messages.values()})
+
+    with FakeGmailServer(messages, latency=LATENCY) as server:
+        helper = server.helper()
+        results = [
+            ("fetch_email", _timed(server, lambda: [helper.fetch_email(email_id) for email_id in ids])),
+            ("fetch_emails", _timed(server, lambda: helper.fetch_emails(ids))),
+            ("iter_threads, 1 worker", _timed(server, lambda: list(helper.iter_threads(thread_ids, workers=1)))),
+            (f"iter_threads, {DEFAULT_FETCH_WORKERS} workers", _timed(server, lambda: list(helper.iter_threads(thread_ids, workers=DEFAULT_FETCH_WORKERS)))),
+        ]
+
+    stdout.write(f"{size} messages in {len(thread_ids)} threads, {LATENCY * 1000:.0f} ms per HTTP request")
+    for name, (elapsed, requests) in results:
+        stdout.write(f"{name:<26} {elapsed:6.2f}s {size / elapsed:6.0f} msg/s ({requests} HTTP requests)")
@@ -0,0 +1,53 @@
+"""
+Compare the size of the summary prompts of a long thread when every reply is summarized with the
+whole conversation, and with the previous summary plus the new reply (see extract_thread_node).
+No LLM is called: the prompts are rendered by the graph nodes and a fixed summary is saved after
+each reply. The generation latency of the LLM grows with the prompt size.
+"""
+import random
+import time
+from datetime import datetime, timedelta, timezone
+from core.benchmarks import benchmark_database
+from core.llm.nodes import extract_thread_node, gather_knowledge_node, summary_prompt
+from core.models import Email, EmailString, Thread, ThreadSummary
+
+DEFAULT_SIZE = 40
+
+# Words of a generated reply
+REPLY_WORDS = 250
+
+SUMMARY = "The vendor and the team discuss the delivery schedule and the budget of the project. " * 4
+
+def _render(thread, force_refresh):
+    """Render the summary prompt of the thread, then save a summary as summarize_thread_node would"""
+    state = gather_knowledge_node(extract_thread_node({"thread": thread, "force_refresh": force_refresh}))
+    prompt_template, prompt_input = summary_prompt(state)
+    previous = state["previous_summary"]
+    ThreadSummary.objects.create(thread=thread, email=state["last_email"], summary=SUMMARY, action="NEED_TO_KNOW",
+                                 rationale="Follow up", participants=[],
+                                 incremental_count=0 if previous is None else previous.incremental_count + 1)
+    return len(prompt_template.format(**prompt_input))
+
+def run(stdout, size=DEFAULT_SIZE):
+    rng = random.Random(42)
+    words = ["delivery", "budget", "schedule", "invoice", "shipment", "meeting", "contract", "update", "vendor", "team"]
+    with benchmark_database():
+        senders = [EmailString.objects.create(original_string=s) for s in ("Vendor <sales@vendor.com>", "Me <me@example.com>")]
+        sizes = {}
+        for mode, force_refresh in (("full", True), ("incremental", False)):
+            thread = Thread.objects.create(gmail_thread_id=f"t-{mode}")
+            sizes[mode] = []
+            start = time.perf_counter()
+            for i in range(size):
+                Email.objects.create(gmail_message_id=f"{mode}-{i}", gmail_thread_id=thread.gmail_thread_id,
+                                     date=datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(hours=i),
+                                     sender_str=senders[i % 2], subject="Re: Delivery schedule", snippet="",
+                                     body=" ".join(rng.choices(words, k=REPLY_WORDS)), thread=thread)
+                sizes[mode].append(_render(thread, force_refresh))
+            sizes[mode + "_time"] = time.perf_counter() - start
+
+        for mode in ("full", "incremental"):
+            total = sum(sizes[mode])
+            stdout.write(f"{mode:<12} {total:9} prompt characters for {size} replies, last reply {sizes[mode][-1]:6} "
+                         f"(~{sizes[mode][-1] // 4} tokens), rendered in {sizes[mode + '_time']:.2f}s")
+        stdout.write(f"incremental prompts are {sum(sizes['full']) / sum(sizes['incremental']):.1f}x smaller in total")
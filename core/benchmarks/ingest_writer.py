@@ -0,0 +1,76 @@
+"""
+Compare the ways of storing downloaded messages in the database:
+- _process_email, a few queries and one transaction per message
+- EmailBatchWriter, set-based lookups and bulk inserts by chunks of messages
+Each approach starts from an empty test database.
+"""
+import io
+import time
+from contextlib import redirect_stdout
+from core import gmail_helper
+from core.benchmarks import benchmark_database
+from core.email_writer import EmailBatchWriter, DEFAULT_CHUNK_SIZE
+from core.management.commands.fetch_email import _process_email
+from core.models import Thread
+from core.tests_core.fake_gmail import FakeGmailServer, make_message
+
+DEFAULT_SIZE = 10000
+
+# Number of messages in each generated thread
+THREAD_LENGTH = 5
+
+# Number of distinct correspondents
+CORRESPONDENTS = 200
+
+def _generate_messages(size):
+    messages = {}
+    for i in range(size):
+        message_id = f"m{i:06d}"
+        messages[message_id] = make_message(
+            message_id,
+            thread_id=f"t{i // THREAD_LENGTH:06d}",
+            subject=f"Subject {i // THREAD_LENGTH}",
+            body=f"Body {i}",
+            sender=f"Person {i % CORRESPONDENTS} <person{i % CORRESPONDENTS}@example.com>",
+            to=f"Person {(i + 1) % CORRESPONDENTS} <person{(i + 1) % CORRESPONDENTS}@example.com>, Me <me@example.com>",
+            internal_date=1700000000000 + i * 1000,
+            label_ids=['INBOX', 'UNREAD'] if i % 3 else ['INBOX'],
+        )
+    return messages
+
+def _timed(parsed, store):
+    with benchmark_database():
+        threads = {}
+        for message in parsed:
+            if message['threadId'] not in threads:
+                threads[message['threadId']] = Thread.objects.create(gmail_thread_id=message['threadId'])
+        start = time.perf_counter()
+        with redirect_stdout(io.StringIO()):
+            store([(message, threads[message['threadId']]) for message in parsed])
+        return time.perf_counter() - start
+
+def _store_one_by_one(messages):
+    for message, thread in messages:
+        _process_email(message, thread)
+
+def _store_in_bulk(messages):
+    writer = EmailBatchWriter(gmail_helper.get_gmail_helper())
+    for message, thread in messages:
+        writer.add(message, thread)
+    writer.flush()
+
+def run(stdout, size=DEFAULT_SIZE):
+    with FakeGmailServer(_generate_messages(size)) as server:
+        previous_helper, gmail_helper._gmail_helper = gmail_helper._gmail_helper, server.helper()
+        try:
+            parsed = gmail_helper._gmail_helper.fetch_emails(sorted(server.messages))
+            results = [
+                ("_process_email", _timed(parsed, _store_one_by_one)),
+                (f"EmailBatchWriter ({DEFAULT_CHUNK_SIZE})", _timed(parsed, _store_in_bulk)),
+            ]
+        finally:
+            gmail_helper._gmail_helper = previous_helper
+
+    stdout.write(f"{size} messages in {size // THREAD_LENGTH} threads, {CORRESPONDENTS} correspondents")
+    for name, elapsed in results:
+        stdout.write(f"{name:<26} {elapsed:6.2f}s {size / elapsed:6.0f} msg/s")
@@ -0,0 +1,68 @@
+"""
+Compare the size of the summary prompt of generated threads before and after the compaction of
+core/llm/compaction.py: many recipients repeated on every reply, signatures and legal footers,
+and participants with a long knowledge. No LLM is called, the prompts are rendered by the graph nodes.
+On a CPU the prefill time of the LLM grows with the prompt size.
+"""
+import random
+import time
+from datetime import datetime, timedelta, timezone
+from core.benchmarks import benchmark_database
+from core.llm.chunks import estimate_tokens
+from core.llm.nodes import compact_prompt_node, extract_thread_node, gather_knowledge_node, summary_prompt
+from core.models import Email, EmailString, Thread
+
+DEFAULT_SIZE = 20
+
+# Replies of a generated thread, and their recipients
+THREAD_LENGTH = 8
+RECIPIENTS = 12
+
+REPLY_WORDS = 60
+KNOWLEDGE_FACTS = 40
+
+SIGNATURE = "\n--\nJane Doe\nSales Manager, Vendor Pty Ltd\n+61 2 9999 9999\n"
+FOOTER = ("\nThis email and any attachments are confidential and intended solely for the addressee. "
+          "If you are not the intended recipient, please notify the sender and delete this email. " * 2)
+
+def _fill(rng, size):
+    words = ["delivery", "budget", "schedule", "invoice", "shipment", "meeting", "contract", "update", "vendor", "team"]
+    facts = ["Works at Vendor Pty Ltd", "Manages the sales team", "Prefers phone calls", "Based in Sydney",
+             "Handles the invoices", "Met at the 2023 trade show", "Plays golf", "Reports to the CEO"]
+    people = [EmailString.objects.create(original_string=f"Person {i} <person{i}@vendor.com>") for i in range(RECIPIENTS + 2)]
+    for person in people:
+        person.contact.knowledge = " ".join(f"{rng.choice(facts)} ({i})." for i in range(KNOWLEDGE_FACTS))
+        person.contact.save()
+    threads = []
+    for t in range(size):
+        thread = Thread.objects.create(gmail_thread_id=f"t{t}")
+        for i in range(THREAD_LENGTH):
+            email = Email.objects.create(gmail_message_id=f"m{t}-{i}", gmail_thread_id=thread.gmail_thread_id,
+                                         date=datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(hours=i),
+                                         sender_str=people[i % 2], subject="Re: Delivery schedule", snippet="",
+                                         body=" ".join(rng.choices(words, k=REPLY_WORDS)) + SIGNATURE + FOOTER,
+                                         thread=thread)
+            email.to_str.set(people[2:])
+        threads.append(thread)
+    return threads
+
+def _prompt_tokens(state):
+    prompt_template, prompt_input = summary_prompt(state)
+    return estimate_tokens(prompt_template.format(**prompt_input))
+
+def run(stdout, size=DEFAULT_SIZE):
+    rng = random.Random(42)
+    with benchmark_database():
+        threads = _fill(rng, size)
+        before, after, elapsed = 0, 0, 0.0
+        for thread in threads:
+            state = gather_knowledge_node(extract_thread_node({"thread": thread}))
+            start = time.perf_counter()
+            compacted = compact_prompt_node(state)
+            elapsed += time.perf_counter() - start
+            before += _prompt_tokens(state)
+            after += _prompt_tokens(compacted)
+        stdout.write(f"{size} threads of {THREAD_LENGTH} emails to {RECIPIENTS} recipients")
+        stdout.write(f"before compaction {before // size:7} tokens per prompt")
+        stdout.write(f"after compaction  {after // size:7} tokens per prompt ({(before - after) * 100 / before:.0f}% saved), "
+                     f"compacted in {elapsed * 1000 / size:.1f}ms per prompt")
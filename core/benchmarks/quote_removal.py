@@ -0,0 +1,64 @@
+"""
+Compare the previous remove_quoted_text (five regexes, each listing all its matches)
+with the single compiled alternation of core.utils.email, on long threaded bodies.
+"""
+import random
+import re
+import time
+from core.utils import remove_quoted_text
+
+DEFAULT_SIZE = 200
+
+# Number of replies quoted in each generated body
+THREAD_DEPTH = 30
+
+def _previous_remove_quoted_text(body):
+    """remove_quoted_text before the single alternation, kept here as the reference"""
+    patterns = [
+        r"On.*wrote:",
+        r"From:.*\nSent:.*\nTo:.*\nSubject:",
+        r"-----Original Message-----",
+        r"^>.*$",
+        r"From:.*\nSent:.*\nTo:.*\n(?:Cc:.*\n)?Subject:",
+    ]
+    earliest_quote = len(body)
+    for pattern in patterns:
+        matches = list(re.finditer(pattern, body, re.MULTILINE))
+        if matches:
+            earliest_quote = min(earliest_quote, matches[0].start())
+    return body[:earliest_quote].strip()
+
+def _paragraph(rng):
+    vocabulary = ["Once", "the", "project", "is", "On", "schedule", "and", "we", "will", "send", "the", "report",
+                  "before", "Friday", "meeting", "with", "a", "From", "budget", "review"]
+    return " ".join(rng.choice(vocabulary) for _ in range(60))
+
+def _threaded_body(rng, depth):
+    """A reply quoting the previous ones, Gmail and Outlook style alternately"""
+    lines = [_paragraph(rng) for _ in range(5)]
+    for level in range(1, depth + 1):
+        if level % 2:
+            lines.append(f"On Mon, May {level} 2024 at 10:00 AM, Person {level} <p{level}@example.com> wrote:")
+            lines.extend("> " * level + _paragraph(rng) for _ in range(4))
+        else:
+            lines.extend([f"From: Person {level} <p{level}@example.com>", "Sent: Monday, May 20, 2024",
+                          "To: Me <me@example.com>", "Subject: RE: Project"])
+            lines.extend(_paragraph(rng) for _ in range(4))
+    return "\n".join(lines)
+
+def run(stdout, size=DEFAULT_SIZE):
+    rng = random.Random(42)
+    bodies = {
+        "threaded": [_threaded_body(rng, THREAD_DEPTH) for _ in range(size)],
+        "no quote": ["\n".join(_paragraph(rng) for _ in range(100)) for _ in range(size)],
+    }
+    stdout.write(f"{size} bodies of each kind, about {len(bodies['threaded'][0]) // 1024} KB each")
+    for name, texts in bodies.items():
+        timings = []
+        for remove in (_previous_remove_quoted_text, remove_quoted_text):
+            start = time.perf_counter()
+            results = [remove(text) for text in texts]
+            timings.append(time.perf_counter() - start)
+        assert results == [_previous_remove_quoted_text(text) for text in texts]
+        stdout.write(f"{name:<10} previous {timings[0] / size * 1000:7.3f}ms  single alternation {timings[1] / size * 1000:7.3f}ms  "
+                     f"{timings[0] / timings[1]:5.1f}x")
@@ -0,0 +1,89 @@
+"""
+Compare the previous thread search (icontains on the subject and body of every email, with distinct)
+with the FTS5 index of core.search_index, on a test database filled with generated emails.
+Each search returns the number of matching threads and the first page (with its snippets for the index),
+like the thread list view.
+"""
+import random
+import time
+from datetime import datetime, timedelta, timezone
+from django.db.models import Q
+from core import search_index
+from core.benchmarks import benchmark_database
+from core.models import Email, EmailString, Thread
+
+DEFAULT_SIZE = 500000
+
+# Number of emails in each generated thread
+THREAD_LENGTH = 5
+
+# Number of emails inserted at once while filling the database
+INSERT_CHUNK_SIZE = 5000
+
+# Number of distinct generated words, and of words in a body
+VOCABULARY_SIZE = 5000
+BODY_WORDS = 80
+
+QUERIES = ["project", "w42", "w4321", "project w1234", '"project w12"', "w12"]
+
+# Searches of each query timed, the best time is kept
+REPEAT = 3
+
+def _vocabulary():
+    # A few very common words, then generated ones drawn with a Zipf-like distribution
+    common = ["project", "meeting", "report", "budget", "team", "review", "schedule", "update"]
+    words = common + [f"w{i}" for i in range(VOCABULARY_SIZE - len(common))]
+    weights = [1 / (rank + 1) for rank in range(len(words))]
+    return words, weights
+
+def _fill(size):
+    rng = random.Random(42)
+    words, weights = _vocabulary()
+    senders = [EmailString.objects.create(original_string=f"Person {i} <person{i}@example.com>") for i in range(100)]
+    threads = Thread.objects.bulk_create([Thread(gmail_thread_id=f"t{i}") for i in range(size // THREAD_LENGTH + 1)])
+    start_date = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    for chunk_start in range(0, size, INSERT_CHUNK_SIZE):
+        Email.objects.bulk_create([
+            Email(
+                gmail_message_id=f"m{i}",
+                gmail_thread_id=f"t{i // THREAD_LENGTH}",
+                date=start_date + timedelta(minutes=i),
+                sender_str=senders[i % len(senders)],
+                subject=" ".join(rng.choices(words, weights, k=5)),
+                body=" ".join(rng.choices(words, weights, k=BODY_WORDS)),
+                stripped_body=None,
+                snippet="",
+                thread=threads[i // THREAD_LENGTH],
+            )
+            for i in range(chunk_start, min(size, chunk_start + INSERT_CHUNK_SIZE))
+        ])
+
+def _previous_search(text):
+    threads = Thread.objects.filter(Q(email__subject__icontains=text) | Q(email__body__icontains=text)).distinct()
+    return threads.count(), list(threads.order_by('-created_at').values_list('id', flat=True)[:10])
+
+def _index_search(text):
+    results = search_index.search_threads(text)
+    snippets = search_index.get_snippets(text, results[:10])
+    return len(results), [thread_id for thread_id, email_id in results[:10]]
+
+def _best_time(search, text):
+    timings = []
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        count, page = search(text)
+        timings.append(time.perf_counter() - start)
+    return min(timings), count
+
+def run(stdout, size=DEFAULT_SIZE):
+    with benchmark_database():
+        start = time.perf_counter()
+        _fill(size)
+        stdout.write(f"{size} emails in {size // THREAD_LENGTH} threads inserted and indexed in {time.perf_counter() - start:.1f}s")
+
+        for text in QUERIES:
+            previous, previous_count = _best_time(_previous_search, text)
+            indexed, indexed_count = _best_time(_index_search, text)
+            # icontains matches substrings ("w42" in "w4213") and the index whole words, so the counts differ
+            stdout.write(f"{text:<16} icontains {previous * 1000:9.1f}ms ({previous_count:6} threads)  "
+                         f"fts5 {indexed * 1000:7.1f}ms ({indexed_count:4} threads)  {previous / indexed:6.1f}x")
@@ -0,0 +1,59 @@
+"""
+Compare the previous normalize_whitespace (a dict rebuilt on each call, one str.replace pass
+per character), str.translate, and the current core.utils.text version on 100 KB bodies.
+"""
+import random
+import re
+import time
+from core.utils import normalize_whitespace
+from core.utils.text import UNICODE_SPACES, HTML_NBSP, EMPTY_LINES
+
+DEFAULT_SIZE = 100
+
+BODY_SIZE = 100 * 1024
+
+def _previous_normalize_whitespace(text):
+    """normalize_whitespace before the translate table, kept here as the reference"""
+    unicode_spaces = dict(UNICODE_SPACES)
+    unicode_spaces[HTML_NBSP] = ' '
+    for space, replacement in unicode_spaces.items():
+        text = text.replace(space, replacement)
+    return re.sub(r'\n\s*\n', '\n\n', text)
+
+_TRANSLATE_TABLE = str.maketrans(UNICODE_SPACES)
+
+def _translate_normalize_whitespace(text):
+    """The same with a str.translate table, which looks up every character of the text in a dict"""
+    return EMPTY_LINES.sub('\n\n', text.translate(_TRANSLATE_TABLE).replace(HTML_NBSP, ' '))
+
+def _body(rng, special_characters):
+    words = ["project", "schedule", "report", "meeting", "budget", "review", "\n", "\n\n\n", "  "]
+    words += special_characters
+    text = []
+    size = 0
+    while size < BODY_SIZE:
+        word = rng.choice(words)
+        text.append(word)
+        size += len(word) + 1
+    return " ".join(text)
+
+def run(stdout, size=DEFAULT_SIZE):
+    rng = random.Random(42)
+    corpora = {
+        "ascii": [_body(rng, []) for _ in range(size)],
+        "with nbsp": [_body(rng, [" ", "&nbsp;"]) for _ in range(size)],
+        "unicode": [_body(rng, ["café", "​", " ", " ", "日本"]) for _ in range(size)],
+    }
+    stdout.write(f"{size} bodies of {BODY_SIZE // 1024} KB for each corpus")
+    for name, texts in corpora.items():
+        timings = []
+        expected = [_previous_normalize_whitespace(text) for text in texts]
+        for normalize_all in (lambda: [_previous_normalize_whitespace(text) for text in texts],
+                              lambda: [_translate_normalize_whitespace(text) for text in texts],
+                              lambda: [normalize_whitespace(text) for text in texts]):
+            start = time.perf_counter()
+            results = normalize_all()
+            timings.append(time.perf_counter() - start)
+            assert results == expected
+        stdout.write(f"{name:<10} previous {timings[0] / size * 1000:7.3f}ms  translate {timings[1] / size * 1000:7.3f}ms  "
+                     f"current {timings[2] / size * 1000:7.3f}ms  {timings[0] / timings[2]:5.1f}x")
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+This module stores the messages downloaded from Gmail in the database.
+Messages are written by chunks: the strings, labels and threads of a whole chunk are looked up
+with a few set-based queries, and the emails and their relations are inserted with bulk_create,
+all in one transaction.
+"""
+import logging
+from datetime import datetime, timezone
+from django.db import transaction
+from django.utils import timezone as django_timezone
+from core.identity_resolver import IdentityResolver
+from core.models import Email, Label, Thread
+from core.utils import classify_calendar_invites, remove_quoted_text, split_addresses
+from core.utils.contact_index import contact_index
+
+logger = logging.getLogger(__name__)
+
+# Number of messages written in one transaction
+DEFAULT_CHUNK_SIZE = 500
+
+class EmailBatchWriter:
+    """Buffer parsed Gmail messages and write them to the database by chunks.
+
+    Usage:
+        writer = EmailBatchWriter(gmail_helper)
+        for message, thread in messages:
+            writer.add(message, thread)
+        writer.flush()
+
+    Like _process_email in the fetch_email command, it creates the missing email strings and labels,
+    adds the Calendar label to calendar invites and keeps Thread.last_email pointing to the newest email.
+    """
+
+    def __init__(self, gmail_helper, chunk_size=DEFAULT_CHUNK_SIZE, resolver=None):
+        self.gmail_helper = gmail_helper
+        self.resolver = resolver or IdentityResolver()
+        self.chunk_size = chunk_size
+        self.pending = []
+        self.written_count = 0
+        self._calendar_label = None
+
+    def add(self, message, thread):
+        """Queue a message (as returned by GmailHelper) belonging to thread, and write the chunk when it is full"""
+        self.pending.append((message, thread))
+        if len(self.pending) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Write all the queued messages"""
+        if not self.pending:
+            return
+        chunk, self.pending = self.pending, []
+        try:
+            with transaction.atomic():
+                self._write(chunk)
+        except Exception:
+            # The ids of the rows created in the rolled back transaction must not be reused
+            self.resolver.clear()
+            contact_index.clear()
+            raise
+        self.written_count += len(chunk)
+        logger.info(f"Stored {len(chunk)} emails ({self.written_count} in total)")
+
+    def _write(self, chunk):
+        parsed = []
+        for message, thread in chunk:
+            parsed.append({
+                "message": message,
+                "thread": thread,
+                "sender": message.get("From", "").strip(),
+                "to": split_addresses(message.get("To", "")),
+                "cc": split_addresses(message.get("Cc", "")),
+                "date": datetime.fromtimestamp(int(message['internalDate']) / 1000, tz=timezone.utc),
+                "label_ids": list(message.get("labelIds", [])),
+            })
+        calendar_flags = classify_calendar_invites(
+            {
+                "subject": message.get('Subject', ''),
+                "body": message['Body'],
+                "headers": message.get('payload', {}).get('headers', []),
+                "payload": message.get('payload'),
+            }
+            for message, thread in chunk
+        )
+        for p, calendar in zip(parsed, calendar_flags):
+            p["calendar"] = calendar
+
+        strings = self.resolver.email_string_ids(
+            {p["sender"] for p in parsed} | {s for p in parsed for s in p["to"] + p["cc"]}
+        )
+        labels = self.resolver.label_ids(
+            {label_id for p in parsed for label_id in p["label_ids"]},
+            self.gmail_helper.fetch_label
+        )
+        calendar_label_id = self._get_calendar_label().id if any(p["calendar"] for p in parsed) else None
+
+        Email.objects.bulk_create([
+            Email(
+                gmail_message_id=p["message"]['id'],
+                gmail_thread_id=p["thread"].gmail_thread_id,
+                date=p["date"],
+                subject=p["message"].get('Subject', ''),
+                snippet=p["message"]['snippet'],
+                body=p["message"]['Body'],
+                stripped_body=remove_quoted_text(p["message"]['Body']),
+                thread=p["thread"],
+                sender_str_id=strings[p["sender"]],
+            )
+            for p in parsed
+        ], ignore_conflicts=True)
+        # ignore_conflicts does not give us the primary keys back, so we read them
+        email_ids = dict(Email.objects.filter(
+            gmail_message_id__in=[p["message"]['id'] for p in parsed]
+        ).values_list('gmail_message_id', 'id'))
+
+        to_rows, cc_rows, label_rows = [], [], []
+        for p in parsed:
+            email_id = email_ids[p["message"]['id']]
+            to_rows.extend(Email.to_str.through(email_id=email_id, emailstring_id=strings[s]) for s in p["to"])
+            cc_rows.extend(Email.cc_str.through(email_id=email_id, emailstring_id=strings[s]) for s in p["cc"])
+            label_rows.extend(Email.labels.through(email_id=email_id, label_id=labels[l]) for l in p["label_ids"])
+            if p["calendar"]:
+                label_rows.append(Email.labels.through(email_id=email_id, label_id=calendar_label_id))
+        Email.to_str.through.objects.bulk_create(to_rows, ignore_conflicts=True)
+        Email.cc_str.through.objects.bulk_create(cc_rows, ignore_conflicts=True)
+        Email.labels.through.objects.bulk_create(label_rows, ignore_conflicts=True)
+
+        self._update_last_emails(parsed, email_ids)
+
+    def _get_calendar_label(self):
+        if self._calendar_label is None:
+            self._calendar_label, created = Label.objects.get_or_create(
+                name="Calendar",
+                defaults={
+                    "gmail_label_id": "CALENDAR",  # This is a custom label, not a Gmail system label
+                }
+            )
+        return self._calendar_label
+
+    def _update_last_emails(self, parsed, email_ids):
+        """Point each thread of the chunk to its newest email"""
+        newest = {}
+        threads = {}
+        for p in parsed:
+            thread = p["thread"]
+            threads[thread.id] = thread
+            if thread.id not in newest or newest[thread.id][0] <= p["date"]:
+                newest[thread.id] = (p["date"], email_ids[p["message"]['id']])
+
+        last_dates = dict(Email.objects.filter(
+            id__in=[t.last_email_id for t in threads.values() if t.last_email_id]
+        ).values_list('id', 'date'))
+
+        now = django_timezone.now()
+        changed = []
+        for thread_id, (date, email_id) in newest.items():
+            thread = threads[thread_id]
+            last_date = last_dates.get(thread.last_email_id)
+            if last_date is None or last_date <= date:
+                thread.last_email_id = email_id
+                thread.updated_at = now
+                changed.append(thread)
+        Thread.objects.bulk_update(changed, ['last_email', 'updated_at'])
@@ -3,76 +3,213 @@ from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from googleapiclient.http import BatchHttpRequest
 from datetime import datetime, timedelta
-import bleach
-import markdownify
-import base64
-import re
-from core.utils import normalize_whitespace
-
-def _extract_body_from_gmail_message(payload):
-    text_body = None
-    html_body = None
-
-    def extract_parts(parts):
-        nonlocal text_body, html_body
-        for part in parts:
-            mime_type = part.get("mimeType")
-            body = part.get("body", {})
-            data = body.get("data")
-            if data:
-                decoded = base64.urlsafe_b64decode(data.encode("utf-8")).decode("utf-8", errors="replace")
-                if mime_type == "text/html" and not html_body:
-                    html_body = decoded
-                elif mime_type == "text/plain" and not text_body:
-                    text_body = decoded
-            # Recursively handle nested multiparts
-            if "parts" in part:
-                extract_parts(part["parts"])
-
-    md_body = None
-    text_body = None
-    if payload.get("mimeType", "").startswith("multipart/"):
-        extract_parts(payload["parts"])
-    else:
-        # Single-part message
-        data = payload.get("body", {}).get("data")
-        if data:
-            decoded = base64.urlsafe_b64decode(data.encode("utf-8")).decode("utf-8", errors="replace")
-            if payload["mimeType"] == "text/html":
-                # First clean the HTML and remove display:none elements
-                cleaned_html = bleach.clean(decoded, 
-                    strip=False,
-                    tags=['div', 'span', 'p', 'br', 'b', 'i', 'u', 'em', 'strong', 'a', 'ul', 'ol', 'li', 'blockquote', 'pre', 'code', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'table', 'tr', 'td', 'th', 'thead', 'tbody'],
-                    attributes={'*': ['style', 'class', 'id', 'href', 'src', 'alt', 'title']}
-                )
-                # Remove elements with display:none
-                cleaned_html = re.sub(r'<[^>]*style="[^"]*display:\s*none[^"]*"[^>]*>.*?</[^>]*>', '', cleaned_html, flags=re.DOTALL)
-                # Convert to markdown
-                md_body = markdownify.markdownify(cleaned_html)
-            elif payload["mimeType"] == "text/plain":
-                text_body = decoded
-    body = text_body or md_body or ""
-
-    # Normalize whitespace in the body
-    body = normalize_whitespace(body)
-
-    return body
+import json
+import logging
+import queue
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from core.utils import extract_body
+
+# Keys added to a Gmail message resource by parse_message
+PARSED_FIELDS = ('From', 'Subject', 'To', 'Cc', 'Date', 'Body')
+
+# Gmail accepts at most 100 calls in a single batch HTTP request
+GMAIL_BATCH_LIMIT = 100
+
+# Number of message IDs requested per page when listing emails
+LIST_PAGE_SIZE = 100
+
+# Default number of workers used by iter_threads and iter_thread_emails
+DEFAULT_FETCH_WORKERS = 4
+
+# Put on the result queue by a _iter_parallel worker when it has no more work
+_WORKER_DONE = object()
+
+# Gmail quota units consumed by each API method
+# See https://developers.google.com/gmail/api/reference/quota
+QUOTA_UNITS = {
+    'gmail.users.getProfile': 1,
+    'gmail.users.history.list': 2,
+    'gmail.users.labels.get': 1,
+    'gmail.users.labels.list': 1,
+    'gmail.users.messages.get': 5,
+    'gmail.users.messages.list': 5,
+    'gmail.users.threads.get': 10,
+}
+
+logger = logging.getLogger(__name__)
+
+# Gmail allows 250 quota units per user per second
+QUOTA_UNITS_PER_SECOND = 250
+
+# Error reasons returned by Gmail when we go over the quota
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded', 'quotaExceeded'}
+
+# HTTP status codes worth retrying
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+# Messages added to these labels are not listed by the after: search of a full sync, so they are not
+# fetched from the history either
+HISTORY_EXCLUDED_LABELS = frozenset(['SPAM', 'TRASH', 'DRAFT'])
+
+class HistoryExpiredError(Exception):
+    """Raised when Gmail no longer has the history records since the requested history id"""
+
+class RequestScheduler:
+    """Execute Gmail API requests within the user quota.
+
+    Requests take their quota units from a token bucket refilled at `units_per_second`. When Gmail
+    answers with a rate limit or server error, the request is retried with an exponential backoff
+    with jitter, never sooner than the Retry-After header. Each rate limit error halves the refill
+    rate, which then grows back slowly on success.
+    The scheduler is thread-safe and is meant to be shared by all the helpers using the same account.
+
+    Attributes:
+        stats (dict): counters of calls, quota units used, throttled calls (which waited for quota),
+            rate limited calls (rejected by Gmail) and retried calls
+    """
+
+    def __init__(self, units_per_second=QUOTA_UNITS_PER_SECOND, burst=QUOTA_UNITS_PER_SECOND, max_retries=6,
+                 base_delay=1.0, max_delay=64.0, clock=time.monotonic, sleep=time.sleep):
+        self.max_rate = units_per_second
+        self.rate = units_per_second
+        self.burst = burst
+        self.tokens = burst
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.clock = clock
+        self.sleep = sleep
+        self.updated_at = clock()
+        self.lock = threading.Lock()
+        self.stats = {'calls': 0, 'units': 0, 'throttled': 0, 'rate_limited': 0, 'retried': 0}
+
+    def acquire(self, units):
+        """Take units from the bucket, waiting until they are available"""
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            # Tokens are reserved straight away, so concurrent callers queue up behind each other
+            self.tokens -= units
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            self.stats['calls'] += 1
+            self.stats['units'] += units
+            if wait:
+                self.stats['throttled'] += 1
+        if wait:
+            self.sleep(wait)
+
+    def execute(self, request, units=None):
+        """Execute a request (or batch request) and return its result, retrying on rate limit and server errors.
+        units defaults to the quota cost of the request method."""
+        if units is None:
+            units = QUOTA_UNITS.get(getattr(request, 'methodId', None), 1)
+        attempt = 0
+        while True:
+            self.acquire(units)
+            try:
+                result = request.execute()
+            except HttpError as e:
+                rate_limited = self.is_rate_limited(e)
+                if rate_limited:
+                    self.slow_down()
+                if attempt >= self.max_retries or not (rate_limited or e.resp.status in RETRYABLE_STATUSES):
+                    raise
+                with self.lock:
+                    self.stats['retried'] += 1
+                self.sleep(self._backoff_delay(e, attempt))
+                attempt += 1
+            else:
+                with self.lock:
+                    self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
+                return result
+
+    def slow_down(self):
+        """Record a rate limit error and halve the refill rate"""
+        with self.lock:
+            self.stats['rate_limited'] += 1
+            self.rate = max(self.max_rate / 50, self.rate / 2)
+
+    def is_rate_limited(self, error):
+        """Whether an HttpError means we went over the Gmail quota"""
+        if error.resp.status == 429:
+            return True
+        return error.resp.status == 403 and bool(RATE_LIMIT_REASONS & _error_reasons(error))
+
+    def _backoff_delay(self, error, attempt):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+def _error_reasons(error):
+    """Return the set of error reasons of a Gmail HttpError"""
+    try:
+        content = json.loads(error.content.decode('utf-8'))
+        return {e.get('reason') for e in content['error'].get('errors', [])}
+    except (ValueError, KeyError, AttributeError, TypeError):
+        return set()
+
+def _retry_after(error):
+    """Return the number of seconds asked by the Retry-After header of an HttpError, if any"""
+    value = error.resp.get('retry-after')
+    if not value:
+        return None
+    if value.isdigit():
+        return int(value)
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def parse_message(msg):
+    """ Add the keys From, Subject, To, Cc, Date and Body to a Gmail message resource, from its payload.
+    It does not need Gmail, so archived messages can be parsed again offline."""
+    headers = msg.get('payload', {}).get('headers', [])
+    for header in headers:
+        if header['name'] in PARSED_FIELDS:
+            msg[header['name']] = header['value']
+
+    msg['Body'] = extract_body(msg['payload'])
+
+    return msg
 
 # this file will create a class calls GmailHelper,
 # it will handle the authentication and fetching of emails and threads from Gmail
 # authentication will be done using gmail authentication
 # Methods will be
 # fetch_emails_since (getting a timestamp as a parameter) - this will return email ids
+# iter_email_pages (getting a timestamp as a parameter) - same as fetch_emails_since, one page at a time
 # fetch_email - parameter email_id
+# fetch_emails - parameter email_ids. Same as fetch_email but using batch requests
 # fetch_thread - parameter thread_id. This will return the thread object and the id of all emails in the thread
+# iter_threads - parameter thread_ids. Same as fetch_thread for several threads, fetched in parallel
+# iter_thread_emails - parameter thread_email_ids. Same as fetch_emails for several threads, fetched in parallel
+# get_history_id - returns the current history id of the mailbox
+# fetch_history - parameter history_id. This will return the emails added and the label changes since that history id
 
 class GmailHelper:
-    def __init__(self):
+    def __init__(self, service=None, batch_uri=None, service_factory=None, scheduler=None):
+        """ service, batch_uri and service_factory can be given to talk to another endpoint than Gmail
+        (e.g. a local fake server in tests). When service is not given, we authenticate against Gmail.
+        service_factory is called to create the extra services used by copy().
+        All requests go through scheduler, which keeps us within the Gmail quota."""
         self.creds = None
-        self.service = None
+        self.service = service
+        self.batch_uri = batch_uri
+        self.service_factory = service_factory
+        self.scheduler = scheduler or RequestScheduler()
+        self.labels_cache = None  # Gmail label id -> label resource, loaded by fetch_labels
         self.SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
-        self.authenticate()
+        if self.service is None:
+            self.authenticate()
 
     def authenticate(self):
         """ This function handles the OAuth2 authentication flow and returns the credentials."""
@@ -92,76 +229,265 @@ class GmailHelper:
             # Save credentials
             with open('token.json', 'w') as token:
                 token.write(self.creds.to_json())
-        self.service = build('gmail', 'v1', credentials=self.creds)
+        self.service = self._build_service()
+
+    def _build_service(self):
+        """ Build a Gmail service with its own authorized HTTP client"""
+        if self.service_factory:
+            return self.service_factory()
+        return build('gmail', 'v1', credentials=self.creds)
+
+    def copy(self):
+        """ Return a helper using the same credentials but its own HTTP client.
+        The httplib2 client of a service is not thread-safe, so each thread needs its own helper."""
+        helper = GmailHelper(service=self._build_service(), batch_uri=self.batch_uri, service_factory=self.service_factory,
+                             scheduler=self.scheduler)
+        helper.creds = self.creds
+        return helper
 
     def fetch_emails_since(self, timestamp):
-        """ This function fetches email IDs from Gmail since the given timestamp."""
-        # Fetch messages ids from Gmail. Handle the next page token if needed
-        results = self.service.users().messages().list(userId='me', q=f'after:{int(timestamp)+1}', maxResults = 100).execute() # type: ignore[attr-defined]
-        messages = results.get('messages', [])
-        while 'nextPageToken' in results:
-            page_token = results['nextPageToken']
-            results = self.service.users().messages().list(userId='me', q=f'after:{int(timestamp)+1}', pageToken=page_token).execute() # type: ignore[attr-defined]
-            messages.extend(results.get('messages', []))
+        """ This function fetches email IDs from Gmail since the given timestamp, oldest first.
+        It keeps all the IDs in memory, use iter_email_pages for large mailboxes."""
+        messages = []
+        for page, next_page_token in self.iter_email_pages(timestamp):
+            messages.extend(page)
 
         # We want to reverse the order of the messages so that the oldest messages are first
         messages.reverse()
 
         return messages
 
+    def iter_email_pages(self, timestamp, page_token=None, page_size=LIST_PAGE_SIZE):
+        """ This function lists email IDs from Gmail since the given timestamp, one page at a time.
+        It yields (messages, next_page_token) tuples, newest messages first as returned by Gmail.
+        next_page_token is None for the last page. Passing it back as page_token resumes the listing
+        after that page."""
+        while True:
+            results = self.scheduler.execute(self.service.users().messages().list( # type: ignore[attr-defined]
+                userId='me', q=f'after:{int(timestamp)+1}', maxResults=page_size, pageToken=page_token
+            ))
+            page_token = results.get('nextPageToken')
+            yield results.get('messages', []), page_token
+            if not page_token:
+                break
+
+    def get_history_id(self):
+        """ This function returns the current history id of the mailbox."""
+        profile = self.scheduler.execute(self.service.users().getProfile(userId='me')) # type: ignore[attr-defined]
+        return profile['historyId']
+
+    def fetch_history(self, start_history_id):
+        """ This function fetches the changes of the mailbox since start_history_id.
+        It returns a tuple (history_id, added_messages, label_changes) where:
+            - history_id is the history id to start from next time
+            - added_messages is the list of {id, threadId} of the messages added, oldest first. Messages deleted
+              since (e.g. the autosaves of a draft) and the ones in HISTORY_EXCLUDED_LABELS are left out
+            - label_changes is the list of (message id, added label ids, removed label ids), in the order they happened
+        It raises HistoryExpiredError when Gmail does not have the history since start_history_id anymore."""
+        history_id = start_history_id
+        added_messages = []
+        deleted_ids = set()
+        label_changes = []
+        page_token = None
+        while True:
+            try:
+                results = self.scheduler.execute(self.service.users().history().list( # type: ignore[attr-defined]
+                    userId='me',
+                    startHistoryId=start_history_id,
+                    historyTypes=['messageAdded', 'messageDeleted', 'labelAdded', 'labelRemoved'],
+                    pageToken=page_token,
+                ))
+            except HttpError as e:
+                if e.resp.status == 404:
+                    raise HistoryExpiredError(f"History id {start_history_id} has expired") from e
+                raise
+
+            for record in results.get('history', []):
+                for added in record.get('messagesAdded', []):
+                    message = added['message']
+                    if not HISTORY_EXCLUDED_LABELS.intersection(message.get('labelIds', [])):
+                        added_messages.append({'id': message['id'], 'threadId': message['threadId']})
+                for deleted in record.get('messagesDeleted', []):
+                    deleted_ids.add(deleted['message']['id'])
+                for added in record.get('labelsAdded', []):
+                    label_changes.append((added['message']['id'], added.get('labelIds', []), []))
+                for removed in record.get('labelsRemoved', []):
+                    label_changes.append((removed['message']['id'], [], removed.get('labelIds', [])))
+
+            history_id = results.get('historyId', history_id)
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+
+        added_messages = [message for message in added_messages if message['id'] not in deleted_ids]
+        return history_id, added_messages, label_changes
+
     def fetch_email(self, email_id):
         """ This function fetches a single email from Gmail by its ID."""
-        msg = self.service.users().messages().get(userId='me', id=email_id).execute() # type: ignore[attr-defined]
+        msg = self.scheduler.execute(self.service.users().messages().get(userId='me', id=email_id)) # type: ignore[attr-defined]
         # we will add keys From, Subject, To, Date to the msg object by searching through payload headers
         msg = self._find_common_headers(msg)
         return msg
 
+    def fetch_emails(self, email_ids, batch_size=GMAIL_BATCH_LIMIT):
+        """ This function fetches several emails from Gmail by their IDs.
+        Up to batch_size messages.get calls are grouped in one batch HTTP request. Emails are returned
+        in the same order as email_ids. Calls that fail inside a batch are retried one by one.
+        Emails which no longer exist (deleted since they were listed) are left out."""
+        batch_size = max(1, min(batch_size, GMAIL_BATCH_LIMIT))
+        # A batch refuses duplicated request ids, so we only request each id once
+        unique_ids = list(dict.fromkeys(email_ids))
+        results = {}
+        failed_ids = []
+
+        def callback(request_id, response, exception):
+            if exception is not None:
+                if self.scheduler.is_rate_limited(exception):
+                    self.scheduler.slow_down()
+                failed_ids.append(request_id)
+            else:
+                results[request_id] = response
+
+        for start in range(0, len(unique_ids), batch_size):
+            batch = self._new_batch_request(callback)
+            chunk = unique_ids[start:start + batch_size]
+            for email_id in chunk:
+                batch.add(self.service.users().messages().get(userId='me', id=email_id), request_id=email_id) # type: ignore[attr-defined]
+            # Each call of a batch counts against the quota
+            self.scheduler.execute(batch, units=len(chunk) * QUOTA_UNITS['gmail.users.messages.get'])
+
+        for email_id in failed_ids:
+            try:
+                results[email_id] = self.scheduler.execute(self.service.users().messages().get(userId='me', id=email_id)) # type: ignore[attr-defined]
+            except HttpError as e:
+                if e.resp.status != 404:
+                    raise
+                logger.warning(f"Email {email_id} no longer exists, skipping it")
+
+        for msg in results.values():
+            self._find_common_headers(msg)
+        return [results[email_id] for email_id in email_ids if email_id in results]
+
+    def _new_batch_request(self, callback):
+        if self.batch_uri:
+            return BatchHttpRequest(callback=callback, batch_uri=self.batch_uri)
+        return self.service.new_batch_http_request(callback=callback) # type: ignore[attr-defined]
+
+    def fetch_labels(self):
+        """ This function loads the whole label catalogue with a single labels().list call.
+        It returns a dict Gmail label id -> label resource, which fetch_label then uses as a cache."""
+        response = self.scheduler.execute(self.service.users().labels().list(userId='me')) # type: ignore[attr-defined]
+        self.labels_cache = {label['id']: label for label in response.get('labels', [])}
+        return self.labels_cache
+
     def fetch_label(self, label_id):
-        """ This function fetches a label from Gmail by its ID. It caches known labels so we don't
-        need to query the Gmail API every time."""
-        # check if the label is already in the cache
-        if hasattr(self, 'labels_cache') and label_id in self.labels_cache:
-            return self.labels_cache[label_id]
-        # if not, fetch it from the API
-        label = self.service.users().labels().get(userId='me', id=label_id).execute() # type: ignore[attr-defined]
-        # cache the label
-        if not hasattr(self, 'labels_cache'):
-            self.labels_cache = {}
-        self.labels_cache[label_id] = label
-        return label
-
-    def fetch_thread(self, thread_id):
-        """ This function fetches a thread from Gmail by its ID."""
-        thread = self.service.users().threads().get(userId='me', id=thread_id).execute()
-        # we will add keys From, Subject, To, Date to the msg object by searching through payload headers
-        for msg in thread['messages']:
-            msg = self._find_common_headers(msg)
+        """ This function returns a label by its ID from the label catalogue.
+        The catalogue is loaded on first use, and reloaded only when an unknown label id appears."""
+        if self.labels_cache is None or label_id not in self.labels_cache:
+            self.fetch_labels()
+        if label_id not in self.labels_cache:
+            # not listed (should not happen), ask for this label only
+            self.labels_cache[label_id] = self.scheduler.execute(self.service.users().labels().get(userId='me', id=label_id)) # type: ignore[attr-defined]
+        return self.labels_cache[label_id]
+
+    def fetch_thread(self, thread_id, format='full'):
+        """ This function fetches a thread from Gmail by its ID.
+        With format='minimal', messages only carry their ids, labels and dates and are not parsed."""
+        thread = self.scheduler.execute(self.service.users().threads().get(userId='me', id=thread_id, format=format)) # type: ignore[attr-defined]
+        if format == 'full':
+            # we will add keys From, Subject, To, Date to the msg object by searching through payload headers
+            for msg in thread['messages']:
+                msg = self._find_common_headers(msg)
         return thread
 
+    def iter_threads(self, thread_ids, workers=DEFAULT_FETCH_WORKERS, queue_size=None, format='full'):
+        """ This function fetches several threads from Gmail in parallel (see _iter_parallel).
+        Threads are yielded as they arrive, not in the order of thread_ids."""
+        return self._iter_parallel(
+            thread_ids, lambda helper, thread_id: helper.fetch_thread(thread_id, format=format), workers, queue_size
+        )
+
+    def iter_thread_emails(self, thread_email_ids, workers=DEFAULT_FETCH_WORKERS, queue_size=None):
+        """ This function fetches the given emails of several threads in parallel (see _iter_parallel).
+        thread_email_ids maps a thread id to the ids of the emails to fetch from that thread.
+        It yields (thread id, emails) tuples as they arrive, emails being in the order of their ids."""
+        return self._iter_parallel(
+            list(thread_email_ids.items()), lambda helper, item: (item[0], helper.fetch_emails(item[1])), workers, queue_size
+        )
+
+    def _iter_parallel(self, items, function, workers, queue_size):
+        """ Call function(helper, item) for each item, using up to `workers` threads each with its own
+        helper, hence its own HTTP client. Results are yielded as they arrive.
+        At most queue_size results wait for the consumer, so a slow consumer (e.g. the
+        database writer) holds back the workers instead of filling the memory."""
+        items = list(items)
+        workers = min(workers, len(items))
+        if workers <= 1:
+            for item in items:
+                yield function(self, item)
+            return
+
+        tasks = queue.Queue()
+        for item in items:
+            tasks.put(item)
+        results = queue.Queue(maxsize=queue_size or workers * 2)
+        stop = threading.Event()
+
+        def put(result):
+            # We don't block forever on a full queue, in case the consumer has stopped
+            while not stop.is_set():
+                try:
+                    results.put(result, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def work(helper):
+            while not stop.is_set():
+                try:
+                    item = tasks.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    put(function(helper, item))
+                except Exception as e:
+                    put(e)
+            put(_WORKER_DONE)
+
+        for helper in [self.copy() for _ in range(workers)]:
+            threading.Thread(target=work, args=(helper,), daemon=True).start()
+
+        finished = 0
+        try:
+            while finished < workers:
+                result = results.get()
+                if result is _WORKER_DONE:
+                    finished += 1
+                elif isinstance(result, Exception):
+                    raise result
+                else:
+                    yield result
+        finally:
+            stop.set()
+
     def _find_common_headers(self, msg):
-        headers = msg.get('payload', {}).get('headers', [])
-        for header in headers:
-            if header['name'] == 'From':
-                msg['From'] = header['value']
-            elif header['name'] == 'Subject':
-                msg['Subject'] = header['value']
-            elif header['name'] == 'To':
-                msg['To'] = header['value']
-            elif header['name'] == 'Cc':
-                msg['Cc'] = header['value']
-            elif header['name'] == 'Date':
-                msg['Date'] = header['value']
-
-        msg['Body'] = _extract_body_from_gmail_message(msg['payload'])
+        return parse_message(msg)
 
-        return msg
+# Use lazy loading pattern so that importing this module does not trigger the OAuth flow
+_gmail_helper = None
 
-gmail_helper = GmailHelper()
+def get_gmail_helper():
+    """Get or create the Gmail helper instance"""
+    global _gmail_helper
+    if _gmail_helper is None:
+        _gmail_helper = GmailHelper()
+    return _gmail_helper
 
 # write a main method that will test the fetch_emails_since method
 if __name__ == "__main__":
     # fetch emails since 10 minutes ago
     timestamp = datetime.now() - timedelta(minutes=120)
+    gmail_helper = get_gmail_helper()
     emails = gmail_helper.fetch_emails_since(timestamp)
     print("Fetched Emails: ", emails)
     # we want to have a set of the threadIds related to the emails downloaded
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+This module keeps, for the duration of a sync, the ids of the email strings, email addresses,
+contacts and labels already seen, so the same senders and recipients are not looked up
+in the database for every message.
+It also reconciles the Label table with the Gmail label catalogue.
+"""
+from collections import OrderedDict
+from django.utils import timezone
+from core.models import Contact, EmailAddress, EmailString, Label
+from core.utils import extract_email_and_name, search_similar_contacts
+from core.utils.contact_index import contact_index
+
+# Maximum number of entries kept in each map
+DEFAULT_MAX_SIZE = 20000
+
+class LRUMap:
+    """A dict-like map which forgets the least recently used keys when it holds more than max_size entries"""
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        if key in self.data:
+            self.data.move_to_end(key)
+            self.hits += 1
+            return self.data[key]
+        self.misses += 1
+        return default
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def clear(self):
+        self.data.clear()
+
+def reconcile_labels(gmail_labels):
+    """Bring the Label table in line with the Gmail label catalogue (a dict Gmail label id -> label resource,
+    as returned by GmailHelper.fetch_labels): missing labels are created and renamed labels get their new name.
+    Labels which are not in the catalogue (e.g. our own Calendar label) are left untouched."""
+    existing = {label.gmail_label_id: label for label in Label.objects.filter(gmail_label_id__in=gmail_labels.keys())}
+    renamed = []
+    for gmail_label_id, label in existing.items():
+        if label.name != gmail_labels[gmail_label_id]['name']:
+            label.name = gmail_labels[gmail_label_id]['name']
+            label.updated_at = timezone.now()
+            renamed.append(label)
+    Label.objects.bulk_update(renamed, ['name', 'updated_at'])
+    Label.objects.bulk_create([
+        Label(gmail_label_id=gmail_label_id, name=label['name'])
+        for gmail_label_id, label in gmail_labels.items() if gmail_label_id not in existing
+    ], ignore_conflicts=True)
+    return len(gmail_labels) - len(existing), len(renamed)
+
+class IdentityResolver:
+    """Resolve email strings, email addresses and labels to database ids, with a cache in front of the database.
+
+    Usage:
+        resolver = IdentityResolver()
+        resolver.warm()
+        ids = resolver.email_string_ids({"John <john@example.com>"})
+
+    New email strings are linked to an email address and a contact the same way EmailString.save does,
+    and every row created is written back to the cache. The cache is only valid for one sync: call clear()
+    if a transaction that created rows is rolled back.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.email_strings = LRUMap(max_size)    # original string -> EmailString id
+        self.email_addresses = LRUMap(max_size)  # email -> EmailAddress id
+        self.labels = LRUMap(max_size)           # Gmail label id -> Label id
+        self.contacts_by_name = LRUMap(max_size) # normalized name -> tuple of Contact ids
+        self.contact_emails = LRUMap(max_size)   # Contact id -> set of EmailAddress ids
+
+    def warm(self):
+        """Load the most recently used rows of each table, with one query per table"""
+        max_size = self.email_strings.max_size
+        for original_string, email_string_id in reversed(EmailString.objects.order_by('-updated_at').values_list('original_string', 'id')[:max_size]):
+            self.email_strings[original_string] = email_string_id
+        for email, email_address_id in reversed(EmailAddress.objects.order_by('-updated_at').values_list('email', 'id')[:max_size]):
+            self.email_addresses[email] = email_address_id
+        for gmail_label_id, label_id in Label.objects.values_list('gmail_label_id', 'id')[:max_size]:
+            self.labels[gmail_label_id] = label_id
+
+        contact_ids = {}
+        for name, contact_id in reversed(Contact.objects.order_by('-updated_at').values_list('name', 'id')[:max_size]):
+            contact_ids.setdefault(name, []).append(contact_id)
+            self.contact_emails[contact_id] = set()
+        for name, ids in contact_ids.items():
+            self.contacts_by_name[name] = tuple(ids)
+        for contact_id, email_address_id in Contact.emails.through.objects.values_list('contact_id', 'emailaddress_id'):
+            emails = self.contact_emails.data.get(contact_id)
+            if emails is not None:
+                emails.add(email_address_id)
+
+    def clear(self):
+        for lru_map in (self.email_strings, self.email_addresses, self.labels, self.contacts_by_name, self.contact_emails):
+            lru_map.clear()
+
+    @property
+    def stats(self):
+        lru_maps = (self.email_strings, self.email_addresses, self.labels, self.contacts_by_name, self.contact_emails)
+        return {
+            'hits': sum(m.hits for m in lru_maps),
+            'misses': sum(m.misses for m in lru_maps),
+        }
+
+    def email_string_ids(self, original_strings):
+        """Return a dict original string -> EmailString id, creating the missing email strings"""
+        resolved, missing = self._lookup(self.email_strings, original_strings)
+        if missing:
+            for original_string, email_string_id in EmailString.objects.filter(original_string__in=missing).values_list('original_string', 'id'):
+                resolved[original_string] = self.email_strings[original_string] = email_string_id
+            for original_string in missing - resolved.keys():
+                resolved[original_string] = self._create_email_string(original_string)
+        return resolved
+
+    def label_ids(self, gmail_label_ids, fetch_label):
+        """Return a dict Gmail label id -> Label id.
+        Missing labels are created from fetch_label(gmail_label_id), which returns the Gmail label resource"""
+        resolved, missing = self._lookup(self.labels, gmail_label_ids)
+        if missing:
+            for gmail_label_id, label_id in Label.objects.filter(gmail_label_id__in=missing).values_list('gmail_label_id', 'id'):
+                resolved[gmail_label_id] = self.labels[gmail_label_id] = label_id
+            for gmail_label_id in missing - resolved.keys():
+                label = fetch_label(gmail_label_id)
+                resolved[gmail_label_id] = self.labels[gmail_label_id] = Label.objects.get_or_create(
+                    gmail_label_id=label["id"],
+                    defaults={"name": label["name"]},
+                )[0].id
+        return resolved
+
+    def email_address_id(self, email):
+        email_address_id = self.email_addresses.get(email)
+        if email_address_id is None:
+            email_address_id = EmailAddress.objects.get_or_create(email=email)[0].id
+            self.email_addresses[email] = email_address_id
+        return email_address_id
+
+    @staticmethod
+    def _lookup(lru_map, keys):
+        resolved = {}
+        for key in keys:
+            value = lru_map.get(key)
+            if value is not None:
+                resolved[key] = value
+        return resolved, set(keys) - resolved.keys()
+
+    def _create_email_string(self, original_string):
+        name, email = extract_email_and_name(original_string)
+        email_address = EmailAddress(id=self.email_address_id(email), email=email)
+        contact_id = self._find_contact(name, email, email_address.id)
+        if contact_id is None:
+            contact_id = Contact.objects.create(name=name).id
+            self.contacts_by_name[name] = self.contacts_by_name.get(name, ()) + (contact_id,)
+            self.contact_emails[contact_id] = set()
+        emails = self._get_contact_emails(contact_id)
+        if email_address.id not in emails:
+            Contact.emails.through.objects.create(contact_id=contact_id, emailaddress_id=email_address.id)
+            Contact.objects.filter(id=contact_id).update(updated_at=timezone.now())
+            emails.add(email_address.id)
+            contact_index.add_email(contact_id, email)
+
+        # The email address and the contact are set, so EmailString.save does not look them up again
+        email_string = EmailString.objects.create(original_string=original_string, email=email_address, contact_id=contact_id)
+        self.email_strings[original_string] = email_string.id
+        return email_string.id
+
+    def _find_contact(self, name, email, email_address_id):
+        """Same rules as search_similar_contacts: the only contact with this name,
+        or among several of them the only one with this email address, else a similar name"""
+        contact_ids = self.contacts_by_name.get(name)
+        if contact_ids is None:
+            contact_ids = tuple(Contact.objects.filter(name=name).values_list('id', flat=True))
+            self.contacts_by_name[name] = contact_ids
+        if not contact_ids:
+            contact = search_similar_contacts(name, email)
+            return contact.id if contact else None
+        if len(contact_ids) == 1:
+            return contact_ids[0]
+        with_email = [contact_id for contact_id in contact_ids if email_address_id in self._get_contact_emails(contact_id)]
+        return with_email[0] if len(with_email) == 1 else None
+
+    def _get_contact_emails(self, contact_id):
+        emails = self.contact_emails.get(contact_id)
+        if emails is None:
+            emails = set(Contact.emails.through.objects.filter(contact_id=contact_id).values_list('emailaddress_id', flat=True))
+            self.contact_emails[contact_id] = emails
+        return emails
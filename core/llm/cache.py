@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+This module caches the thread summaries, so a thread whose conversation and participant knowledge
+have not changed is not summarized again by the LLM.
+
+The key of a summary is a hash of the rendered prompt (conversation and knowledge), of the model and
+of PROMPT_SUMMARY_VERSION. It is stored in ThreadSummary.prompt_hash, so the cache is the
+ThreadSummary table itself. As a summary updates the knowledge of the participants, which is part of
+the prompt, it is stored under the key of the prompt rendered with the updated knowledge:
+the prompt the next run on the same thread renders.
+"""
+import hashlib
+import threading
+from django.apps import apps
+from core.llm.prompts import PROMPT_SUMMARY, PROMPT_SUMMARY_VERSION
+
+class SummaryCache:
+    """Look up and store thread summaries by prompt hash. It can be shared between threads.
+
+    stats counts the hits, the misses, and the summaries made again because of force_refresh.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'refreshed': 0}
+
+    @staticmethod
+    def key(prompt_input, prompt_template=PROMPT_SUMMARY):
+        """Return the key of the summary prompt rendered with prompt_input (conversation and participants)"""
+        from core.utils.llm import SUMMARY_MODEL
+        digest = hashlib.blake2b(f"{SUMMARY_MODEL}:{PROMPT_SUMMARY_VERSION}\0".encode('utf-8'), digest_size=32)
+        digest.update(prompt_template.format(**prompt_input).encode('utf-8'))
+        return digest.hexdigest()
+
+    def lookup(self, key, thread):
+        """Return the ThreadSummary of thread cached for key, or None.
+        A summary cached for another thread with the same conversation and knowledge is copied to thread."""
+        ThreadSummary = apps.get_model('core', 'ThreadSummary')
+        cached = ThreadSummary.objects.filter(prompt_hash=key).order_by('-id').first()
+        self.count('misses' if cached is None else 'hits')
+        if cached is not None and cached.thread_id != thread.id:
+            cached = ThreadSummary.objects.create(
+                thread=thread,
+                # Kept up to date by EmailBatchWriter, unlike the order of the ids
+                email=thread.last_email or thread.email_set.order_by('date', 'id').last(),
+                summary=cached.summary,
+                action=cached.action,
+                rationale=cached.rationale,
+                participants=cached.participants,
+                incremental_count=cached.incremental_count,
+                prompt_hash=key,
+            )
+        return cached
+
+    def store(self, thread_summary_id, key):
+        """Cache a ThreadSummary for the prompt of key"""
+        ThreadSummary = apps.get_model('core', 'ThreadSummary')
+        ThreadSummary.objects.filter(id=thread_summary_id).update(prompt_hash=key)
+
+    def count(self, event):
+        with self.lock:
+            self.stats[event] += 1
+
+    def report(self):
+        """Return the stats as a line of text, e.g. for the end of a command"""
+        lookups = self.stats['hits'] + self.stats['misses']
+        hit_rate = f"{self.stats['hits'] * 100 / lookups:.0f}%" if lookups else "n/a"
+        return (f"Summary cache: {self.stats['hits']} hits, {self.stats['misses']} misses ({hit_rate} hit rate), "
+                f"{self.stats['refreshed']} forced refreshes")
+
+def summary_data(thread_summary):
+    """Return a ThreadSummary as the summary data returned by the LLM"""
+    return {
+        "summary": thread_summary.summary,
+        "action": thread_summary.action,
+        "rationale": thread_summary.rationale,
+        "participants": thread_summary.participants or [],
+    }
+
+# Cache used by summarize_thread_node
+summary_cache = SummaryCache()
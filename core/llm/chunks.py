@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+This module measures the conversation of a thread in tokens and splits it in chunks fitting a token
+budget, for the map-reduce summaries of the threads too long for one prompt (see summarize_thread_node).
+The tokens are estimated from the number of characters: the tokenizer of the model is not available
+without calling Ollama, and the budget only needs to be respected roughly.
+"""
+
+# Average number of characters of a token of gemma3 for English and French emails
+CHARS_PER_TOKEN = 4
+
+def estimate_tokens(text):
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+def _split_text(text, max_chars):
+    """Split text in pieces of at most max_chars characters, at a line break or a space when possible"""
+    pieces = []
+    while len(text) > max_chars:
+        cut = text.rfind('\n', 0, max_chars)
+        if cut < max_chars // 2:
+            cut = text.rfind(' ', 0, max_chars)
+        if cut < max_chars // 2:
+            cut = max_chars
+        pieces.append(text[:cut])
+        text = text[cut:].lstrip()
+    if text:
+        pieces.append(text)
+    return pieces
+
+def split_messages(messages, max_tokens):
+    """Group consecutive messages in chunks of at most max_tokens (estimated) tokens, keeping their order.
+    A message longer than max_tokens is split in several chunks."""
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    chunks = []
+    current, current_size = [], 0
+    for message in messages:
+        for piece in _split_text(message, max_chars):
+            # + 1 for the line break joining the messages of a chunk
+            if current and current_size + len(piece) + 1 > max_chars:
+                chunks.append("\n".join(current))
+                current, current_size = [], 0
+            current.append(piece)
+            current_size += len(piece) + 1
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+This module compacts the summary prompt before it is sent to Ollama: on a CPU the prefill time grows with
+the length of the prompt, and most of a long thread is repeated headers, signatures and old knowledge.
+
+- The To, Cc, Labels and Subject of an email are only written when they differ from the previous email,
+  and long recipient lists are abbreviated.
+- Signatures and legal footers are removed from the bodies.
+- The knowledge of each participant is cut to SUMMARY_KNOWLEDGE_TOKENS, keeping the facts sharing the
+  most words with the conversation. The facts left out of the prompt are returned, so that
+  they are added back to the knowledge rewritten by the LLM, which has not seen them.
+"""
+import re
+import threading
+from core.llm.chunks import estimate_tokens
+from core.llm.prompts import COMPACT_CONVERSATION_NOTE, COMPACT_EMAIL_TEMPLATE
+
+# Recipients written before "and N others"
+MAX_RECIPIENTS = 4
+
+DATE_FORMAT = "%Y-%m-%d %H:%M"
+
+# Start of the signature or of the legal footer of a body: the standard "-- " delimiter,
+# the mobile signatures, and the usual first words of a disclaimer (English and French)
+FOOTER_PATTERN = re.compile(
+    r"^-- ?$"
+    r"|^(?:Sent from my|Sent from Outlook|Get Outlook for|Envoyé de mon|Envoyé depuis)\b"
+    r"|^(?:Confidentiality notice|Disclaimer|Legal notice|Avertissement)\b"
+    r"|^This (?:e-?mail|message|communication)\b.{0,80}\b(?:confidential|privileged|intended (?:solely |only )?for)"
+    r"|^Ce (?:message|courriel|mail)\b.{0,80}\b(?:confidentiel|destinés? exclusivement)",
+    re.MULTILINE | re.IGNORECASE
+)
+
+# "Re: ", "TR: ", "Fwd: "... ignored when comparing the subjects
+SUBJECT_PREFIX = re.compile(r"^(?:\s*(?:re|fw|fwd|tr)\s*:\s*)+", re.IGNORECASE)
+
+# Sentences, lines or items of a knowledge text
+FACT_SEPARATOR = re.compile(r"(?<=[.!?;])\s+|\n+")
+WORD = re.compile(r"\w{4,}")
+
+def strip_footer(body):
+    """Return the body without its signature or legal footer. A body which would be left empty is kept whole"""
+    match = FOOTER_PATTERN.search(body)
+    if match is None or not body[:match.start()].strip():
+        return body.strip()
+    return body[:match.start()].strip()
+
+def abbreviate_recipients(recipients):
+    if len(recipients) <= MAX_RECIPIENTS:
+        return ", ".join(recipients)
+    return ", ".join(recipients[:MAX_RECIPIENTS]) + f" and {len(recipients) - MAX_RECIPIENTS} others"
+
+def compact_messages(emails):
+    """Format the emails (the values of EMAIL_TEMPLATE, see extract_thread_node) with COMPACT_EMAIL_TEMPLATE,
+    writing the headers which did not change since the previous email only once"""
+    messages = []
+    previous = {}
+    for values in emails:
+        headers = {
+            "To": abbreviate_recipients(values["to_list"]),
+            "Cc": abbreviate_recipients(values["cc_list"]),
+            "Labels": values["labels"],
+            "Subject": values["subject"],
+        }
+        lines = [f"From: {values['sender']}", f"Date: {values['date'].strftime(DATE_FORMAT)}"]
+        for name, value in headers.items():
+            compared = SUBJECT_PREFIX.sub("", value) if name == "Subject" else value
+            if value and compared != previous.get(name):
+                lines.append(f"{name}: {value}")
+            previous[name] = compared
+        messages.append(COMPACT_EMAIL_TEMPLATE.format(headers="\n".join(lines), content=strip_footer(values["content"])))
+    return messages
+
+def trim_knowledge(knowledge, context_words, max_tokens):
+    """Cut a knowledge text to max_tokens, keeping the facts (sentences or lines) sharing the most words
+    with the conversation, in their original order. Returns the kept text and the list of dropped facts"""
+    if not knowledge or estimate_tokens(knowledge) <= max_tokens:
+        return knowledge, []
+    facts = [fact.strip() for fact in FACT_SEPARATOR.split(knowledge) if fact.strip()]
+    # The most relevant first, the earliest first among the equally relevant ones
+    ranked = sorted(range(len(facts)), key=lambda i: (-len(set(WORD.findall(facts[i].lower())) & context_words), i))
+    kept, size = set(), 0
+    for i in ranked:
+        if size + estimate_tokens(facts[i]) + 1 <= max_tokens:
+            kept.add(i)
+            size += estimate_tokens(facts[i]) + 1
+    return " ".join(facts[i] for i in sorted(kept)), [facts[i] for i in range(len(facts)) if i not in kept]
+
+def compact_prompt(emails, participant_set, knowledge_tokens, updated_knowledge=None):
+    """Return the compacted conversation, its messages, the compacted knowledge of the participants,
+    and the facts left out of the knowledge as a dict contact id -> list of facts.
+    The knowledge of the updated_knowledge dict (contact id -> text) is used instead of the one of the contacts"""
+    messages = compact_messages(emails)
+    conversation = COMPACT_CONVERSATION_NOTE + "\n".join(messages)
+    context_words = set(WORD.findall(conversation.lower()))
+    knowledge, dropped = {}, {}
+    for contact in participant_set.contacts:
+        contact_knowledge = (updated_knowledge or {}).get(contact.id, contact.knowledge)
+        knowledge[contact.id], facts = trim_knowledge(contact_knowledge, context_words, knowledge_tokens)
+        if facts:
+            dropped[contact.id] = facts
+    return conversation, messages, participant_set.format(knowledge), dropped
+
+def _fact_key(fact):
+    """The words of a fact, to compare facts whatever their case, spacing and punctuation"""
+    return " ".join(re.findall(r"\w+", fact.lower()))
+
+def restore_knowledge(updated_knowledge, dropped_facts):
+    """Add the facts left out of the prompt back to the knowledge updated by the LLM.
+    A fact the knowledge already has, even written differently, is not added again"""
+    if not dropped_facts:
+        return updated_knowledge
+    known = {_fact_key(fact) for fact in FACT_SEPARATOR.split(updated_knowledge or "")}
+    missing = []
+    for fact in dropped_facts:
+        if _fact_key(fact) not in known:
+            known.add(_fact_key(fact))
+            missing.append(fact)
+    if not missing:
+        return updated_knowledge
+    if not updated_knowledge:
+        return " ".join(missing)
+    # The facts must stay separated to be found again by the next run
+    separator = " " if updated_knowledge.rstrip()[-1] in ".!?;" else "\n"
+    return updated_knowledge.rstrip() + separator + " ".join(missing)
+
+class CompactionStats:
+    """Tokens of the summary prompts before and after compaction. It can be shared between threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.prompts = 0
+        self.tokens_before = 0
+        self.tokens_after = 0
+
+    def record(self, tokens_before, tokens_after):
+        with self.lock:
+            self.prompts += 1
+            self.tokens_before += tokens_before
+            self.tokens_after += tokens_after
+
+    def report(self):
+        """Return the stats as a line of text, e.g. for the end of a command"""
+        saved = self.tokens_before - self.tokens_after
+        ratio = f"{saved * 100 / self.tokens_before:.0f}%" if self.tokens_before else "n/a"
+        return f"Prompt compaction: {self.prompts} prompts, {saved} tokens saved ({ratio})"
+
+# Stats of compact_prompt_node
+compaction_stats = CompactionStats()
@@ -2,41 +2,68 @@
 """
 This module provides the main LangGraph helper class for email processing.
 It defines the graph structure and provides access to the compiled graph.
+
+The graph is also available as an async graph, run with ainvoke: it awaits the LLM with the async
+Ollama client and runs the database access off the event loop, so one event loop (an ASGI view,
+the --async worker) can keep many summaries in progress.
 """
 from langgraph.graph import StateGraph, START, END
 from core.llm.types import EmailThreadState
 from core.llm.nodes import (
     extract_thread_node,
     gather_knowledge_node,
+    compact_prompt_node,
+    count_tokens_node,
     summarize_thread_node,
-    update_knowledge_node
+    asummarize_thread_node,
+    update_knowledge_node,
+    off_event_loop
 )
 
-def build_graph():
-    """Build and compile the LangGraph for email processing"""
+def _build(summarize_node, wrap=lambda node: node):
     builder = StateGraph(EmailThreadState)
     
     # Add nodes - each representing a step in the email processing pipeline
-    builder.add_node("extract_thread", extract_thread_node)
-    builder.add_node("gather_knowledge", gather_knowledge_node)
-    builder.add_node("summarize_thread", summarize_thread_node)
-    builder.add_node("update_knowledge", update_knowledge_node)
+    builder.add_node("extract_thread", wrap(extract_thread_node))
+    builder.add_node("gather_knowledge", wrap(gather_knowledge_node))
+    builder.add_node("compact_prompt", wrap(compact_prompt_node))
+    builder.add_node("count_tokens", count_tokens_node)
+    builder.add_node("summarize_thread", summarize_node)
+    builder.add_node("update_knowledge", wrap(update_knowledge_node))
     
     # Define the flow of the graph
     builder.add_edge(START, "extract_thread")
     builder.add_edge("extract_thread", "gather_knowledge")
-    builder.add_edge("gather_knowledge", "summarize_thread")
+    builder.add_edge("gather_knowledge", "compact_prompt")
+    builder.add_edge("compact_prompt", "count_tokens")
+    builder.add_edge("count_tokens", "summarize_thread")
     builder.add_edge("summarize_thread", "update_knowledge")
     builder.add_edge("update_knowledge", END)
     
     return builder.compile()
 
+def build_graph():
+    """Build and compile the LangGraph for email processing"""
+    return _build(summarize_thread_node)
+
+def build_async_graph():
+    """Build and compile the LangGraph for email processing, to be run with ainvoke"""
+    return _build(asummarize_thread_node, wrap=off_event_loop)
+
 # Use lazy loading pattern instead of immediate instantiation
 _langgraph_helper = None
+_async_langgraph_helper = None
 
 def get_langgraph_helper():
     """Get or create the langgraph helper instance"""
     global _langgraph_helper
     if _langgraph_helper is None:
         _langgraph_helper = build_graph()
-    return _langgraph_helper 
\ No newline at end of file
+    return _langgraph_helper
+
+def get_async_langgraph_helper():
+    """Get or create the async langgraph helper instance"""
+    global _async_langgraph_helper
+    if _async_langgraph_helper is None:
+        _async_langgraph_helper = build_async_graph()
+    return _async_langgraph_helper
@@ -4,51 +4,126 @@ This module contains LangGraph node functions for the email processing system.
 Each function represents a step in the LangGraph processing pipeline.
 """
 import json
+import logging
 import sys
 from string import Template
 from langchain.prompts import PromptTemplate
 from core.llm.types import ParticipantSet
-from core.llm.prompts import PROMPT_PARTICIPANT_KNOWLEDGE, EMAIL_TEMPLATE, HEADER_TEMPLATE, PROMPT_SUMMARY
+from core.llm.cache import summary_cache, summary_data as cached_summary_data
+from core.llm.chunks import estimate_tokens, split_messages
+from core.llm.compaction import compact_prompt, compaction_stats, restore_knowledge
+from core.llm.prompts import PROMPT_PARTICIPANT_KNOWLEDGE, EMAIL_TEMPLATE, HEADER_TEMPLATE, PROMPT_SUMMARY, PROMPT_INCREMENTAL_SUMMARY
+from core.llm.prompts import PROMPT_CHUNK_SUMMARY, PARTIAL_SUMMARIES_TEMPLATE
 # Import models lazily to prevent AppRegistryNotReady errors
+from asgiref.sync import sync_to_async
 from django.apps import apps
+from django.conf import settings
+from django.db.models import Q
+
+logger = logging.getLogger(__name__)
 
 def get_thread_summary_model():
     """Get the ThreadSummary model lazily"""
     return apps.get_model('core', 'ThreadSummary')
 
+# A full summary of the thread is made again after this many incremental ones,
+# so that the errors of the successive summaries do not accumulate
+FULL_SUMMARY_EVERY = 5
+
 def get_llm_utils():
     """Get LLM utilities lazily to avoid circular imports"""
-    from core.utils import sanitize_json, llm, summary_chain, log_llm_prompt
-    return sanitize_json, llm, summary_chain, log_llm_prompt
+    from core.utils import sanitize_json, llm, summary_chain, incremental_summary_chain, log_llm_prompt
+    return sanitize_json, llm, summary_chain, incremental_summary_chain, log_llm_prompt
+
+def get_chunk_summary_chain():
+    """Get the chain summarizing a chunk of a long conversation, lazily like get_llm_utils"""
+    from core.utils import chunk_summary_chain
+    return chunk_summary_chain
+
+def _previous_summary(thread):
+    """Return the latest summary of the thread and the emails received since, or (None, None) when a full summary is due:
+    the thread has no summary, no email was received since it, or it ends a series of FULL_SUMMARY_EVERY incremental summaries"""
+    ThreadSummary = get_thread_summary_model()
+    previous = ThreadSummary.objects.filter(thread=thread).select_related('email').order_by('-id').first()
+    if previous is None or previous.incremental_count + 1 >= FULL_SUMMARY_EVERY:
+        return None, None
+    last_date = previous.email.date
+    new_emails = list(thread.email_set.filter(
+        Q(date__gt=last_date) | Q(date=last_date, id__gt=previous.email_id)
+    ).order_by('date', 'id'))
+    if not new_emails:
+        return None, None
+    return previous, new_emails
 
 def extract_thread_node(state):
-    """Extract thread information and format messages"""
+    """Extract thread information and format messages.
+    When the thread already has a summary, only the emails received since are formatted, and
+    summarize_thread_node updates the previous summary with them (unless force_refresh)."""
     thread = state["thread"]
     messages = []
     message_headers = []
-    
-    for email in thread.email_set.all():
+    values_list = []
+    thread_emails = []
+
+    previous, emails = (None, None) if state.get("force_refresh") else _previous_summary(thread)
+    new_ids = None if emails is None else {email.id for email in emails}
+    all_emails = list(thread.email_set.select_related('sender_str').prefetch_related('to_str', 'cc_str', 'labels').order_by('date', 'id'))
+    if emails is None:
+        emails = all_emails
+
+    # Every email is formatted: the next run on the thread renders the whole conversation (see _next_prompt_hash)
+    for email in all_emails:
         # Common data to extract
+        to_list = [t.original_string for t in email.to_str.all()]
+        cc_list = [t.original_string for t in email.cc_str.all()]
         values = {
             "sender": email.sender_str.original_string,
-            "to_recipients": ", ".join([t.original_string for t in email.to_str.all()]),
-            "cc_recipients": ", ".join([t.original_string for t in email.cc_str.all()]),
+            "to_recipients": ", ".join(to_list),
+            "cc_recipients": ", ".join(cc_list),
+            "to_list": to_list,
+            "cc_list": cc_list,
             "date": email.date,
             "labels": " ".join([l.name for l in email.labels.all()]),
             "subject": email.subject,
             "content": email.truncated_body,
             "snippet": email.snippet,
         }
+        thread_emails.append(values)
+        if new_ids is not None and email.id not in new_ids:
+            continue
 
         message = EMAIL_TEMPLATE.format(**values)
         header = HEADER_TEMPLATE.format(**values)
         messages.append(message)
         message_headers.append(header)
+        values_list.append(values)
         
     return {
+        **state,
         "conversation": "\n".join(messages), 
         "message_headers": "\n".join(message_headers),
-        **state
+        "previous_summary": previous,
+        "last_email": emails[-1] if emails else None,
+        "emails": values_list,
+        "thread_emails": thread_emails,
+        "messages": messages,
+    }
+
+def summary_prompt(state):
+    """Return the template and the input of the summary prompt: the whole conversation,
+    or the previous summary and the messages received since (see extract_thread_node)"""
+    prompt_input = {
+        "conversation": state["conversation"],
+        "participants": state["knowledge"],
+    }
+    previous = state.get("previous_summary")
+    if previous is None:
+        return PROMPT_SUMMARY, prompt_input
+    return PROMPT_INCREMENTAL_SUMMARY, {
+        **prompt_input,
+        "previous_summary": previous.summary,
+        "previous_action": previous.action,
+        "previous_rationale": previous.rationale,
     }
 
 def gather_knowledge_node(state):
@@ -65,26 +140,106 @@ def gather_knowledge_node(state):
         "participant_set": participant_set
     }
 
-def summarize_thread_node(state):
-    """Generate summary for the thread"""
-    sanitize_json, llm, summary_chain, log_llm_prompt = get_llm_utils()
-    
-    prompt_input = {
-        "conversation": state["conversation"],
-        "participants": state["knowledge"],
-    }
+def _compact(state):
+    conversation, messages, knowledge, dropped = compact_prompt(
+        state["emails"], state["participant_set"], settings.SUMMARY_KNOWLEDGE_TOKENS
+    )
+    return {**state, "conversation": conversation, "messages": messages, "knowledge": knowledge, "dropped_knowledge": dropped}
+
+def _next_prompt_hash(state, knowledge_updates):
+    """Return the key of the prompt the next run on the thread renders if nothing changes: the full summary
+    prompt of the whole conversation, with the knowledge updated by this summary"""
+    conversation, messages, knowledge, dropped = compact_prompt(
+        state["thread_emails"], state["participant_set"], settings.SUMMARY_KNOWLEDGE_TOKENS,
+        updated_knowledge={contact.id: contact_knowledge for contact, contact_knowledge in knowledge_updates.items()}
+    )
+    prompt_template, prompt_input = summary_prompt({"conversation": conversation, "knowledge": knowledge})
+    return summary_cache.key(prompt_input, prompt_template)
+
+def compact_prompt_node(state):
+    """Compact the conversation and the knowledge of the summary prompt (see core/llm/compaction.py),
+    and report the tokens saved"""
+    compacted = _compact(state)
+    before = estimate_tokens(state["conversation"]) + estimate_tokens(state["knowledge"])
+    after = estimate_tokens(compacted["conversation"]) + estimate_tokens(compacted["knowledge"])
+    compaction_stats.record(before, after)
+    logger.info(f"Summary prompt of thread {state['thread'].id} compacted from {before} to {after} tokens ({before - after} saved)")
+    return {**compacted, "compaction": {"before": before, "after": after}}
+
+def count_tokens_node(state):
+    """Estimate the size of the conversation, and split it in chunks when it goes over the token budget"""
+    conversation_tokens = estimate_tokens(state["conversation"])
+    chunks = []
+    if conversation_tokens > settings.SUMMARY_TOKEN_BUDGET:
+        chunks = split_messages(state.get("messages") or [state["conversation"]], settings.SUMMARY_CHUNK_TOKENS)
+    return {**state, "conversation_tokens": conversation_tokens, "chunks": chunks}
+
+def _chunk_prompts(chunks, log_llm_prompt):
+    for chunk in chunks:
+        log_llm_prompt(prompt_name="thread_summary_chunk", prompt_input={"conversation": chunk}, prompt_template=PROMPT_CHUNK_SUMMARY)
+    return [{"conversation": chunk} for chunk in chunks]
+
+def _reduce_chunks(chunks, partial_summaries):
+    """Return the text combining the partial summaries, and the chunks to summarize again (None when done)"""
+    text = PARTIAL_SUMMARIES_TEMPLATE.format(partial_summaries="\n\n".join(
+        f"Part {i}:\n{summary.strip()}" for i, summary in enumerate(partial_summaries, 1)
+    ))
+    next_chunks = split_messages(partial_summaries, settings.SUMMARY_CHUNK_TOKENS)
+    # Stop when the summaries fit, or when they can not be grouped any further
+    if estimate_tokens(text) <= settings.SUMMARY_TOKEN_BUDGET or len(next_chunks) >= len(chunks):
+        return text, None
+    return text, next_chunks
+
+def summarize_chunks(chunks, chunk_summary_chain, log_llm_prompt):
+    """Summarize the chunks of a conversation, SUMMARY_MAP_CONCURRENCY at a time, and return the text
+    replacing the conversation in the summary prompt. While the partial summaries are still over the
+    token budget, they are summarized again by chunks."""
+    while chunks:
+        partial_summaries = chunk_summary_chain.batch(
+            _chunk_prompts(chunks, log_llm_prompt),
+            config={"max_concurrency": settings.SUMMARY_MAP_CONCURRENCY}
+        )
+        text, chunks = _reduce_chunks(chunks, partial_summaries)
+    return text
+
+async def asummarize_chunks(chunks, chunk_summary_chain, log_llm_prompt):
+    """Same as summarize_chunks, with the async Ollama client"""
+    while chunks:
+        partial_summaries = await chunk_summary_chain.abatch(
+            _chunk_prompts(chunks, log_llm_prompt),
+            config={"max_concurrency": settings.SUMMARY_MAP_CONCURRENCY}
+        )
+        text, chunks = _reduce_chunks(chunks, partial_summaries)
+    return text
+
+def _prepare_summary(state):
+    """Return the summary prompt of the state, or the state completed with the cached summary"""
+    prompt_template, prompt_input = summary_prompt(state)
     
+    # The same conversation and knowledge give the same summary, unless a new one is asked for
+    if state.get("force_refresh"):
+        summary_cache.count('refreshed')
+    else:
+        cached = summary_cache.lookup(summary_cache.key(prompt_input, prompt_template), state["thread"])
+        if cached is not None:
+            return None, None, {**state, "thread_summary": cached_summary_data(cached), "thread_summary_id": cached.id, "cached": True}
+    return prompt_template, prompt_input, None
+
+def _log_summary_prompt(state, prompt_template, prompt_input, log_llm_prompt):
     # Log the prompt before invoking
     log_llm_prompt(
-        prompt_name="thread_summary",
+        prompt_name="thread_summary" if state.get("previous_summary") is None else "thread_summary_incremental",
         prompt_input=prompt_input,
-        prompt_template=PROMPT_SUMMARY
+        prompt_template=prompt_template
     )
-    
-    result = summary_chain.invoke(prompt_input)
-    
+
+def _save_summary(state, result, sanitize_json):
+    """Parse the answer of the LLM and save it as a ThreadSummary"""
+    thread = state["thread"]
+    previous = state.get("previous_summary")
     try:
         summary_data = json.loads(sanitize_json(result))
+        cacheable = True
     except json.JSONDecodeError:
         print("ERROR in decoding JSON")
         print(sanitize_json(result))
@@ -94,27 +249,65 @@ def summarize_thread_node(state):
             "participants": [], 
             "rationale": ""
         }
+        # An answer which could not be parsed is not reused
+        cacheable = False
 
     # Create and save thread summary - use lazy loading for model
     ThreadSummary = get_thread_summary_model()
-    thread = state["thread"]
     thread_summary = ThreadSummary.objects.create(
         thread=thread,
-        email=thread.email_set.last(),
+        email=state.get("last_email") or thread.email_set.last(),
         summary=summary_data["summary"],
         action=summary_data["action"],
         rationale=summary_data["rationale"],
-        participants=summary_data["participants"]
+        participants=summary_data["participants"],
+        incremental_count=0 if previous is None else previous.incremental_count + 1
     )  
     thread_summary.save()
+
+    knowledge_updates = _knowledge_updates(state, summary_data["participants"])
+    # Cached for the prompt of the next run, with this summary and the updated knowledge
+    prompt_hash = _next_prompt_hash(state, knowledge_updates) if cacheable else None
+    return {**state, "thread_summary": summary_data, "thread_summary_id": thread_summary.id, "cached": False,
+            "knowledge_updates": knowledge_updates, "prompt_hash": prompt_hash}
+
+def summarize_thread_node(state):
+    """Generate summary for the thread"""
+    sanitize_json, llm, summary_chain, incremental_summary_chain, log_llm_prompt = get_llm_utils()
     
-    return {**state, "thread_summary": summary_data}
+    prompt_template, prompt_input, cached_state = _prepare_summary(state)
+    if cached_state is not None:
+        return cached_state
 
-def update_knowledge_node(state):
-    """Update knowledge about participants based on the summary"""
+    # A conversation over the token budget is summarized by chunks, then the summary prompt combines their summaries
+    if state.get("chunks"):
+        prompt_input = {**prompt_input, "conversation": summarize_chunks(state["chunks"], get_chunk_summary_chain(), log_llm_prompt)}
+
+    _log_summary_prompt(state, prompt_template, prompt_input, log_llm_prompt)
+    result = (summary_chain if state.get("previous_summary") is None else incremental_summary_chain).invoke(prompt_input)
+    return _save_summary(state, result, sanitize_json)
+
+async def asummarize_thread_node(state):
+    """Same as summarize_thread_node for the async graph: the LLM is awaited, the database is accessed
+    off the event loop"""
+    sanitize_json, llm, summary_chain, incremental_summary_chain, log_llm_prompt = get_llm_utils()
+
+    prompt_template, prompt_input, cached_state = await sync_to_async(_prepare_summary)(state)
+    if cached_state is not None:
+        return cached_state
+
+    if state.get("chunks"):
+        prompt_input = {**prompt_input, "conversation": await asummarize_chunks(state["chunks"], get_chunk_summary_chain(), log_llm_prompt)}
+
+    _log_summary_prompt(state, prompt_template, prompt_input, log_llm_prompt)
+    result = await (summary_chain if state.get("previous_summary") is None else incremental_summary_chain).ainvoke(prompt_input)
+    return await sync_to_async(_save_summary)(state, result, sanitize_json)
+
+def _knowledge_updates(state, participants):
+    """Match the participants returned by the LLM with the contacts of the thread.
+    Returns their updated knowledge as a dict contact -> knowledge"""
     thread = state["thread"]
-    participants = state["thread_summary"]["participants"]
-    print(state["thread_summary"])
+    updates = {}
     print(participants)
     thread_participants = thread.participants
     print("participants", thread_participants)
@@ -157,7 +350,32 @@ def update_knowledge_node(state):
             print(f"unable to find a match for {participant}")
             continue
 
-        contact.knowledge = participant.get("updated_knowledge")
+        # The LLM only saw the knowledge kept by the compaction, the facts left out are added back
+        updates[contact] = restore_knowledge(
+            participant.get("updated_knowledge"), (state.get("dropped_knowledge") or {}).get(contact.id, [])
+        )
+
+    return updates
+
+def update_knowledge_node(state):
+    """Update knowledge about participants based on the summary"""
+    # A cached summary has already updated the knowledge
+    if state.get("cached"):
+        return state["thread_summary"]
+    for contact, knowledge in state["knowledge_updates"].items():
+        contact.knowledge = knowledge
         contact.save()
 
+    # The key was computed by summarize_thread_node, with the knowledge saved above
+    if state.get("prompt_hash"):
+        summary_cache.store(state["thread_summary_id"], state["prompt_hash"])
+
     return state["thread_summary"] 
+
+def off_event_loop(node):
+    """Wrap a node of the synchronous graph for the async graph: it accesses the database, so it runs
+    in the thread of sync_to_async instead of blocking the event loop"""
+    async def async_node(state):
+        return await sync_to_async(node)(state)
+    async_node.__name__ = f"a{node.__name__}"
+    return async_node
@@ -4,8 +4,12 @@ This module contains prompts and templates for the LangGraph email processing sy
 These prompts are used by the LLM to generate summaries and extract knowledge.
 """
 
+# Version of the thread summaries: bump it when they change without PROMPT_SUMMARY changing
+# (e.g. how the answer is parsed), so that the summaries cached with the previous version are not reused
+PROMPT_SUMMARY_VERSION = 1
+
 # Define prompts as constants
-PROMPT_SUMMARY = """
+SUMMARY_INSTRUCTIONS = """
 This is not an interactive session. The objective is to
 - assess what to do based on the messages received
 - we also want to maintain general knowledge about participants not specific to these messages, such as the organisation they work for, their position, etc.
@@ -23,13 +27,9 @@ Therefore, your role is to:
   - assess who are the participants in the discussion and what is their role
 - assess whether we have gained additional general knowledge about these participants, that is knowledge that is not specific to the current thread of discussion
 
-Here is what we know so far about the participants:
-{participants}
-
-Here is the conversation:
-{conversation}
+"""
 
-Please return your answer strictly in JSON format using the following schema:
+SUMMARY_ANSWER_FORMAT = """Please return your answer strictly in JSON format using the following schema:
 {{
   "summary": "a short summary of the conversation",
   "rationale": "a short explanation of why you chose this action"
@@ -46,6 +46,44 @@ Please return your answer strictly in JSON format using the following schema:
 }}
 """
 
+PROMPT_SUMMARY = SUMMARY_INSTRUCTIONS + """Here is what we know so far about the participants:
+{participants}
+
+Here is the conversation:
+{conversation}
+
+""" + SUMMARY_ANSWER_FORMAT
+
+# Summary of the messages received since the previous summary, see extract_thread_node
+PROMPT_INCREMENTAL_SUMMARY = SUMMARY_INSTRUCTIONS + """Here is what we know so far about the participants:
+{participants}
+
+The beginning of the conversation was already summarized as:
+Summary: {previous_summary}
+Action: {previous_action}
+Rationale: {previous_rationale}
+
+Here are the messages received since then:
+{conversation}
+
+Update the summary, action and rationale so that they cover the whole conversation, including these messages.
+
+""" + SUMMARY_ANSWER_FORMAT
+
+# Summary of one chunk of a conversation too long for one prompt (the map step, see summarize_thread_node)
+PROMPT_CHUNK_SUMMARY = """
+This is not an interactive session. Here is a part of a long email conversation, in chronological order:
+{conversation}
+
+Summarize this part in at most 150 words: what is asked, proposed, decided or promised, by whom,
+with the dates, amounts and names that matter. Answer with the summary only.
+"""
+
+# Replaces the conversation in the summary prompt once its chunks are summarized (the reduce step)
+PARTIAL_SUMMARIES_TEMPLATE = """These messages are too long to be read at once. Here are the summaries of their successive parts, in chronological order:
+{partial_summaries}
+"""
+
 PROMPT_PARTICIPANT_KNOWLEDGE = """
 In the current thread of discussion, we have the followig message history and summary of discussion:
 Thread subject: {thread_subject}
@@ -86,6 +124,16 @@ Email content: {content}
 <END_OF_EMAIL>
 """
 
+# Email of the compacted conversation, see core/llm/compaction.py
+COMPACT_EMAIL_TEMPLATE = """
+<START_OF_EMAIL>
+{headers}
+Email content: {content}
+<END_OF_EMAIL>
+"""
+
+COMPACT_CONVERSATION_NOTE = "(To, Cc, Labels and Subject are only written when they change from the previous email)\n"
+
 HEADER_TEMPLATE = """
 From: {sender}
 To: {to_recipients}
@@ -16,6 +16,20 @@ class EmailThreadState(TypedDict):
     participants: List[Any]
     knowledge: Any
     participant_set: Any
+    force_refresh: bool     # run the LLM on the whole conversation even if the summary cache has this prompt
+    previous_summary: Any   # ThreadSummary updated with the new messages, None for a full summary
+    last_email: Any
+    emails: List[Dict]      # the values of EMAIL_TEMPLATE for each email of the conversation
+    thread_emails: List[Dict]  # the same for every email of the thread, also when only the new ones are summarized
+    messages: List[str]     # the formatted emails of the conversation
+    dropped_knowledge: Dict[int, List[str]]  # facts left out of the prompt by contact id, see core/llm/compaction.py
+    compaction: Dict[str, int]  # estimated tokens of the conversation and knowledge, before and after compaction
+    conversation_tokens: int
+    chunks: List[str]       # the conversation split for a map-reduce summary, empty if it fits in one prompt
+    thread_summary_id: Any
+    cached: bool            # the summary comes from the summary cache
+    knowledge_updates: Dict[Any, str]  # the knowledge of the contacts updated by the summary, saved by update_knowledge_node
+    prompt_hash: Any        # key of the next run's prompt to cache the summary under, None if the answer could not be parsed
 
 # Helper class for managing participants
 class ParticipantSet:
@@ -31,8 +45,15 @@ class ParticipantSet:
         self.email_str_list[contact.id] = email_strs
 
     def __str__(self):
+        return self.format()
+
+    def format(self, knowledge=None):
+        """Format the participants with KNOWLEDGE_TEMPLATE, using the knowledge of the knowledge dict
+        (contact id -> text) instead of the one of the contacts when given"""
         result = ""
-        for p in self.contacts:
-            r = KNOWLEDGE_TEMPLATE % (p.id, p.name, self.email_str_list[p.id], p.knowledge)
+        # In a stable order, so the same participants give the same prompt (see core/llm/cache.py)
+        for p in sorted(self.contacts, key=lambda contact: contact.id):
+            contact_knowledge = p.knowledge if knowledge is None else knowledge.get(p.id, p.knowledge)
+            r = KNOWLEDGE_TEMPLATE % (p.id, p.name, sorted(self.email_str_list[p.id]), contact_knowledge)
             result += r 
         return result 
\ No newline at end of file
@@ -1,6 +1,6 @@
 from django.core.management.base import BaseCommand
 from core.models import Email, Label
-from core.utils import is_calendar_invite
+from core.utils import classify_calendar_invites
 
 class Command(BaseCommand):
     help = "Process existing emails and add Calendar label where appropriate"
@@ -37,13 +37,18 @@ class Command(BaseCommand):
         while True:
             # Get a batch of emails that don't have the Calendar label
             #emails = Email.objects.exclude(labels=calendar_label).order_by('id')[offset:offset + batch_size]
-            emails = Email.objects.order_by('id')[offset:offset + batch_size]
+            emails = list(Email.objects.select_related('sender_str').order_by('id')[offset:offset + batch_size])
             if not emails:
                 break
 
             self.stdout.write(f"Processing batch of {len(emails)} emails...")
 
-            for email in emails:
+            # Classify the whole batch in one call
+            calendar_flags = classify_calendar_invites(
+                {'subject': email.subject, 'body': email.body} for email in emails
+            )
+
+            for email, calendar in zip(emails, calendar_flags):
 
                 # Debug logging
                 self.stdout.write(f"\nChecking email:")
@@ -52,10 +57,7 @@ class Command(BaseCommand):
                 self.stdout.write(f"From: {email.sender_str.original_string}")
                 
                 # Check if it's a calendar invite
-                if is_calendar_invite(
-                    subject=email.subject,
-                    body=email.body,
-                ):
+                if calendar:
                     email.labels.add(calendar_label)
                     total_updated += 1
                     self.stdout.write(
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from core.models import Email
+from core.utils import remove_quoted_text
+
+class Command(BaseCommand):
+    help = "Compute the stored body without quoted text (Email.stripped_body) of existing emails"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of emails updated in each transaction'
+        )
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Recompute every email, e.g. after a change of remove_quoted_text, not only the ones never computed'
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        emails = Email.objects.all() if options['all'] else Email.objects.filter(stripped_body__isnull=True)
+        total = emails.count()
+        self.stdout.write(f"Processing {total} emails...")
+
+        processed = 0
+        last_id = 0
+        while True:
+            # Paginate on the primary key, the filter may no longer match the emails already updated
+            batch = list(emails.filter(id__gt=last_id).order_by('id').only('id', 'body')[:batch_size])
+            if not batch:
+                break
+            for email in batch:
+                email.stripped_body = remove_quoted_text(email.body)
+            with transaction.atomic():
+                Email.objects.bulk_update(batch, ['stripped_body'])
+            processed += len(batch)
+            last_id = batch[-1].id
+            self.stdout.write(f"Updated {processed}/{total} emails")
+
+        self.stdout.write(self.style.SUCCESS(f"Successfully processed {processed} emails."))
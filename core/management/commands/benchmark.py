@@ -0,0 +1,23 @@
+from importlib import import_module
+from django.core.management.base import BaseCommand, CommandError
+
+class Command(BaseCommand):
+    help = "Run one of the offline benchmarks from core.benchmarks"
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', help='Name of the benchmark module, e.g. gmail_fetch')
+        parser.add_argument(
+            '--size',
+            type=int,
+            default=None,
+            help="Size of the generated data set (defaults to the benchmark's own default)"
+        )
+
+    def handle(self, *args, **options):
+        try:
+            benchmark = import_module(f"core.benchmarks.{options['name']}")
+        except ModuleNotFoundError:
+            raise CommandError(f"Unknown benchmark {options['name']}")
+
+        size = options['size'] or benchmark.DEFAULT_SIZE
+        benchmark.run(self.stdout, size)
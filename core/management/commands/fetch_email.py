@@ -1,16 +1,39 @@
 # we will add a command to django manage.py to fetch emails from the gmail api
 from django.core.management.base import BaseCommand
 from core.models import SystemParameter, Thread, Email, Label, Contact, EmailAddress, EmailString
-from core.gmail_helper import gmail_helper
-from core.utils import is_calendar_invite
+from core.gmail_helper import get_gmail_helper, HistoryExpiredError, DEFAULT_FETCH_WORKERS
+from core.email_writer import EmailBatchWriter
+from core.identity_resolver import IdentityResolver, reconcile_labels
+from core.message_archive import MessageArchive
+from django.conf import settings
+from googleapiclient.errors import HttpError
+from core.utils import is_calendar_invite, split_addresses
+from core.utils.mime import conversion_cache
 from datetime import datetime, timedelta
 from pytz import timezone
+import json
 import re
+import time
 import unicodedata
 
+# Number of days fetched again when the Gmail history id has expired
+RESYNC_DAYS = 7
+
+def _get_label(gmail_label_id):
+    """ Return the Label object for a Gmail label id, creating it if needed"""
+    label = get_gmail_helper().fetch_label(gmail_label_id)
+    label_obj, created = Label.objects.get_or_create(
+        gmail_label_id=label["id"],
+        defaults={
+            "name": label["name"],
+        }
+    )
+    return label_obj
+
 def _process_email(message, thread):
     """ This method will process one email
     parameters: message - a message returned from Gmail, thread: the Django thread object
+    It is only used with --no-bulk, EmailBatchWriter does the same for a whole chunk of emails
     It assumes the thread already exists
     It will check the labels and create them if they don't exist
     It will save the email to the database
@@ -46,42 +69,34 @@ def _process_email(message, thread):
     )
 
     # Process to and from fields
-    for receiver in to_str.split(","):
-        if not receiver.strip():
-            continue
+    for receiver in split_addresses(to_str):
         receiver_str_obj, created = EmailString.objects.get_or_create(
-            original_string=receiver.strip(),
+            original_string=receiver,
         )
         email_obj.to_str.add(receiver_str_obj)
 
-    for receiver in cc_str.split(","):
-        if not receiver.strip():
-            continue
+    for receiver in split_addresses(cc_str):
         receiver_str_obj, created = EmailString.objects.get_or_create(
-            original_string=receiver.strip(),
+            original_string=receiver,
         )
         email_obj.cc_str.add(receiver_str_obj)
 
-    thread.last_email = email_obj
-    thread.save()
+    # Emails are not always processed in chronological order
+    if thread.last_email is None or thread.last_email.date <= email_obj.date:
+        thread.last_email = email_obj
+        thread.save()
 
     # Process labels
     labels = message.get("labelIds", [])
     for gmail_label_id in labels:
-        label = gmail_helper.fetch_label(gmail_label_id)
-        label_obj, created = Label.objects.get_or_create(
-            gmail_label_id=label["id"],
-            defaults={
-                "name": label["name"],
-            }
-        )
-        email_obj.labels.add(label_obj)
+        email_obj.labels.add(_get_label(gmail_label_id))
 
     # Check if this is a calendar invite and add the Calendar label if needed
     if is_calendar_invite(
         subject=message['Subject'],
         body=message['Body'],
-        headers=message.get('payload', {}).get('headers', [])
+        headers=message.get('payload', {}).get('headers', []),
+        payload=message.get('payload'),
     ):
         calendar_label, created = Label.objects.get_or_create(
             name="Calendar",
@@ -97,52 +112,269 @@ def _process_email(message, thread):
 class Command(BaseCommand):
     help = "Fetch emails from Gmail and store them in the database"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--no-batch',
+            action='store_true',
+            help='Fetch emails one request at a time instead of using Gmail batch requests'
+        )
+        parser.add_argument(
+            '--no-bulk',
+            action='store_true',
+            help='Store emails one at a time instead of by chunks in a single transaction'
+        )
+        parser.add_argument(
+            '--no-archive',
+            action='store_true',
+            help='Do not keep the raw Gmail messages in the archive used by reparse_emails'
+        )
+        parser.add_argument(
+            '--mode',
+            choices=['history', 'query'],
+            default='history',
+            help='history: pull changes since the last Gmail history id. query: search emails received after the last sync time'
+        )
+        parser.add_argument(
+            '--resync-days',
+            type=int,
+            default=RESYNC_DAYS,
+            help='Number of days fetched again when the last history id has expired'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=DEFAULT_FETCH_WORKERS,
+            help='Number of new threads fetched from Gmail in parallel'
+        )
+
     def handle(self, *args, **options):
         """This will fetch emails from Gmail since the last sync
         For each email, it will check that:
             - labels already exist in the database. If not it will create them
             - thread already exist in the database. If not it will create them; and it will fetch all emails from that thread
             """
+        self.gmail_helper = get_gmail_helper()
+        self.batch = not options['no_batch']
+        self.workers = options['workers']
+
+        # One labels().list call per run, then fetch_label only calls Gmail again for label ids it does not know
+        created_count, renamed_count = reconcile_labels(self.gmail_helper.fetch_labels())
+        print(f"Label catalogue: {created_count} labels created, {renamed_count} renamed")
+
+        self.writer = None
+        if not options['no_bulk']:
+            resolver = IdentityResolver()
+            resolver.warm()
+            self.writer = EmailBatchWriter(self.gmail_helper, resolver=resolver)
+        # The raw messages are archived so that reparse_emails can parse them again without Gmail
+        self.archive = None if options['no_archive'] else MessageArchive(settings.MESSAGE_ARCHIVE_DIR)
+        # Repeated HTML templates (newsletters, notifications) are only converted to text once
+        if settings.HTML_CONVERSION_CACHE_FILE:
+            conversion_cache.open_file(settings.HTML_CONVERSION_CACHE_FILE)
+        self.processed_count = 0
+        start_time = time.perf_counter()
+
         # we retrieve the last sync time. If it does not exists then it default to now - 2 hours
-        last_sync_obj, created = SystemParameter.objects.get_or_create(
+        self.last_sync_obj, created = SystemParameter.objects.get_or_create(
                 key="last_sync_time",
                 defaults= {
                     "value" : int(datetime.now().timestamp()) - 3600*24, #2 hours
                     }
                 ) # type: ignore[attr-defined]
+
+        try:
+            if options['mode'] == 'query':
+                self._sync_since(int(self.last_sync_obj.value))
+            else:
+                self._sync_history(options['resync_days'])
+        finally:
+            if self.archive:
+                self.archive.close()
+            conversion_cache.close()
+
+        elapsed = time.perf_counter() - start_time
+        print(f"Processed {self.processed_count} emails in {elapsed:.1f}s ({self.processed_count / elapsed:.1f} emails/s)")
+        stats = self.gmail_helper.scheduler.stats
+        print(f"Gmail API: {stats['calls']} calls, {stats['units']} quota units, {stats['throttled']} throttled, "
+              f"{stats['rate_limited']} rate limited, {stats['retried']} retried")
+        if self.writer:
+            print(f"Stored {self.writer.written_count} emails")
+            stats = self.writer.resolver.stats
+            print(f"Identity cache: {stats['hits']} hits, {stats['misses']} misses")
+        stats = conversion_cache.stats
+        print(f"HTML conversion cache: {stats['hits'] + stats['file_hits']} hits ({stats['file_hits']} from file), {stats['misses']} misses")
+
+    def _sync_history(self, resync_days):
+        """Process the changes recorded by Gmail since the last history id.
+        The first run, or a run where the history id has expired, falls back to a search of the emails
+        received in the last resync_days days (or since the last sync time if more recent)"""
+        last_history_obj = SystemParameter.objects.filter(key="last_history_id").first()
+        # We read the current history id before listing anything so that changes happening during the sync are not lost
+        current_history_id = self.gmail_helper.get_history_id()
+
+        try:
+            if last_history_obj is None:
+                raise HistoryExpiredError("No history id stored yet")
+            print(f"Last history id: {last_history_obj.value}")
+            history_id, added_messages, label_changes = self.gmail_helper.fetch_history(last_history_obj.value)
+        except HistoryExpiredError as e:
+            print(f"{e}, doing a full sync of the last {resync_days} days")
+            resync_since = int(datetime.now().timestamp()) - resync_days * 3600*24
+            self._sync_since(max(resync_since, int(self.last_sync_obj.value)))
+            history_id = current_history_id
+        else:
+            print(f"Fetched {len(added_messages)} new emails and {len(label_changes)} label changes since history id {last_history_obj.value}")
+            fetched_ids, max_timestamp = self._process_email_records(added_messages)
+            self._update_last_sync_time(max_timestamp)
+            self._apply_label_changes(label_changes, skip_ids=fetched_ids)
+
+        SystemParameter.objects.update_or_create(key="last_history_id", defaults={"value": history_id})
+
+    def _sync_since(self, timestamp):
+        """Process the emails received after timestamp, one page of the Gmail listing at a time.
+        After each page we save a checkpoint, so that an interrupted sync resumes after the last
+        page processed. The last sync time only moves forward once the whole listing is processed,
+        as pages go from the newest emails to the oldest."""
+        checkpoint = self._load_checkpoint()
+        if checkpoint:
+            timestamp = checkpoint['since']
+            print(f"Resuming sync since {timestamp} after {checkpoint['processed']} emails")
+        else:
+            checkpoint = {'since': timestamp, 'page_token': None, 'high_water': 0, 'processed': 0}
         # log the last sync time
-        print(f"Last sync time: {last_sync_obj.value}")
+        print(f"Last sync time: {timestamp}")
 
         # fetch emails from gmail since last sync
-        emails = gmail_helper.fetch_emails_since(int(last_sync_obj.value) + 1)
-        #log the number of emails fetched
-        print(f"Fetched {len(emails)} emails since {last_sync_obj.value}")
+        for emails, next_page_token in self.gmail_helper.iter_email_pages(timestamp + 1, page_token=checkpoint['page_token']):
+            #log the number of emails fetched
+            print(f"Fetched a page of {len(emails)} emails since {timestamp}")
+            # Gmail lists the newest emails first, we process each page from the oldest
+            fetched_ids, max_timestamp = self._process_email_records(emails[::-1])
+            checkpoint['page_token'] = next_page_token
+            checkpoint['high_water'] = max(checkpoint['high_water'], max_timestamp)
+            checkpoint['processed'] += len(emails)
+            if next_page_token:
+                self._save_checkpoint(checkpoint)
+
+        self._update_last_sync_time(checkpoint['high_water'])
+        SystemParameter.objects.filter(key="sync_checkpoint").delete()
+
+    def _load_checkpoint(self):
+        checkpoint_obj = SystemParameter.objects.filter(key="sync_checkpoint").first()
+        return json.loads(checkpoint_obj.value) if checkpoint_obj else None
+
+    def _save_checkpoint(self, checkpoint):
+        SystemParameter.objects.update_or_create(key="sync_checkpoint", defaults={"value": json.dumps(checkpoint)})
 
-        if not emails:
-            print("No new emails to process")
-            return
+    def _update_last_sync_time(self, timestamp):
+        if timestamp > int(self.last_sync_obj.value):
+            self.last_sync_obj.value = int(timestamp)
+            self.last_sync_obj.save()
+
+    def _process_email_records(self, email_records):
+        """Fetch and store the emails listed in email_records (dicts with id and threadId keys).
+        Emails already in the database are skipped.
+        Returns the set of gmail ids that were fetched and the timestamp of the newest email of a known thread."""
+        known_ids = set(Email.objects.filter(
+            gmail_message_id__in=[r['id'] for r in email_records]
+        ).values_list('gmail_message_id', flat=True))
 
         # Now for each email we want to check if the thread already exists in the database
         # if not we will create it and fetch all emails from that thread
         max_timestamp = 0
-        for email_record in emails:
+        fetched_ids = set()
+        # new threads are fetched in parallel, and the emails of threads we already know
+        # are fetched together using batch requests
+        new_threads = {}
+        pending_emails = []
+        for email_record in email_records:
+            if email_record['id'] in known_ids or email_record['id'] in fetched_ids:
+                continue
             # check if the thread already exists
             gmail_thread_id = email_record.get("threadId")
+            if gmail_thread_id in new_threads:
+                # the whole thread is fetched below
+                continue
             thread, created = Thread.objects.get_or_create(gmail_thread_id=gmail_thread_id) # type: ignore[attr-defined]
             if created:
                 # log that we created a new thread
                 print(f"Created new thread with id {gmail_thread_id}")
-                # fetch all emails from that thread
-                thread_emails = gmail_helper.fetch_thread(gmail_thread_id)
-                for thread_email in thread_emails['messages']:
-                    _process_email(thread_email, thread)
-                    # We don't update max timestamp for threaded emails as this may fetch newer emails and we don't want to miss emails in case the process stops in the middle
-                    # max_timestamp = max(int(thread_email['internalDate'])/1000, max_timestamp)
+                new_threads[gmail_thread_id] = thread
             else:
-                email = gmail_helper.fetch_email(email_record['id'])
-                _process_email(email, thread)
-                max_timestamp = max(int(email['internalDate'])/1000, max_timestamp)
+                pending_emails.append((email_record['id'], thread))
+                fetched_ids.add(email_record['id'])
+
+        # list the emails of the new threads, then only download the ones we don't have yet
+        thread_email_ids = {}
+        for thread_info in self.gmail_helper.iter_threads(new_threads, workers=self.workers, format='minimal'):
+            thread_email_ids[thread_info['id']] = [m['id'] for m in thread_info['messages']]
+        stored_ids = set(Email.objects.filter(
+            gmail_message_id__in=[email_id for email_ids in thread_email_ids.values() for email_id in email_ids]
+        ).values_list('gmail_message_id', flat=True))
+        missing_email_ids = {}
+        for gmail_thread_id, email_ids in thread_email_ids.items():
+            missing = [email_id for email_id in email_ids if email_id not in stored_ids]
+            if missing:
+                missing_email_ids[gmail_thread_id] = missing
+        print(f"New threads have {len(stored_ids)} emails already stored and {sum(len(ids) for ids in missing_email_ids.values())} to download")
+
+        # fetch the missing emails. Only this thread writes to the database
+        for gmail_thread_id, thread_emails in self.gmail_helper.iter_thread_emails(missing_email_ids, workers=self.workers):
+            thread = new_threads[gmail_thread_id]
+            for thread_email in thread_emails:
+                self._store_email(thread_email, thread)
+                fetched_ids.add(thread_email['id'])
+                self.processed_count += 1
+                # We don't update max timestamp for threaded emails as this may fetch newer emails and we don't want to miss emails in case the process stops in the middle
+                # max_timestamp = max(int(thread_email['internalDate'])/1000, max_timestamp)
+
+        if self.batch:
+            fetched_emails = self.gmail_helper.fetch_emails([email_id for email_id, thread in pending_emails])
+        else:
+            fetched_emails = []
+            for email_id, thread in pending_emails:
+                try:
+                    fetched_emails.append(self.gmail_helper.fetch_email(email_id))
+                except HttpError as e:
+                    if e.resp.status != 404:
+                        raise
+
+        # Emails deleted since they were listed are not returned
+        fetched_by_id = {email['id']: email for email in fetched_emails}
+        for email_id, thread in pending_emails:
+            email = fetched_by_id.get(email_id)
+            if email is None:
+                fetched_ids.discard(email_id)
+                continue
+            self._store_email(email, thread)
+            self.processed_count += 1
+            max_timestamp = max(int(email['internalDate'])/1000, max_timestamp)
 
-        # update the last sync time
-        last_sync_obj.value = int(max_timestamp)
-        last_sync_obj.save()
+        if self.writer:
+            self.writer.flush()
+
+        return fetched_ids, max_timestamp
+
+    def _store_email(self, message, thread):
+        if self.archive:
+            self.archive.append(message)
+        if self.writer:
+            self.writer.add(message, thread)
+        else:
+            _process_email(message, thread)
+
+    def _apply_label_changes(self, label_changes, skip_ids=()):
+        """Apply the (gmail message id, added label ids, removed label ids) changes to the stored emails.
+        Emails in skip_ids have just been fetched and already carry their current labels."""
+        emails = Email.objects.in_bulk(
+            [message_id for message_id, added, removed in label_changes if message_id not in skip_ids],
+            field_name='gmail_message_id'
+        )
+        for message_id, added, removed in label_changes:
+            email_obj = emails.get(message_id)
+            if email_obj is None:
+                continue
+            if added:
+                email_obj.labels.add(*[_get_label(label_id) for label_id in added])
+            if removed:
+                email_obj.labels.remove(*Label.objects.filter(gmail_label_id__in=removed))
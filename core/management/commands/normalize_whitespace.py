@@ -1,31 +1,50 @@
 from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
 from core.models import Email
-from core.utils import normalize_whitespace
+from core.utils import normalize_whitespace, remove_quoted_text
 
 class Command(BaseCommand):
     help = 'Normalize whitespace in all existing email bodies'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of emails normalized and updated in one transaction'
+        )
+
     def handle(self, *args, **options):
-        emails = Email.objects.all()
-        total_emails = emails.count()
+        batch_size = options['batch_size']
+        total_emails = Email.objects.count()
         processed = 0
         updated = 0
 
         self.stdout.write(f"Processing {total_emails} emails...")
 
-        for email in emails:
-            processed += 1
-            original_body = email.body
-            normalized_body = normalize_whitespace(original_body)
-            
-            if original_body != normalized_body:
-                email.body = normalized_body
-                email.save()
-                updated += 1
-                self.stdout.write(f"Updated email {email.id} ({processed}/{total_emails})")
-            else:
-                self.stdout.write(f"No changes needed for email {email.id} ({processed}/{total_emails})")
+        last_id = 0
+        while True:
+            batch = list(Email.objects.filter(id__gt=last_id).order_by('id').only('id', 'body')[:batch_size])
+            if not batch:
+                break
+            last_id = batch[-1].id
+            processed += len(batch)
+
+            now = timezone.now()
+            changed = []
+            for email in batch:
+                normalized_body = normalize_whitespace(email.body)
+                if email.body != normalized_body:
+                    email.body = normalized_body
+                    email.stripped_body = remove_quoted_text(normalized_body)
+                    email.updated_at = now
+                    changed.append(email)
+            with transaction.atomic():
+                Email.objects.bulk_update(changed, ['body', 'stripped_body', 'updated_at'])
+            updated += len(changed)
+            self.stdout.write(f"Processed {processed}/{total_emails} emails, {updated} updated")
 
         self.stdout.write(self.style.SUCCESS(
             f"Successfully processed {processed} emails. Updated {updated} emails."
-        )) 
\ No newline at end of file
+        ))
@@ -0,0 +1,17 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from core.models import Email, ThreadSummary
+from core import search_index
+
+class Command(BaseCommand):
+    help = "Rebuild the full-text index used by the thread search from the emails and summaries"
+
+    def handle(self, *args, **options):
+        if not search_index.is_available():
+            raise CommandError("The full-text index needs SQLite and migration 0004_search_index")
+
+        self.stdout.write(f"Indexing {Email.objects.count()} emails and the summaries of "
+                          f"{ThreadSummary.objects.values('thread').distinct().count()} threads...")
+        start = time.perf_counter()
+        search_index.rebuild_search_index()
+        self.stdout.write(self.style.SUCCESS(f"Search index rebuilt in {time.perf_counter() - start:.1f}s"))
@@ -0,0 +1,100 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from core.models import Email, Label
+from core.message_archive import MessageArchive, reparse_archived
+from core.utils import remove_quoted_text
+
+class Command(BaseCommand):
+    help = "Parse the archived raw Gmail messages again and update the stored emails, without calling Gmail"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=os.cpu_count(),
+            help='Number of processes parsing messages in parallel'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Number of emails parsed by a worker and updated in one transaction'
+        )
+        parser.add_argument(
+            '--restore-labels',
+            action='store_true',
+            help='Also set the Gmail labels to the ones archived with the messages. '
+                 'Label changes made after the messages were archived are lost'
+        )
+
+    def handle(self, *args, **options):
+        archive = MessageArchive(settings.MESSAGE_ARCHIVE_DIR)
+        archive.close()  # the workers open their own copy
+        self.restore_labels = options['restore_labels']
+        self.calendar_label, created = Label.objects.get_or_create(
+            name="Calendar",
+            defaults={
+                "gmail_label_id": "CALENDAR",  # This is a custom label, not a Gmail system label
+            }
+        )
+        self.label_ids = dict(Label.objects.values_list('gmail_label_id', 'id'))
+
+        email_ids = dict(
+            (gmail_message_id, email_id)
+            for email_id, gmail_message_id in Email.objects.values_list('id', 'gmail_message_id').iterator()
+            if gmail_message_id in archive
+        )
+        self.stdout.write(f"{len(email_ids)} stored emails found in the archive ({len(archive)} archived messages)")
+
+        gmail_message_ids = list(email_ids)
+        batch_size = options['batch_size']
+        batches = [gmail_message_ids[i:i + batch_size] for i in range(0, len(gmail_message_ids), batch_size)]
+        updated_count = 0
+        # Parsing is CPU bound, so it runs in several processes; the database is only written from this one
+        with ProcessPoolExecutor(max_workers=options['workers'], initializer=django.setup) as executor:
+            for results in executor.map(reparse_archived, [archive.directory] * len(batches), batches):
+                with transaction.atomic():
+                    updated_count += self._update_emails(results, email_ids)
+                self.stdout.write(f"Parsed {len(results)} emails, {updated_count} bodies changed so far")
+
+        self.stdout.write(self.style.SUCCESS(f"Finished: {len(email_ids)} emails parsed, {updated_count} bodies changed"))
+
+    def _update_emails(self, results, email_ids):
+        """Store the (gmail message id, body, Gmail label ids, is calendar invite) results of a worker.
+        Return the number of bodies that changed."""
+        emails = Email.objects.in_bulk([email_ids[r[0]] for r in results])
+        now = timezone.now()
+        changed = []
+        calendar_ids = []
+        label_rows = []
+        for gmail_message_id, body, gmail_label_ids, calendar in results:
+            email = emails[email_ids[gmail_message_id]]
+            if email.body != body:
+                email.body = body
+                email.stripped_body = remove_quoted_text(body)
+                email.updated_at = now
+                changed.append(email)
+            if calendar:
+                calendar_ids.append(email.id)
+            if self.restore_labels:
+                label_rows.extend(
+                    Email.labels.through(email_id=email.id, label_id=self.label_ids[label_id])
+                    for label_id in gmail_label_ids if label_id in self.label_ids
+                )
+        Email.objects.bulk_update(changed, ['body', 'stripped_body', 'updated_at'])
+
+        through = Email.labels.through.objects.filter(email_id__in=emails.keys())
+        if self.restore_labels:
+            through.exclude(label_id=self.calendar_label.id).delete()
+            Email.labels.through.objects.bulk_create(label_rows, ignore_conflicts=True)
+        through.filter(label_id=self.calendar_label.id).exclude(email_id__in=calendar_ids).delete()
+        Email.labels.through.objects.bulk_create(
+            [Email.labels.through(email_id=email_id, label_id=self.calendar_label.id) for email_id in calendar_ids],
+            ignore_conflicts=True
+        )
+        return len(changed)
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+# This file adds a command to manage.py to summarize the threads queued by the summarize view
+# and the admin action (see core/summary_queue.py)
+from django.core.management.base import BaseCommand
+from core.summary_queue import DEFAULT_POLL_INTERVAL, QueueWorkers
+from core.summary_worker import DEFAULT_CONCURRENCY
+import logging
+import signal
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = "Summarize the queued threads, until a SIGTERM / SIGINT is received"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=DEFAULT_CONCURRENCY,
+            help='Number of threads summarized at the same time (see OLLAMA_NUM_PARALLEL)'
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=DEFAULT_POLL_INTERVAL,
+            help='Seconds between two checks of an empty queue'
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Stop when no queued job is due instead of waiting for new ones'
+        )
+
+    def handle(self, *args, **options):
+        def on_done(job, error):
+            if error is None:
+                self.stdout.write(f"Job {job.id}: thread {job.thread_id} summarized")
+            else:
+                self.stdout.write(self.style.ERROR(f"Job {job.id}: thread {job.thread_id} failed (attempt {job.attempts}): {error}"))
+
+        workers = QueueWorkers(count=options['workers'], poll_interval=options['poll_interval'], on_done=on_done)
+
+        def shutdown(signum, frame):
+            self.stdout.write(self.style.WARNING("Stopping once the summaries in progress are complete")) # type: ignore[attr-defined]
+            workers.stop()
+
+        self.stdout.write(f"Summarizing the queued threads, {workers.count} at a time")
+        previous_handlers = {signum: signal.signal(signum, shutdown) for signum in (signal.SIGTERM, signal.SIGINT)}
+        try:
+            stats = workers.run(once=options['once'])
+        finally:
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+        self.stdout.write(self.style.SUCCESS(f"{stats['done']} jobs done, {stats['failed']} attempts failed")) # type: ignore[attr-defined]
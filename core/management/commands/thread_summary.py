@@ -6,8 +6,14 @@
 from django.core.management.base import BaseCommand
 from core.models import Thread, ThreadSummary
 from core.llm import get_langgraph_helper
+from core.llm.cache import summary_cache
+from core.llm.compaction import compaction_stats
+from core.summary_worker import DEFAULT_CONCURRENCY, SummaryWorker, asummarize_thread, pending_threads, summarize_thread
+from functools import partial
+import asyncio
 import json
 import logging
+import signal
 from datetime import datetime
 import codecs
 
@@ -23,19 +29,52 @@ logger = logging.getLogger(__name__)
 
 class Command(BaseCommand):
     help = "Create a summary for each thread with more than 1 email and the label PERSONAL"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--worker',
+            action='store_true',
+            help='Summarize every pending thread instead of only the first one'
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=DEFAULT_CONCURRENCY,
+            help='Number of threads summarized at the same time in worker mode (see OLLAMA_NUM_PARALLEL)'
+        )
+        parser.add_argument(
+            '--async',
+            action='store_true',
+            dest='use_async',
+            help='In worker mode, run the summaries with the async graph in one thread instead of a thread pool'
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            default=None,
+            help='Maximum number of threads summarized in worker mode'
+        )
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Summarize again with the LLM even if the conversation and knowledge have a cached summary'
+        )
+        parser.add_argument(
+            '--retry-failed',
+            action='store_true',
+            help='Also summarize the threads whose summary failed in a previous worker run'
+        )
     
     def handle(self, *args, **options):
         """This will create a summary for each thread with more than 1 email and the label PERSONAL"""
 
         # Get all threads where the last email has CATEGORY_PERSONAL label but not CALENDAR label
         # and where there is not already a summary
-        threads = Thread.objects.filter(
-                last_email__labels__name="CATEGORY_PERSONAL"
-        ).exclude(
-                last_email__labels__name="Calendar"
-        ).filter(
-                last_email__threadsummary__isnull=True
-        ).distinct() # type: ignore[attr-defined]
+        threads = pending_threads()
+
+        if options['worker']:
+            self._run_worker(threads, options)
+            return
 
         thread = threads.first() # we will only process the first thread for now
         if not thread:
@@ -54,7 +93,7 @@ class Command(BaseCommand):
 
         # Now we create a summary for the thread
         langgraph_helper = get_langgraph_helper()
-        result = langgraph_helper.invoke({"thread": thread})
+        result = langgraph_helper.invoke({"thread": thread, "force_refresh": options['force']})
         summary_result = result["thread_summary"]
         
         # Extract only the serializable summary data
@@ -100,7 +139,52 @@ class Command(BaseCommand):
             self.stdout.write(f"\n- {participant['name']} ({participant['email']})")
             self.stdout.write(f"  Role: {participant['role in the thread']}")
             self.stdout.write(f"  Updated Knowledge: {participant['updated_knowledge']}")
+        self.stdout.write(f"\n\n{summary_cache.report()}")
+        self.stdout.write(compaction_stats.report())
 
+    def _run_worker(self, threads, options):
+        """Summarize all the pending threads, until they are all done or a SIGTERM / SIGINT is received"""
+        thread_ids = list(threads.order_by('id').values_list('id', flat=True))
+        if options['limit'] is not None:
+            thread_ids = thread_ids[:options['limit']]
+        if not thread_ids:
+            self.stdout.write(self.style.SUCCESS("No threads found")) # type: ignore[attr-defined]
+            return
+        self.stdout.write(f"Summarizing {len(thread_ids)} threads, {options['concurrency']} at a time"
+                          f"{' with the async graph' if options['use_async'] else ''}")
+
+        def on_done(thread_id, summary, error, seconds):
+            count = worker.summarized_count + len(worker.failed_ids)
+            if error is None:
+                logger.info(f"Thread {thread_id} summarized in {seconds:.1f}s: {summary.get('summary', '')}")
+                self.stdout.write(f"[{count}/{len(thread_ids)}] Thread {thread_id} summarized in {seconds:.1f}s")
+            else:
+                self.stdout.write(self.style.ERROR(f"[{count}/{len(thread_ids)}] Thread {thread_id} failed after {seconds:.1f}s: {error}"))
+
+        worker = SummaryWorker(
+            concurrency=options['concurrency'],
+            summarize=partial(asummarize_thread if options['use_async'] else summarize_thread, force_refresh=options['force']),
+            on_done=on_done
+        )
 
+        def shutdown(signum, frame):
+            self.stdout.write(self.style.WARNING("Stopping once the summaries in progress are complete")) # type: ignore[attr-defined]
+            worker.stop()
 
+        previous_handlers = {signum: signal.signal(signum, shutdown) for signum in (signal.SIGTERM, signal.SIGINT)}
+        try:
+            if options['use_async']:
+                stats = asyncio.run(worker.arun(thread_ids, retry_failed=options['retry_failed']))
+            else:
+                stats = worker.run(thread_ids, retry_failed=options['retry_failed'])
+        finally:
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
 
+        latency = "no latency" if stats['p50'] is None else f"latency p50 {stats['p50']:.1f}s, p95 {stats['p95']:.1f}s"
+        self.stdout.write(self.style.SUCCESS( # type: ignore[attr-defined]
+            f"Summarized {stats['summarized']} threads in {worker.elapsed:.0f}s "
+            f"({stats['threads_per_minute']:.1f} threads/min, {latency}), {stats['failed']} failed"
+        ))
+        self.stdout.write(summary_cache.report())
+        self.stdout.write(compaction_stats.report())
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+This module keeps the raw Gmail message resources in an append-only archive, so emails can be parsed
+again (e.g. after improving the body extraction) without downloading the mailbox from Gmail.
+
+The archive is a directory with two files:
+- messages.pack: a header (magic + codec) followed by records. Each record is the length of the message id
+  and of the compressed data, the message id, and the compressed JSON of the message.
+- messages.idx: one line "gmail_message_id offset length" per record, pointing to the compressed data.
+  The index can be rebuilt from the pack, which is the source of truth.
+Records are compressed with zstd when the zstandard package is installed, with zlib otherwise.
+"""
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # optional dependency
+    zstandard = None
+
+PACK_FILE = 'messages.pack'
+INDEX_FILE = 'messages.idx'
+MAGIC = b'GMPACK1'
+CODEC_ZLIB = b'z'
+CODEC_ZSTD = b's'
+HEADER_SIZE = len(MAGIC) + 1
+RECORD_HEADER = struct.Struct('>HI')
+
+class MessageArchive:
+    """Append-only, compressed archive of Gmail message resources, with random access by message id.
+
+    Usage:
+        with MessageArchive(directory) as archive:
+            archive.append(message)
+            message = archive.get(gmail_message_id)
+
+    Reads go through a memory map of the pack file. Several processes can read the same archive,
+    but only one should write to it.
+    """
+
+    def __init__(self, directory, codec=None):
+        self.directory = str(directory)
+        os.makedirs(self.directory, exist_ok=True)
+        self.pack_path = os.path.join(self.directory, PACK_FILE)
+        self.index_path = os.path.join(self.directory, INDEX_FILE)
+        self._lock = threading.Lock()
+        self._mmap = None
+        self._pack = None
+        self._index_file = None
+
+        if not os.path.exists(self.pack_path) or os.path.getsize(self.pack_path) < HEADER_SIZE:
+            self.codec = codec or (CODEC_ZSTD if zstandard else CODEC_ZLIB)
+            with open(self.pack_path, 'wb') as pack:
+                pack.write(MAGIC + self.codec)
+            open(self.index_path, 'w').close()
+        else:
+            with open(self.pack_path, 'rb') as pack:
+                header = pack.read(HEADER_SIZE)
+            if header[:len(MAGIC)] != MAGIC:
+                raise ValueError(f"{self.pack_path} is not a message archive")
+            self.codec = header[len(MAGIC):]
+        if self.codec == CODEC_ZSTD and zstandard is None:
+            raise RuntimeError("This archive is compressed with zstd, install the zstandard package to read it")
+
+        self.index = {}  # gmail message id -> (offset, length) of the compressed data
+        self._load_index()
+
+    def _load_index(self):
+        end = HEADER_SIZE
+        pack_size = os.path.getsize(self.pack_path)
+        # Size of the valid lines at the start of the index
+        index_size = 0
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'rb') as index_file:
+                for line in index_file:
+                    parts = line.split()
+                    if not line.endswith(b'\n') or len(parts) != 3 or int(parts[1]) + int(parts[2]) > pack_size:
+                        break  # partly written line, or record lost in a crash
+                    gmail_message_id, offset, length = parts[0].decode('ascii'), int(parts[1]), int(parts[2])
+                    self.index[gmail_message_id] = (offset, length)
+                    end = max(end, offset + length)
+                    index_size += len(line)
+            if index_size < os.path.getsize(self.index_path):
+                # The lines appended later must not follow a broken one
+                os.truncate(self.index_path, index_size)
+        if end < pack_size:
+            self._recover(end)
+
+    def _recover(self, end):
+        """Index the records written after the last index line, e.g. after a crash,
+        and drop a partly written record at the end of the pack"""
+        pack_size = os.path.getsize(self.pack_path)
+        recovered = []
+        with open(self.pack_path, 'rb') as pack:
+            pack.seek(end)
+            while end + RECORD_HEADER.size <= pack_size:
+                id_length, length = RECORD_HEADER.unpack(pack.read(RECORD_HEADER.size))
+                offset = end + RECORD_HEADER.size + id_length
+                if offset + length > pack_size:
+                    break
+                gmail_message_id = pack.read(id_length).decode('ascii')
+                pack.seek(length, os.SEEK_CUR)
+                recovered.append((gmail_message_id, offset, length))
+                end = offset + length
+        if end < pack_size:
+            os.truncate(self.pack_path, end)
+        with open(self.index_path, 'a') as index_file:
+            for gmail_message_id, offset, length in recovered:
+                if gmail_message_id not in self.index:
+                    index_file.write(f"{gmail_message_id} {offset} {length}\n")
+                self.index[gmail_message_id] = (offset, length)
+
+    def _compress(self, data):
+        if self.codec == CODEC_ZSTD:
+            return zstandard.ZstdCompressor(level=3).compress(data)
+        return zlib.compress(data, 6)
+
+    def _decompress(self, data):
+        if self.codec == CODEC_ZSTD:
+            return zstandard.ZstdDecompressor().decompress(data)
+        return zlib.decompress(data)
+
+    def append(self, message):
+        """Archive a Gmail message resource. Return False if the message is already in the archive"""
+        # Imported here because workers may import this module before Django is set up
+        from core.gmail_helper import PARSED_FIELDS
+
+        gmail_message_id = message['id']
+        if gmail_message_id in self.index:
+            return False
+        raw = {key: value for key, value in message.items() if key not in PARSED_FIELDS}
+        data = self._compress(json.dumps(raw, separators=(',', ':')).encode('utf-8'))
+        encoded_id = gmail_message_id.encode('ascii')
+
+        with self._lock:
+            if self._pack is None:
+                self._pack = open(self.pack_path, 'ab')
+                self._index_file = open(self.index_path, 'a')
+            offset = self._pack.tell() + RECORD_HEADER.size + len(encoded_id)
+            self._pack.write(RECORD_HEADER.pack(len(encoded_id), len(data)) + encoded_id + data)
+            self._index_file.write(f"{gmail_message_id} {offset} {len(data)}\n")
+            self.index[gmail_message_id] = (offset, len(data))
+        return True
+
+    def get(self, gmail_message_id):
+        """Return the archived message resource, or None if the message is not in the archive"""
+        location = self.index.get(gmail_message_id)
+        if location is None:
+            return None
+        offset, length = location
+        with self._lock:
+            if self._mmap is None or offset + length > len(self._mmap):
+                self._remap()
+            data = self._mmap[offset:offset + length]
+        return json.loads(self._decompress(data))
+
+    def _remap(self):
+        if self._pack is not None:
+            self._pack.flush()
+        if self._mmap is not None:
+            self._mmap.close()
+        with open(self.pack_path, 'rb') as pack:
+            self._mmap = mmap.mmap(pack.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __contains__(self, gmail_message_id):
+        return gmail_message_id in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def flush(self):
+        with self._lock:
+            if self._pack is not None:
+                self._pack.flush()
+                self._index_file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._pack is not None:
+                self._pack.close()
+                self._index_file.close()
+                self._pack = self._index_file = None
+            if self._mmap is not None:
+                self._mmap.close()
+                self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# Archive opened by each reparse worker process
+_worker_archive = None
+
+def reparse_archived(directory, gmail_message_ids):
+    """Parse archived messages again, in a reparse_emails worker process.
+    Return a list of (gmail message id, body, Gmail label ids, is calendar invite)."""
+    global _worker_archive
+    # Imported here because workers may import this module before Django is set up
+    from core.gmail_helper import parse_message
+    from core.utils import is_calendar_invite
+
+    if _worker_archive is None or _worker_archive.directory != str(directory):
+        _worker_archive = MessageArchive(directory)
+    results = []
+    for gmail_message_id in gmail_message_ids:
+        message = parse_message(_worker_archive.get(gmail_message_id))
+        results.append((
+            gmail_message_id,
+            message['Body'],
+            message.get('labelIds', []),
+            is_calendar_invite(
+                subject=message.get('Subject', ''),
+                body=message['Body'],
+                headers=message.get('payload', {}).get('headers', []),
+                payload=message.get('payload'),
+            ),
+        ))
+    return results
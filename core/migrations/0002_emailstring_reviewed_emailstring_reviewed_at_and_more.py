@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailstring',
+            name='reviewed',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='emailstring',
+            name='reviewed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='threadsummary',
+            name='action',
+            field=models.CharField(blank=True, choices=[('IGNORE', 'Ignore'), ('NEED_TO_KNOW', 'Need to Know'), ('NEED_TO_RESPOND', 'Need to Respond')], max_length=20, null=True),
+        ),
+        migrations.AddField(
+            model_name='threadsummary',
+            name='participants',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='threadsummary',
+            name='rationale',
+            field=models.TextField(default=''),
+            preserve_default=False,
+        ),
+    ]
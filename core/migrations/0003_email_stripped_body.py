@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_emailstring_reviewed_emailstring_reviewed_at_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='email',
+            name='stripped_body',
+            field=models.TextField(blank=True, help_text='Body without the quoted text of previous emails, computed when the email is saved', null=True),
+        ),
+    ]
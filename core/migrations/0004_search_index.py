@@ -0,0 +1,52 @@
+from django.db import migrations
+from core import search_index
+
+# Full-text index of the emails and thread summaries, see core/search_index.py.
+# FTS5 is SQLite only: on other databases the thread search keeps using icontains.
+CREATE_SQL = [
+    # The prefix indexes make the searches of a word being typed ("proj*") fast
+    "CREATE VIRTUAL TABLE core_email_fts USING fts5("
+    "subject, body, sender, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')",
+    "CREATE VIRTUAL TABLE core_summary_fts USING fts5(summary, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')",
+]
+
+# Index the existing rows
+INDEX_SQL = [
+    """INSERT INTO core_email_fts (rowid, subject, body, sender)
+        SELECT e.id, e.subject, coalesce(e.stripped_body, e.body), s.name || ' ' || s.original_string
+        FROM core_email e LEFT JOIN core_emailstring s ON s.id = e.sender_str_id""",
+    """INSERT INTO core_summary_fts (rowid, summary)
+        SELECT thread_id, summary FROM (SELECT thread_id, summary, max(id) FROM core_threadsummary GROUP BY thread_id)""",
+]
+
+DROP_SQL = [f"DROP TRIGGER IF EXISTS {name}" for name in search_index.TRIGGERS] + [
+    "DROP TABLE IF EXISTS core_email_fts",
+    "DROP TABLE IF EXISTS core_summary_fts",
+]
+
+def create_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for sql in CREATE_SQL:
+        schema_editor.execute(sql, params=None)
+    # The triggers are defined in core/search_index.py, which the later migrations use to create them again
+    search_index.ensure_triggers(schema_editor)
+    for sql in INDEX_SQL:
+        schema_editor.execute(sql, params=None)
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for sql in DROP_SQL:
+        schema_editor.execute(sql, params=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_email_stripped_body'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
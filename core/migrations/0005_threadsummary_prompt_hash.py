@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:03
+
+from django.db import migrations, models
+from core.search_index import ensure_triggers_migration
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_search_index'),
+    ]
+
+    operations = [
+        # Removing the indexed column when rolling back makes SQLite rebuild core_threadsummary,
+        # which drops the triggers of the full-text index: they are created again
+        migrations.RunPython(
+            migrations.RunPython.noop,
+            ensure_triggers_migration,
+        ),
+        migrations.AddField(
+            model_name='threadsummary',
+            name='prompt_hash',
+            field=models.CharField(blank=True, db_index=True, help_text='Key of the summary cache, see core/llm/cache.py', max_length=64, null=True),
+        ),
+    ]
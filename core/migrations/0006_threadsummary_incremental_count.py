@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:31
+
+from django.db import migrations, models
+from core.search_index import ensure_triggers_migration
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_threadsummary_prompt_hash'),
+    ]
+
+    operations = [
+        # Removing the column when rolling back rebuilds the table again: the triggers are then restored
+        migrations.RunPython(
+            migrations.RunPython.noop,
+            ensure_triggers_migration,
+        ),
+        migrations.AddField(
+            model_name='threadsummary',
+            name='incremental_count',
+            field=models.PositiveIntegerField(default=0, help_text='Number of incremental summaries since the last full summary of the thread'),
+        ),
+        # Adding a NOT NULL column makes SQLite rebuild core_threadsummary, which drops the triggers
+        # keeping the full-text index in sync: they are created again
+        migrations.RunPython(
+            ensure_triggers_migration,
+            migrations.RunPython.noop,
+        ),
+    ]
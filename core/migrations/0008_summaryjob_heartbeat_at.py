@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_summaryjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='summaryjob',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, help_text='Updated by the worker while the job runs', null=True),
+        ),
+    ]
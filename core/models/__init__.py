@@ -6,6 +6,7 @@ from .email import Email
 from .thread import Thread
 from .thread_summary import ThreadSummary
 from .system_parameter import SystemParameter
+from .summary_job import SummaryJob
 
 # Export all models
 __all__ = [
@@ -17,4 +18,5 @@ __all__ = [
     'Thread',
     'ThreadSummary',
     'SystemParameter',
+    'SummaryJob',
 ] 
\ No newline at end of file
@@ -3,14 +3,10 @@ from .email_address import EmailAddress
 from .base import TimestampedModel
 
 class ContactManager(models.Manager):
-    def search_similar_names(self, name, email=None):
-        from core.utils import search_similar_contacts
-        result = search_similar_contacts(name, email)
-        if result is None:
-            return []
-        if isinstance(result, list):
-            return result
-        return [result]
+    def search_similar_names(self, name, email=None, limit=10):
+        """Return the contacts with a name similar to name, best first, each with its score in a rank attribute"""
+        from core.utils.contact_index import contact_index
+        return contact_index.search(name, email, limit=limit)
 
 class Contact(TimestampedModel):
     name = models.CharField(max_length=255)
@@ -14,14 +14,22 @@ class Email(TimestampedModel):
     cc_str = models.ManyToManyField(EmailString, related_name="cc_emails")
     subject = models.CharField(max_length=255)
     body = models.TextField()
+    stripped_body = models.TextField(null=True, blank=True, help_text="Body without the quoted text of previous emails, computed when the email is saved")
     snippet = models.TextField()
     labels = models.ManyToManyField(Label, blank=True)
     thread = models.ForeignKey('Thread', on_delete=models.SET_NULL, null=True, blank=True)
 
+    def save(self, *args, **kwargs):
+        self.stripped_body = remove_quoted_text(self.body)
+        super().save(*args, **kwargs)
+
     @property
     def truncated_body(self):
-        """Returns the body of the email without the quoted text from previous emails."""
-        return remove_quoted_text(self.body)
+        """Returns the body of the email without the quoted text from previous emails.
+        It is stored in stripped_body, emails not backfilled yet (see backfill_stripped_body) compute it."""
+        if self.stripped_body is None:
+            return remove_quoted_text(self.body)
+        return self.stripped_body
 
     def __str__(self):
         return f"{self.subject} - {self.date} - from {self.sender_str}" 
\ No newline at end of file
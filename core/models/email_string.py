@@ -15,7 +15,9 @@ class EmailString(TimestampedModel):
     def save(self, *args, **kwargs):
         name, email = extract_email_and_name(self.original_string)
         self.name = name
-        self.email = EmailAddress.objects.get_or_create(email=email)[0]
+        # The email address may already be set by the caller (e.g. the sync's IdentityResolver)
+        if self.email_id is None or self.email.email != email:
+            self.email = EmailAddress.objects.get_or_create(email=email)[0]
 
         if not self.contact:
             contact = search_similar_contacts(name, email)
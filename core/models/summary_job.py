@@ -0,0 +1,39 @@
+from django.db import models
+from django.db.models import Q
+from django.utils import timezone
+from .thread import Thread
+from .thread_summary import ThreadSummary
+from .base import TimestampedModel
+
+class SummaryJob(TimestampedModel):
+    """A thread to summarize in the background, see core/summary_queue.py and the run_workers command"""
+    PENDING = 'PENDING'
+    RUNNING = 'RUNNING'
+    DONE = 'DONE'
+    FAILED = 'FAILED'
+
+    thread = models.ForeignKey(Thread, on_delete=models.CASCADE)
+    force_refresh = models.BooleanField(default=False, help_text="Summarize again even if the summary cache has the prompt")
+    status = models.CharField(max_length=10, default=PENDING, choices=[
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed')
+    ])
+    attempts = models.PositiveIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now, help_text="Not started before this time, to retry with backoff")
+    locked_by = models.CharField(max_length=100, blank=True, default="")
+    locked_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True, help_text="Updated by the worker while the job runs")
+    error = models.TextField(blank=True, default="")
+    thread_summary = models.ForeignKey(ThreadSummary, on_delete=models.SET_NULL, null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'run_after'])]
+        constraints = [
+            # A thread has at most one job waiting or in progress: the requests made meanwhile are coalesced
+            models.UniqueConstraint(fields=['thread'], condition=Q(status__in=['PENDING', 'RUNNING']), name='unique_active_summary_job'),
+        ]
+
+    def __str__(self):
+        return f"Summary job {self.id} for Thread {self.thread_id}: {self.status}"
@@ -15,6 +15,10 @@ class ThreadSummary(TimestampedModel):
     ])
     rationale = models.TextField()
     participants = models.JSONField(null=True, blank=True)
+    incremental_count = models.PositiveIntegerField(default=0,
+                                                    help_text="Number of incremental summaries since the last full summary of the thread")
+    prompt_hash = models.CharField(max_length=64, null=True, blank=True, db_index=True,
+                                   help_text="Key of the summary cache, see core/llm/cache.py")
     timestamp = models.DateTimeField(auto_now_add=True)
 
     @property
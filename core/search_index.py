@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+This module searches the threads through the SQLite FTS5 full-text index created by migration 0004.
+
+The index is two FTS5 tables:
+- core_email_fts: one row per email (rowid = email id) with its subject, stripped body and sender.
+  The thread of an email is read from core_email, as reading a column of an FTS5 row loads the whole row
+- core_summary_fts: one row per thread (rowid = thread id) with the text of its latest summary
+SQLite triggers on core_email and core_threadsummary keep them in sync, so every way of writing
+emails (bulk ingest, save, bulk_update) and summaries updates the index.
+Renaming an email string does not re-index the emails it sent: rebuild_search_index() does.
+SQLite drops the triggers of a table rebuilt by a migration (e.g. adding a NOT NULL column, or removing
+an indexed one): the migrations changing core_email or core_threadsummary call ensure_triggers, forwards and
+backwards.
+"""
+import re
+from django.db import connection, transaction
+from django.db.models.expressions import RawSQL
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+EMAIL_TABLE = 'core_email_fts'
+SUMMARY_TABLE = 'core_summary_fts'
+
+# Maximum number of threads returned by a search sorted by relevance
+MAX_RESULTS = 1000
+
+# Ranking of the emails: bm25 with the weights of the subject, body and sender columns,
+# so a match in the subject counts most
+EMAIL_RANK = 'bm25(10.0, 1.0, 4.0)'
+
+# Markers put around the matched terms by snippet(), replaced by <mark> after the text is escaped
+HIGHLIGHT_START = '\x02'
+HIGHLIGHT_END = '\x03'
+SNIPPET_TOKENS = 16
+
+# Quoted phrases and single terms of a search query
+QUERY_TERM = re.compile(r'"([^"]*)"|(\w+)')
+
+EMAIL_COLUMNS = "NEW.id, NEW.subject, coalesce(NEW.stripped_body, NEW.body), " \
+                "(SELECT name || ' ' || original_string FROM core_emailstring WHERE id = NEW.sender_str_id)"
+LATEST_SUMMARY = "SELECT thread_id, summary FROM core_threadsummary WHERE thread_id = {thread} ORDER BY id DESC LIMIT 1"
+
+# The triggers keeping the index in sync, by name
+TRIGGERS = {
+    'core_email_fts_insert': f"""CREATE TRIGGER IF NOT EXISTS core_email_fts_insert AFTER INSERT ON core_email BEGIN
+        INSERT INTO {EMAIL_TABLE} (rowid, subject, body, sender) VALUES ({EMAIL_COLUMNS});
+    END""",
+    # Only the updates of indexed columns, so e.g. bulk_update(['updated_at']) does not re-index
+    'core_email_fts_update': f"""CREATE TRIGGER IF NOT EXISTS core_email_fts_update
+        AFTER UPDATE OF subject, body, stripped_body, sender_str_id ON core_email BEGIN
+        DELETE FROM {EMAIL_TABLE} WHERE rowid = OLD.id;
+        INSERT INTO {EMAIL_TABLE} (rowid, subject, body, sender) VALUES ({EMAIL_COLUMNS});
+    END""",
+    'core_email_fts_delete': f"""CREATE TRIGGER IF NOT EXISTS core_email_fts_delete AFTER DELETE ON core_email BEGIN
+        DELETE FROM {EMAIL_TABLE} WHERE rowid = OLD.id;
+    END""",
+    # A thread is indexed with its latest summary
+    'core_summary_fts_insert': f"""CREATE TRIGGER IF NOT EXISTS core_summary_fts_insert AFTER INSERT ON core_threadsummary BEGIN
+        DELETE FROM {SUMMARY_TABLE} WHERE rowid = NEW.thread_id;
+        INSERT INTO {SUMMARY_TABLE} (rowid, summary) {LATEST_SUMMARY.format(thread='NEW.thread_id')};
+    END""",
+    'core_summary_fts_update': f"""CREATE TRIGGER IF NOT EXISTS core_summary_fts_update
+        AFTER UPDATE OF summary, thread_id ON core_threadsummary BEGIN
+        DELETE FROM {SUMMARY_TABLE} WHERE rowid IN (OLD.thread_id, NEW.thread_id);
+        INSERT INTO {SUMMARY_TABLE} (rowid, summary) {LATEST_SUMMARY.format(thread='OLD.thread_id')};
+        INSERT OR REPLACE INTO {SUMMARY_TABLE} (rowid, summary) {LATEST_SUMMARY.format(thread='NEW.thread_id')};
+    END""",
+    'core_summary_fts_delete': f"""CREATE TRIGGER IF NOT EXISTS core_summary_fts_delete AFTER DELETE ON core_threadsummary BEGIN
+        DELETE FROM {SUMMARY_TABLE} WHERE rowid = OLD.thread_id;
+        INSERT INTO {SUMMARY_TABLE} (rowid, summary) {LATEST_SUMMARY.format(thread='OLD.thread_id')};
+    END""",
+}
+
+REBUILD_SQL = [
+    f"DELETE FROM {EMAIL_TABLE}",
+    f"""INSERT INTO {EMAIL_TABLE} (rowid, subject, body, sender)
+        SELECT e.id, e.subject, coalesce(e.stripped_body, e.body), s.name || ' ' || s.original_string
+        FROM core_email e LEFT JOIN core_emailstring s ON s.id = e.sender_str_id""",
+    f"DELETE FROM {SUMMARY_TABLE}",
+    # The latest summary of each thread (SQLite takes the bare columns from the row of the max)
+    f"""INSERT INTO {SUMMARY_TABLE} (rowid, summary)
+        SELECT thread_id, summary FROM (SELECT thread_id, summary, max(id) FROM core_threadsummary GROUP BY thread_id)""",
+    f"INSERT INTO {EMAIL_TABLE} ({EMAIL_TABLE}) VALUES ('optimize')",
+    f"INSERT INTO {SUMMARY_TABLE} ({SUMMARY_TABLE}) VALUES ('optimize')",
+]
+
+def is_available():
+    """Return True if the database has the full-text index (SQLite with migration 0004 applied)"""
+    return connection.vendor == 'sqlite' and EMAIL_TABLE in connection.introspection.table_names()
+
+def ensure_triggers(schema_editor):
+    """Create the triggers of the index which are missing, e.g. after a migration rebuilt their table.
+    Does nothing without the index (another database, or before migration 0004)"""
+    connection = schema_editor.connection
+    if connection.vendor != 'sqlite' or EMAIL_TABLE not in connection.introspection.table_names():
+        return
+    for sql in TRIGGERS.values():
+        schema_editor.execute(sql, params=None)
+
+def ensure_triggers_migration(apps, schema_editor):
+    """ensure_triggers for RunPython, in both directions of the migrations rebuilding core_email or core_threadsummary"""
+    ensure_triggers(schema_editor)
+
+def to_match_query(text):
+    """Turn what the user typed into an FTS5 query: every term and "quoted phrase" must match,
+    and the last term also matches as a prefix ("meet" finds "meeting").
+    Return '' if the text has no searchable term."""
+    terms = []
+    prefix = False
+    for match in QUERY_TERM.finditer(text):
+        phrase, word = match.groups()
+        if word:
+            terms.append(f'"{word}"')
+        elif phrase.strip():
+            terms.append('"' + phrase.strip() + '"')
+        # Only a word ending the text is still being typed
+        prefix = bool(word) and not text[match.end():].strip()
+    if prefix:
+        terms[-1] += '*'
+    return ' '.join(terms)
+
+def _matches_sql(match):
+    """Return the SQL and parameters of the (thread_id, email_id, score) rows matching an FTS5 query"""
+    sql = f"""
+        SELECT e.thread_id AS thread_id, f.rowid AS email_id, f.rank AS score
+        FROM {EMAIL_TABLE} f JOIN core_email e ON e.id = f.rowid
+        WHERE {EMAIL_TABLE} MATCH %s AND f.rank MATCH %s
+        UNION ALL
+        SELECT rowid, NULL, rank FROM {SUMMARY_TABLE} WHERE {SUMMARY_TABLE} MATCH %s
+    """
+    return sql, [match, EMAIL_RANK, match]
+
+def search_threads(text, limit=MAX_RESULTS, thread_ids=None):
+    """Search the threads whose emails (subject, body, sender) or latest summary match text.
+
+    Args:
+        text (str): The search query typed by the user
+        limit (int): Maximum number of threads returned, None for all of them
+        thread_ids (list): Only search these threads, e.g. the threads of a page
+
+    Returns:
+        list: (thread id, email id) tuples, the most relevant thread first. The email id is the best
+            matching email of the thread, or None when it is the summary which matches best
+    """
+    match = to_match_query(text)
+    if not match:
+        return []
+    # Only the index is read here (ranks and ids), snippets are made for the displayed threads by get_snippets.
+    # Each thread is ranked by its best matching email or summary
+    # (SQLite takes the bare columns of an aggregate query from the row of the min)
+    matches_sql, params = _matches_sql(match)
+    sql = f"SELECT thread_id, email_id, min(score) FROM ({matches_sql}) WHERE thread_id IS NOT NULL"
+    if thread_ids is not None:
+        sql += f" AND thread_id IN ({', '.join(['%s'] * len(thread_ids))})"
+        params += list(thread_ids)
+    sql += " GROUP BY thread_id ORDER BY min(score)"
+    if limit is not None:
+        sql += " LIMIT %s"
+        params.append(limit)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [(thread_id, email_id) for thread_id, email_id, score in cursor.fetchall()]
+
+def matching_threads(text):
+    """Return the ids of all the threads matching text as a subquery, for a filter(id__in=...)
+    of the searches which are not sorted by relevance"""
+    match = to_match_query(text)
+    if not match:
+        return []
+    matches_sql, params = _matches_sql(match)
+    return RawSQL(f"SELECT thread_id FROM ({matches_sql}) WHERE thread_id IS NOT NULL", params)
+
+def get_snippets(text, results):
+    """Return a dict thread id -> best matching excerpt, for (thread id, email id) results of search_threads.
+    The matched terms are between HIGHLIGHT_START and HIGHLIGHT_END, see highlight."""
+    match = to_match_query(text)
+    email_threads = {email_id: thread_id for thread_id, email_id in results if email_id is not None}
+    summary_threads = [thread_id for thread_id, email_id in results if email_id is None]
+    snippet_args = [HIGHLIGHT_START, HIGHLIGHT_END, '…', SNIPPET_TOKENS]
+    snippets = {}
+    with connection.cursor() as cursor:
+        for table, column, ids in ((EMAIL_TABLE, -1, list(email_threads)), (SUMMARY_TABLE, 0, summary_threads)):
+            if not ids:
+                continue
+            placeholders = ', '.join(['%s'] * len(ids))
+            cursor.execute(
+                f"SELECT rowid, snippet({table}, {column}, %s, %s, %s, %s) FROM {table} WHERE {table} MATCH %s AND rowid IN ({placeholders})",
+                snippet_args + [match] + ids
+            )
+            for rowid, snippet in cursor.fetchall():
+                snippets[email_threads[rowid] if table == EMAIL_TABLE else rowid] = snippet
+    return snippets
+
+def highlight(snippet):
+    """Return the snippet as safe HTML, with the matched terms in <mark> elements"""
+    return mark_safe(escape(snippet).replace(HIGHLIGHT_START, '<mark>').replace(HIGHLIGHT_END, '</mark>'))
+
+def rebuild_search_index():
+    """Index all the emails and summaries again, e.g. after email strings were renamed"""
+    with transaction.atomic(), connection.cursor() as cursor:
+        for sql in REBUILD_SQL:
+            cursor.execute(sql)
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""
+This module keeps the in-memory contact index (core.utils.contact_index) in sync with the Contact
+table for the changes made by this process. Connected by CoreConfig.ready.
+Bulk changes (QuerySet.update, bulk_create) send no signal: the index picks them up on its next refresh.
+"""
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from core.models import Contact, EmailAddress
+from core.utils.contact_index import contact_index
+
+@receiver(post_save, sender=Contact)
+def index_contact(sender, instance, **kwargs):
+    # Not built yet: it will read the contact from the database
+    if contact_index.built:
+        contact_index.add(instance.id, instance.name)
+
+@receiver(post_delete, sender=Contact)
+def unindex_contact(sender, instance, **kwargs):
+    if contact_index.built:
+        contact_index.remove(instance.id)
+
+@receiver(m2m_changed, sender=Contact.emails.through)
+def index_contact_emails(sender, instance, action, reverse, pk_set, **kwargs):
+    if not contact_index.built or action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if action == 'post_clear':
+        # pk_set is None: the contact lost all its email addresses, or the email address all its contacts
+        links = [(instance.id, email) for email in contact_index.emails.get(instance.id, ())] if not reverse else \
+                [(contact_id, instance.email) for contact_id in contact_index.by_email.get(instance.email.lower(), ())]
+    elif reverse:
+        links = [(contact_id, instance.email) for contact_id in pk_set]
+    else:
+        links = [(instance.id, email) for email in EmailAddress.objects.filter(id__in=pk_set).values_list('email', flat=True)]
+    for contact_id, email in list(links):
+        if action == 'post_add':
+            contact_index.add_email(contact_id, email)
+        else:
+            contact_index.remove_email(contact_id, email)
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+This module is the background queue of the thread summaries: the summarize view and the admin action
+enqueue a SummaryJob and return at once, and the run_workers command summarizes the queued threads.
+
+- A thread has at most one job pending or running (see the unique_active_summary_job constraint),
+  so the requests for a thread already queued are coalesced into its job.
+- A failed job is retried MAX_ATTEMPTS times in total, after a backoff doubling at each attempt.
+- A job is claimed with a conditional UPDATE, so several worker processes can share the queue.
+  The workers update the heartbeat of their running jobs every HEARTBEAT_INTERVAL, and give back to the queue
+  the jobs whose heartbeat stopped for STALE_AFTER (their worker died), however long a summary takes.
+- The status writes are retried, since SQLite refuses writes while another connection holds its lock.
+"""
+import logging
+import os
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import time
+from django.db import DatabaseError, IntegrityError, connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from core.models import SummaryJob, Thread
+from core.summary_worker import DEFAULT_CONCURRENCY
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 5
+# Seconds before the first retry, doubled at each attempt up to BACKOFF_MAX
+BACKOFF_BASE = 30
+BACKOFF_MAX = 3600
+# Seconds between two heartbeats of the running jobs, and between two sweeps of the stale jobs
+HEARTBEAT_INTERVAL = 60.0
+# A running job without heartbeat for longer was lost by its worker
+STALE_AFTER = timedelta(minutes=5)
+# Attempts of a status write failing with a database error, and seconds before the first retry
+WRITE_ATTEMPTS = 5
+WRITE_RETRY_DELAY = 0.5
+# Seconds a worker waits when the queue is empty
+DEFAULT_POLL_INTERVAL = 2.0
+
+def enqueue(thread, force_refresh=False):
+    """Queue the summary of a thread. Returns the job, and False when the thread already had a job
+    pending or running, which is returned instead (and made a forced refresh if still pending)"""
+    while True:
+        job = SummaryJob.objects.filter(thread=thread, status__in=[SummaryJob.PENDING, SummaryJob.RUNNING]).first()
+        if job is not None:
+            break
+        try:
+            with transaction.atomic():
+                return SummaryJob.objects.create(thread=thread, force_refresh=force_refresh), True
+        except IntegrityError:
+            # Queued by another request meanwhile: read its job, or create one if that job is already finished
+            continue
+    if force_refresh and not job.force_refresh:
+        SummaryJob.objects.filter(id=job.id, status=SummaryJob.PENDING).update(force_refresh=True)
+    return job, False
+
+def backoff(attempts):
+    """Seconds before the next attempt of a job which failed `attempts` times"""
+    return min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempts - 1))
+
+def claim(worker_id):
+    """Take the oldest job due, or return None. The job is marked running for this worker"""
+    now = timezone.now()
+    for job_id in SummaryJob.objects.filter(status=SummaryJob.PENDING, run_after__lte=now).order_by('run_after', 'id').values_list('id', flat=True)[:10]:
+        # Only one worker changes the status from PENDING, the others try the next job
+        claimed = SummaryJob.objects.filter(id=job_id, status=SummaryJob.PENDING).update(
+            status=SummaryJob.RUNNING, attempts=F('attempts') + 1, locked_by=worker_id, locked_at=now, heartbeat_at=now,
+            updated_at=now
+        )
+        if claimed:
+            return SummaryJob.objects.get(id=job_id)
+    return None
+
+def _claimed(job):
+    """The job as long as it was not claimed again since `job` was, e.g. after being found stale"""
+    return SummaryJob.objects.filter(id=job.id, locked_by=job.locked_by, attempts=job.attempts)
+
+def complete(job, thread_summary_id):
+    _claimed(job).update(status=SummaryJob.DONE, thread_summary_id=thread_summary_id, error="", updated_at=timezone.now())
+
+def fail(job, error):
+    """Queue the job again after its backoff, or mark it failed after MAX_ATTEMPTS"""
+    now = timezone.now()
+    if job.attempts < MAX_ATTEMPTS:
+        _claimed(job).update(status=SummaryJob.PENDING, error=repr(error), updated_at=now,
+                             run_after=now + timedelta(seconds=backoff(job.attempts)))
+    else:
+        _claimed(job).update(status=SummaryJob.FAILED, error=repr(error), updated_at=now)
+
+def heartbeat(job_ids):
+    """Record that the jobs are still running"""
+    SummaryJob.objects.filter(id__in=job_ids, status=SummaryJob.RUNNING).update(heartbeat_at=timezone.now())
+
+def requeue_stale():
+    """Give back to the queue the jobs left running by a worker which died, after the backoff of fail().
+    A job which already had MAX_ATTEMPTS is marked failed: it may be the one killing its workers.
+    Returns the number of jobs queued again or failed"""
+    now = timezone.now()
+    limit = now - STALE_AFTER
+    # The jobs claimed before heartbeat_at existed only have locked_at
+    stale = Q(status=SummaryJob.RUNNING) & (Q(heartbeat_at__lt=limit) | Q(heartbeat_at__isnull=True, locked_at__lt=limit))
+    count = SummaryJob.objects.filter(stale, attempts__gte=MAX_ATTEMPTS).update(
+        status=SummaryJob.FAILED, error="worker lost", updated_at=now
+    )
+    for job_id, attempts in SummaryJob.objects.filter(stale).values_list('id', 'attempts'):
+        # The conditions are checked again, in case a heartbeat came meanwhile
+        count += SummaryJob.objects.filter(stale, id=job_id).update(
+            status=SummaryJob.PENDING, error="worker lost", updated_at=now, run_after=now + timedelta(seconds=backoff(attempts))
+        )
+    return count
+
+def retry_write(write, *args):
+    """Call write(*args), retrying WRITE_ATTEMPTS times in total when the database is locked or unavailable"""
+    for attempt in range(1, WRITE_ATTEMPTS + 1):
+        try:
+            return write(*args)
+        except DatabaseError as e:
+            if attempt == WRITE_ATTEMPTS:
+                raise
+            logger.warning(f"Write to the summary queue failed (attempt {attempt}), retrying: {e!r}")
+            time.sleep(WRITE_RETRY_DELAY * 2 ** (attempt - 1))
+
+def run_job(thread_id, force_refresh=False):
+    """Run the LangGraph pipeline on a thread, which saves its ThreadSummary
+    (or reuses the cached one, unless force_refresh). Returns the id of the ThreadSummary"""
+    from core.llm import get_langgraph_helper
+    thread = Thread.objects.get(id=thread_id)
+    result = get_langgraph_helper().invoke({"thread": thread, "force_refresh": force_refresh})
+    return result["thread_summary_id"]
+
+def job_status(job):
+    """Return the job as the data of the status endpoint"""
+    data = {
+        'id': job.id,
+        'thread_id': job.thread_id,
+        'status': job.status,
+        'attempts': job.attempts,
+        'error': job.error,
+        'run_after': job.run_after.isoformat(),
+    }
+    if job.status == SummaryJob.DONE and job.thread_summary is not None:
+        data.update({
+            'summary': job.thread_summary.summary,
+            'action': job.thread_summary.action,
+            'rationale': job.thread_summary.rationale,
+        })
+    return data
+
+class QueueWorkers:
+    """A pool of `count` threads summarizing the queued jobs.
+
+    Usage:
+        workers = QueueWorkers(count=4)
+        workers.run()         # until stop() is called, e.g. from a SIGTERM handler
+        workers.run(once=True)  # until the queue has no job due
+
+    summarize is called with (thread id, force_refresh) and returns the id of the ThreadSummary.
+    """
+
+    def __init__(self, count=DEFAULT_CONCURRENCY, summarize=run_job, poll_interval=DEFAULT_POLL_INTERVAL, on_done=None):
+        self.count = max(1, count)
+        self.summarize = summarize
+        self.poll_interval = poll_interval
+        # Called in the worker threads with (job, error or None)
+        self.on_done = on_done
+        self.stopping = threading.Event()
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.lock = threading.Lock()
+        self.done_count = 0
+        self.failed_count = 0
+        # Ids of the jobs running in this process, for their heartbeat
+        self.running = set()
+
+    def stop(self):
+        self.stopping.set()
+
+    def run(self, once=False):
+        self._requeue_stale()
+        finished = threading.Event()
+        monitor = threading.Thread(target=self._monitor, args=(finished,), name='summary-job-monitor', daemon=True)
+        monitor.start()
+        try:
+            with ThreadPoolExecutor(max_workers=self.count, thread_name_prefix='summary-job') as executor:
+                futures = [executor.submit(self._work, f"{self.worker_id}:{i}", once) for i in range(self.count)]
+            for future in futures:
+                future.result()
+        finally:
+            finished.set()
+            monitor.join()
+        return {'done': self.done_count, 'failed': self.failed_count}
+
+    def _monitor(self, finished):
+        """Beat for the running jobs and sweep the stale ones every HEARTBEAT_INTERVAL, until the workers finish"""
+        try:
+            while not finished.wait(HEARTBEAT_INTERVAL):
+                self._beat()
+                self._requeue_stale()
+        finally:
+            connection.close()
+
+    def _beat(self):
+        with self.lock:
+            job_ids = list(self.running)
+        if job_ids:
+            try:
+                retry_write(heartbeat, job_ids)
+            except DatabaseError as e:
+                logger.error(f"Heartbeat of the summary jobs {job_ids} failed: {e!r}")
+
+    def _requeue_stale(self):
+        try:
+            requeued = retry_write(requeue_stale)
+        except DatabaseError as e:
+            logger.error(f"Sweep of the stale summary jobs failed: {e!r}")
+            return
+        if requeued:
+            logger.warning(f"{requeued} summary jobs left running were queued again or failed")
+
+    def _work(self, worker_id, once):
+        try:
+            while not self.stopping.is_set():
+                try:
+                    job = claim(worker_id)
+                except DatabaseError as e:
+                    # e.g. the database is locked by another process: try again later
+                    logger.warning(f"Claim of a summary job failed: {e!r}")
+                    self.stopping.wait(self.poll_interval)
+                    continue
+                if job is None:
+                    if once:
+                        return
+                    self.stopping.wait(self.poll_interval)
+                    continue
+                self._run_job(job)
+        finally:
+            # Each worker thread has its own database connection
+            connection.close()
+
+    def _run_job(self, job):
+        with self.lock:
+            self.running.add(job.id)
+        try:
+            thread_summary_id = self.summarize(job.thread_id, job.force_refresh)
+            error = None
+        except Exception as e:
+            logger.error(f"Summary job {job.id} of thread {job.thread_id} failed (attempt {job.attempts}): {e!r}")
+            error = e
+        try:
+            if error is None:
+                retry_write(complete, job, thread_summary_id)
+            else:
+                retry_write(fail, job, error)
+        except DatabaseError as e:
+            # The job stays running without heartbeat, so it is queued again after STALE_AFTER
+            logger.error(f"Status of the summary job {job.id} could not be saved: {e!r}")
+        finally:
+            with self.lock:
+                self.running.discard(job.id)
+                if error is None:
+                    self.done_count += 1
+                else:
+                    self.failed_count += 1
+        if self.on_done:
+            self.on_done(job, error)
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+This module summarizes many threads in one run, for the --worker mode of the thread_summary command.
+Up to `concurrency` threads go through the LangGraph pipeline at the same time: most of the time of a
+summary is spent waiting for Ollama, which can serve several requests in parallel (OLLAMA_NUM_PARALLEL).
+Each summary is committed by the pipeline as soon as it completes, and the progress is checkpointed
+in a SystemParameter so an interrupted run is reported when the next one resumes.
+
+The summaries can also be run by the async graph in one thread (arun): the database access is serialized
+in the thread of sync_to_async, and only the requests to Ollama are in flight at the same time.
+"""
+import asyncio
+import json
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from asgiref.sync import sync_to_async
+from django.db import connection
+from core.models import SystemParameter, Thread
+
+logger = logging.getLogger(__name__)
+
+# Number of threads summarized at the same time
+DEFAULT_CONCURRENCY = 2
+
+CHECKPOINT_KEY = 'summary_checkpoint'
+
+def pending_threads():
+    """Threads to summarize: the last email has the CATEGORY_PERSONAL label but not the Calendar label,
+    and it is not already attached to a thread summary"""
+    return Thread.objects.filter(
+            last_email__labels__name="CATEGORY_PERSONAL"
+    ).exclude(
+            last_email__labels__name="Calendar"
+    ).filter(
+            last_email__threadsummary__isnull=True
+    ).distinct() # type: ignore[attr-defined]
+
+def summarize_thread(thread_id, force_refresh=False):
+    """Run the LangGraph pipeline on a thread, which saves its ThreadSummary
+    (or reuses the cached one, unless force_refresh). Returns the summary data"""
+    from core.llm import get_langgraph_helper
+    thread = Thread.objects.get(id=thread_id)
+    result = get_langgraph_helper().invoke({"thread": thread, "force_refresh": force_refresh})
+    return result["thread_summary"]
+
+async def asummarize_thread(thread_id, force_refresh=False):
+    """Same as summarize_thread, with the async graph"""
+    from core.llm import get_async_langgraph_helper
+    thread = await Thread.objects.aget(id=thread_id)
+    result = await get_async_langgraph_helper().ainvoke({"thread": thread, "force_refresh": force_refresh})
+    return result["thread_summary"]
+
+def percentile(values, fraction):
+    """Return the value below which `fraction` of the values fall (nearest rank), None if there are none"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+class SummaryWorker:
+    """Summarize a list of threads with up to `concurrency` of them in progress at once.
+
+    Usage:
+        worker = SummaryWorker(concurrency=4)
+        worker.run(pending_threads().values_list('id', flat=True))
+        print(worker.stats)
+
+    stop() (e.g. from a SIGTERM handler) lets the summaries in progress complete, and starts no other one.
+    A thread whose summary fails is recorded in the checkpoint and skipped by the next runs,
+    until they are started with retry_failed.
+    """
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, summarize=summarize_thread, on_done=None):
+        self.concurrency = max(1, concurrency)
+        # A coroutine function for arun
+        self.summarize = summarize
+        # Called in the calling thread with (thread id, summary data or None, exception or None, seconds)
+        self.on_done = on_done
+        self.stopping = threading.Event()
+        self.latencies = []
+        self.failed_ids = set()
+        self.summarized_count = 0
+        self.previous_count = 0
+        self.elapsed = 0.0
+
+    def stop(self):
+        self.stopping.set()
+
+    def run(self, thread_ids, retry_failed=False):
+        """Summarize the threads, then remove the checkpoint if they were all processed"""
+        pending = self._start(thread_ids, retry_failed)
+
+        start = time.perf_counter()
+        in_progress = {}
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='summary') as executor:
+            while in_progress or (pending and not self.stopping.is_set()):
+                while pending and len(in_progress) < self.concurrency and not self.stopping.is_set():
+                    thread_id = pending.pop(0)
+                    in_progress[executor.submit(self._summarize, thread_id)] = thread_id
+                done, _ = wait(in_progress, return_when=FIRST_COMPLETED)
+                for future in done:
+                    self._done(in_progress.pop(future), *future.result())
+        self.elapsed = time.perf_counter() - start
+
+        return self._finish(pending)
+
+    async def arun(self, thread_ids, retry_failed=False):
+        """Same as run, with up to `concurrency` coroutines (e.g. asummarize_thread) in progress"""
+        pending = await sync_to_async(self._start)(thread_ids, retry_failed)
+
+        start = time.perf_counter()
+        in_progress = {}
+        while in_progress or (pending and not self.stopping.is_set()):
+            while pending and len(in_progress) < self.concurrency and not self.stopping.is_set():
+                thread_id = pending.pop(0)
+                in_progress[asyncio.ensure_future(self._asummarize(thread_id))] = thread_id
+            done, _ = await asyncio.wait(in_progress, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                await sync_to_async(self._done)(in_progress.pop(task), *task.result())
+        self.elapsed = time.perf_counter() - start
+
+        return await sync_to_async(self._finish)(pending)
+
+    def _start(self, thread_ids, retry_failed):
+        """Return the threads to summarize, without the ones which failed in a previous run"""
+        checkpoint = self._load_checkpoint()
+        if checkpoint and not retry_failed:
+            self.failed_ids = set(checkpoint['failed'])
+            print(f"Resuming after {checkpoint['summarized']} summaries, skipping {len(self.failed_ids)} failed threads")
+        self.previous_count = checkpoint['summarized'] if checkpoint else 0
+        return [thread_id for thread_id in thread_ids if thread_id not in self.failed_ids]
+
+    def _done(self, thread_id, summary, error, seconds):
+        self.latencies.append(seconds)
+        if error is None:
+            self.summarized_count += 1
+        else:
+            self.failed_ids.add(thread_id)
+            logger.error(f"Summary of thread {thread_id} failed: {error!r}")
+        self._save_checkpoint(self.previous_count + self.summarized_count)
+        if self.on_done:
+            self.on_done(thread_id, summary, error, seconds)
+
+    def _finish(self, pending):
+        if not pending and not self.failed_ids:
+            SystemParameter.objects.filter(key=CHECKPOINT_KEY).delete()
+        return self.stats
+
+    def _summarize(self, thread_id):
+        start = time.perf_counter()
+        try:
+            return self.summarize(thread_id), None, time.perf_counter() - start
+        except Exception as e:
+            return None, e, time.perf_counter() - start
+        finally:
+            # Each worker thread has its own database connection
+            connection.close()
+
+    async def _asummarize(self, thread_id):
+        start = time.perf_counter()
+        try:
+            return await self.summarize(thread_id), None, time.perf_counter() - start
+        except Exception as e:
+            return None, e, time.perf_counter() - start
+
+    @property
+    def stats(self):
+        return {
+            'summarized': self.summarized_count,
+            'failed': len(self.failed_ids),
+            'threads_per_minute': self.summarized_count * 60 / self.elapsed if self.elapsed else 0.0,
+            'p50': percentile(self.latencies, 0.5),
+            'p95': percentile(self.latencies, 0.95),
+        }
+
+    def _load_checkpoint(self):
+        checkpoint_obj = SystemParameter.objects.filter(key=CHECKPOINT_KEY).first()
+        return json.loads(checkpoint_obj.value) if checkpoint_obj else None
+
+    def _save_checkpoint(self, summarized_count):
+        SystemParameter.objects.update_or_create(key=CHECKPOINT_KEY, defaults={"value": json.dumps({
+            'summarized': summarized_count,
+            'failed': sorted(self.failed_ids),
+        })})
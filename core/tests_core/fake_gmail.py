@@ -0,0 +1,287 @@
+"""
+A local fake of the Gmail REST API used by the test suite.
+
+It serves the handful of endpoints GmailHelper talks to (including the multipart
+batch endpoint) from in-memory data, so ingest code can be exercised and timed
+without network access or credentials.
+"""
+import base64
+import json
+import re
+import threading
+import time
+from email.parser import Parser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import httplib2
+from googleapiclient.discovery import build
+
+MESSAGE_PATH = re.compile(r'^/gmail/v1/users/me/messages/(?P<id>[^/?]+)$')
+THREAD_PATH = re.compile(r'^/gmail/v1/users/me/threads/(?P<id>[^/?]+)$')
+LABEL_PATH = re.compile(r'^/gmail/v1/users/me/labels/(?P<id>[^/?]+)$')
+MESSAGES_PATH = '/gmail/v1/users/me/messages'
+LABELS_PATH = '/gmail/v1/users/me/labels'
+PROFILE_PATH = '/gmail/v1/users/me/profile'
+HISTORY_PATH = '/gmail/v1/users/me/history'
+BATCH_PATH = '/batch/gmail/v1'
+
+
+def make_message(message_id, thread_id=None, subject="Subject", body="Body", sender="Sender <sender@example.com>",
+                 to="Receiver <receiver@example.com>", internal_date=1700000000000, label_ids=None):
+    """Build a Gmail API message resource with a single text/plain part."""
+    return {
+        'id': message_id,
+        'threadId': thread_id or message_id,
+        'labelIds': label_ids if label_ids is not None else ['INBOX'],
+        'snippet': body[:100],
+        'internalDate': str(internal_date),
+        'payload': {
+            'mimeType': 'text/plain',
+            'headers': [
+                {'name': 'From', 'value': sender},
+                {'name': 'To', 'value': to},
+                {'name': 'Subject', 'value': subject},
+                {'name': 'Date', 'value': 'Tue, 14 Nov 2023 22:13:20 +0000'},
+            ],
+            'body': {'data': base64.urlsafe_b64encode(body.encode('utf-8')).decode('ascii')},
+        },
+    }
+
+
+class FakeGmailServer:
+    """Serve Gmail API resources from memory on a local port.
+
+    Attributes:
+        messages (dict): message id -> message resource
+        labels (dict): label id -> label resource. Unknown ids are served as system labels named after their id,
+            and the label list holds these labels plus the ones used by the messages
+        history (list): history records, oldest first
+        history_id (int): current history id of the mailbox
+        oldest_history_id (int): history ids older than this one are answered with a 404
+        fail_in_batch (set): message ids that return a 500 when requested inside a batch
+        latency (float): seconds to wait before answering each HTTP request, to emulate the network
+        errors (list): (status, reason, retry after) answered, in order, to the next single GET requests
+        http_requests (int): number of HTTP requests received
+        batch_requests (int): number of batch HTTP requests received
+    """
+
+    def __init__(self, messages=None, latency=0.0):
+        self.messages = dict(messages or {})
+        self.labels = {}
+        self.history = []
+        self.history_id = 100
+        self.oldest_history_id = 0
+        self.page_size = 100
+        self.fail_in_batch = set()
+        self.errors = []
+        self.latency = latency
+        self.http_requests = 0
+        self.batch_requests = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler_class())
+        self._thread = None
+
+    @property
+    def root_url(self):
+        host, port = self._server.server_address
+        return f'http://{host}:{port}/'
+
+    @property
+    def batch_uri(self):
+        return self.root_url.rstrip('/') + BATCH_PATH
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def build_service(self):
+        """Return a googleapiclient Gmail service pointed at this server."""
+        return build('gmail', 'v1', http=httplib2.Http(), static_discovery=True,
+                     client_options={'api_endpoint': self.root_url})
+
+    def helper(self, scheduler=None):
+        """Return a GmailHelper wired to this server.
+        Unless a scheduler is given, requests are not throttled, as the fake server has no quota."""
+        from core.gmail_helper import GmailHelper, RequestScheduler
+        scheduler = scheduler or RequestScheduler(units_per_second=10**9, burst=10**9)
+        return GmailHelper(service=self.build_service(), batch_uri=self.batch_uri, service_factory=self.build_service,
+                           scheduler=scheduler)
+
+    def record_history(self, messages_added=(), labels_added=(), labels_removed=(), messages_deleted=()):
+        """Apply changes to the mailbox and record them as one history record.
+
+        Args:
+            messages_added (iterable): message resources added to the mailbox
+            messages_deleted (iterable): ids of the messages deleted from the mailbox
+            labels_added (iterable): (message id, label ids) tuples
+            labels_removed (iterable): (message id, label ids) tuples
+        """
+        self.history_id += 1
+        record = {'id': str(self.history_id)}
+        if messages_added:
+            for message in messages_added:
+                self.messages[message['id']] = message
+            record['messagesAdded'] = [{'message': self._stub(m['id'])} for m in messages_added]
+        if labels_added:
+            for message_id, label_ids in labels_added:
+                self.messages[message_id]['labelIds'] += [l for l in label_ids if l not in self.messages[message_id]['labelIds']]
+            record['labelsAdded'] = [{'message': self._stub(m), 'labelIds': l} for m, l in labels_added]
+        if labels_removed:
+            for message_id, label_ids in labels_removed:
+                self.messages[message_id]['labelIds'] = [l for l in self.messages[message_id]['labelIds'] if l not in label_ids]
+            record['labelsRemoved'] = [{'message': self._stub(m), 'labelIds': l} for m, l in labels_removed]
+        if messages_deleted:
+            record['messagesDeleted'] = [{'message': self._stub(m)} for m in messages_deleted]
+            for message_id in messages_deleted:
+                del self.messages[message_id]
+        self.history.append(record)
+
+    def _stub(self, message_id):
+        message = self.messages[message_id]
+        return {'id': message_id, 'threadId': message['threadId'], 'labelIds': list(message['labelIds'])}
+
+    def route(self, method, path, in_batch=False):
+        """Resolve one API call and return (status, payload)."""
+        not_found = 404, {'error': {'code': 404, 'message': 'Not Found'}}
+        if method != 'GET':
+            return not_found
+        parsed = urlparse(path)
+        query = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+
+        match = MESSAGE_PATH.match(parsed.path)
+        if match:
+            message_id = match.group('id')
+            if in_batch and message_id in self.fail_in_batch:
+                return 500, {'error': {'code': 500, 'message': 'Backend Error'}}
+            if message_id not in self.messages:
+                return not_found
+            return 200, self.messages[message_id]
+
+        match = THREAD_PATH.match(parsed.path)
+        if match:
+            thread_id = match.group('id')
+            messages = [m for m in self.messages.values() if m['threadId'] == thread_id]
+            if not messages:
+                return not_found
+            messages.sort(key=lambda m: int(m['internalDate']))
+            if query.get('format') == 'minimal':
+                messages = [{**self._stub(m['id']), 'internalDate': m['internalDate']} for m in messages]
+            return 200, {'id': thread_id, 'messages': messages}
+
+        match = LABEL_PATH.match(parsed.path)
+        if match:
+            label_id = match.group('id')
+            return 200, self.labels.get(label_id, {'id': label_id, 'name': label_id, 'type': 'system'})
+
+        if parsed.path == LABELS_PATH:
+            label_ids = set(self.labels) | {l for m in self.messages.values() for l in m.get('labelIds', [])}
+            return 200, {'labels': [self.labels.get(l, {'id': l, 'name': l, 'type': 'system'}) for l in sorted(label_ids)]}
+
+        if parsed.path == MESSAGES_PATH:
+            # Only the after: search operator is supported, newest messages first
+            after = int(query.get('q', 'after:0').split(':')[1])
+            messages = [m for m in self.messages.values() if int(m['internalDate']) // 1000 > after]
+            messages.sort(key=lambda m: int(m['internalDate']), reverse=True)
+            page_size = int(query.get('maxResults', 100))
+            offset = int(query.get('pageToken', 0))
+            result = {'messages': [{'id': m['id'], 'threadId': m['threadId']} for m in messages[offset:offset + page_size]]}
+            if offset + page_size < len(messages):
+                result['nextPageToken'] = str(offset + page_size)
+            return 200, result
+
+        if parsed.path == PROFILE_PATH:
+            return 200, {'emailAddress': 'me@example.com', 'historyId': str(self.history_id)}
+
+        if parsed.path == HISTORY_PATH:
+            start = int(query['startHistoryId'])
+            if start < self.oldest_history_id:
+                return not_found
+            records = [r for r in self.history if int(r['id']) > start]
+            offset = int(query.get('pageToken', 0))
+            page = records[offset:offset + self.page_size]
+            result = {'history': page, 'historyId': str(self.history_id)}
+            if offset + self.page_size < len(records):
+                result['nextPageToken'] = str(offset + self.page_size)
+            return 200, result
+
+        return not_found
+
+    def handle_batch(self, content_type, body):
+        """Split a multipart/mixed batch body and answer every part."""
+        with self._lock:
+            self.batch_requests += 1
+        envelope = Parser().parsestr(f'Content-Type: {content_type}\r\n\r\n{body}')
+        boundary = 'batch_fake_gmail_boundary'
+        chunks = []
+        for part in envelope.get_payload():
+            request_line = part.get_payload().splitlines()[0]
+            method, path, _ = request_line.split(' ', 2)
+            status, payload = self.route(method, path, in_batch=True)
+            content_id = part['Content-ID'].strip('<>')
+            chunks.append(
+                f'--{boundary}\r\n'
+                'Content-Type: application/http\r\n'
+                f'Content-ID: <response-{content_id}>\r\n\r\n'
+                f'HTTP/1.1 {status} {"OK" if status < 300 else "Error"}\r\n'
+                'Content-Type: application/json; charset=UTF-8\r\n\r\n'
+                f'{json.dumps(payload)}\r\n'
+            )
+        chunks.append(f'--{boundary}--\r\n')
+        return f'multipart/mixed; boundary={boundary}', ''.join(chunks).encode('utf-8')
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, content_type, body, headers=None):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                with fake._lock:
+                    fake.http_requests += 1
+                time.sleep(fake.latency)
+                with fake._lock:
+                    error = fake.errors.pop(0) if fake.errors else None
+                if error:
+                    status, reason, retry_after = error
+                    payload = {'error': {'code': status, 'message': reason, 'errors': [{'reason': reason}]}}
+                    headers = {'Retry-After': str(retry_after)} if retry_after is not None else {}
+                    self._send(status, 'application/json', json.dumps(payload).encode('utf-8'), headers)
+                    return
+                status, payload = fake.route('GET', self.path)
+                self._send(status, 'application/json', json.dumps(payload).encode('utf-8'))
+
+            def do_POST(self):
+                with fake._lock:
+                    fake.http_requests += 1
+                time.sleep(fake.latency)
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length).decode('utf-8')
+                if urlparse(self.path).path != BATCH_PATH:
+                    self._send(404, 'application/json', b'{}')
+                    return
+                content_type, content = fake.handle_batch(self.headers['Content-Type'], body)
+                self._send(200, content_type, content)
+
+        return Handler
@@ -0,0 +1,83 @@
+import asyncio
+from unittest import mock
+from asgiref.sync import sync_to_async
+from django.test import TestCase, override_settings
+from core.llm.helper import build_async_graph
+from core.models import Contact, ThreadSummary
+from core.summary_worker import SummaryWorker
+from core.tests_core import test_map_reduce_summary, test_summary_cache
+
+class FakeAsyncSummaryChain(test_summary_cache.FakeSummaryChain):
+    """The fake summary chain, answering ainvoke after a short wait, recording how many prompts are in flight"""
+
+    def __init__(self):
+        super().__init__()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def ainvoke(self, prompt_input):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.02)
+        self.in_flight -= 1
+        return self.invoke(prompt_input)
+
+class AsyncGraphTest(TestCase):
+    create_thread = test_summary_cache.SummaryCacheTest.create_thread
+    create_email = test_summary_cache.SummaryCacheTest.create_email
+
+    def setUp(self):
+        test_summary_cache.SummaryCacheTest.setUp(self)
+        self.chain = FakeAsyncSummaryChain()
+        self.chain.alice_id = self.sender.contact_id
+
+    def llm_utils(self):
+        from core.utils import sanitize_json, llm
+        return mock.patch('core.llm.nodes.get_llm_utils',
+                          return_value=(sanitize_json, llm, self.chain, self.chain, lambda **kwargs: None))
+
+    async def test_summary_and_cache(self):
+        with self.llm_utils():
+            result = await build_async_graph().ainvoke({"thread": self.thread})
+            self.assertFalse(result["cached"])
+            self.assertEqual(result["thread_summary"]["summary"], "Alice asks for the budget")
+            self.assertEqual((await Contact.objects.aget(id=self.sender.contact_id)).knowledge, "Works on the budget")
+            self.assertTrue((await build_async_graph().ainvoke({"thread": self.thread}))["cached"])
+        self.assertEqual(self.chain.calls, 1)
+        self.assertEqual(await ThreadSummary.objects.acount(), 1)
+
+    @override_settings(SUMMARY_TOKEN_BUDGET=100, SUMMARY_CHUNK_TOKENS=400)
+    async def test_long_conversation(self):
+        for day in range(21, 24):
+            await sync_to_async(self.create_email)(self.thread, f"m{day}", "details " * 150, day=day)
+        chunk_chain = test_map_reduce_summary.FakeChunkSummaryChain()
+        with self.llm_utils(), mock.patch('core.llm.nodes.get_chunk_summary_chain', return_value=chunk_chain):
+            await build_async_graph().ainvoke({"thread": self.thread})
+        self.assertEqual(len(chunk_chain.batches[0][0]), 3)
+        self.assertIn("Part 1:", self.chain.prompt_inputs[-1]["conversation"])
+
+    async def test_summaries_in_flight_at_once(self):
+        threads = [self.thread] + [await sync_to_async(self.create_thread)(f"t{i}") for i in range(2, 4)]
+        graph = build_async_graph()
+        with self.llm_utils():
+            await asyncio.gather(*[graph.ainvoke({"thread": thread}) for thread in threads])
+        self.assertEqual(self.chain.max_in_flight, 3)
+        self.assertEqual(await ThreadSummary.objects.acount(), 3)
+
+    async def test_worker(self):
+        running, max_running = 0, 0
+
+        async def summarize(thread_id):
+            nonlocal running, max_running
+            running += 1
+            max_running = max(max_running, running)
+            await asyncio.sleep(0.02)
+            running -= 1
+            if thread_id == 3:
+                raise RuntimeError("Ollama is not responding")
+            return {"summary": f"Summary of {thread_id}"}
+
+        worker = SummaryWorker(concurrency=2, summarize=summarize)
+        stats = await worker.arun(range(1, 6))
+        self.assertEqual((stats['summarized'], stats['failed']), (4, 1))
+        self.assertEqual(max_running, 2)
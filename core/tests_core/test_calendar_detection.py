@@ -255,4 +255,43 @@ class CalendarInviteDetectionTest(TestCase):
                     result, 
                     test_case['expected'],
                     f"Test case '{test_case['name']}' failed. Expected {test_case['expected']}, got {result}"
-                ) 
\ No newline at end of file
+                ) 
+
+
+class CalendarPartDetectionTest(TestCase):
+    def test_text_calendar_part(self):
+        payload = {'mimeType': 'multipart/mixed', 'parts': [
+            {'mimeType': 'multipart/alternative', 'parts': [
+                {'mimeType': 'text/plain'},
+                {'mimeType': 'text/calendar'},
+            ]},
+        ]}
+        self.assertTrue(is_calendar_invite(subject="Lunch", body="See you there", payload=payload))
+
+    def test_ics_attachment(self):
+        payload = {'mimeType': 'multipart/mixed', 'parts': [
+            {'mimeType': 'text/plain'},
+            {'mimeType': 'application/octet-stream', 'filename': 'Invite.ICS'},
+        ]}
+        self.assertTrue(is_calendar_invite(subject="Lunch", body="See you there", payload=payload))
+
+    def test_other_attachment(self):
+        payload = {'mimeType': 'multipart/mixed', 'parts': [
+            {'mimeType': 'text/plain'},
+            {'mimeType': 'application/pdf', 'filename': 'report.pdf'},
+        ]}
+        self.assertFalse(is_calendar_invite(subject="Report", body="Attached", payload=payload))
+
+    def test_colon_indicators(self):
+        self.assertTrue(is_calendar_invite(subject="Sync", body="Where: Room 4\nWhen: 10:00"))
+        self.assertFalse(is_calendar_invite(subject="Sync", body="Meet at 10:00, see https://example.com"))
+
+    def test_batch(self):
+        from core.utils import classify_calendar_invites
+        emails = [
+            {'subject': "Accepted: Sync", 'body': ""},
+            {'subject': "Hello", 'body': "Just checking in"},
+            {'subject': "Hello", 'body': "", 'headers': [{'name': 'X-MICROSOFT-CDO-BUSYSTATUS', 'value': 'BUSY'}]},
+            {'subject': "Hello", 'body': "", 'payload': {'mimeType': 'text/calendar'}},
+        ]
+        self.assertEqual(classify_calendar_invites(emails), [True, False, True, True])
@@ -0,0 +1,100 @@
+from django.test import TestCase
+from core.models import Contact, EmailAddress, EmailString
+from core.utils import search_similar_contacts
+from core.utils.contact_index import contact_index, name_similarity, name_tokens, phonetic_key
+
+class NameSimilarityTest(TestCase):
+    def test_name_tokens(self):
+        self.assertEqual(name_tokens("José-María García Jr."), ('jose', 'maria', 'garcia'))
+        self.assertEqual(name_tokens("O'Brien, Pat"), ('o', 'brien', 'pat'))
+
+    def test_phonetic_key(self):
+        self.assertEqual(phonetic_key("john"), phonetic_key("jon"))
+        self.assertEqual(phonetic_key("stephen"), phonetic_key("steven"))
+        self.assertEqual(phonetic_key("smyth"), phonetic_key("smith"))
+        self.assertNotEqual(phonetic_key("jane"), phonetic_key("john"))
+
+    def test_name_similarity(self):
+        self.assertEqual(name_similarity(('john', 'smith'), ('smith', 'john')), 1.0)
+        self.assertGreater(name_similarity(('jon', 'smith'), ('jonathan', 'smith')), 0.85)
+        self.assertGreater(name_similarity(('j', 'smith'), ('john', 'smith')), 0.75)
+        self.assertLess(name_similarity(('john', 'smith'), ('john', 'william', 'smith')), 1.0)
+        self.assertEqual(name_similarity(('alice',), ('bob',)), 0.0)
+
+class ContactIndexTest(TestCase):
+    def setUp(self):
+        contact_index.clear()
+        self.john = Contact.objects.create(name="Jonathan Smith")
+        self.john.emails.add(EmailAddress.objects.create(email="jonathan.smith@acme.com"))
+        self.jane = Contact.objects.create(name="Jane Smith")
+        self.jane.emails.add(EmailAddress.objects.create(email="jane@gmail.com"))
+
+    def test_candidates(self):
+        candidates = contact_index.candidates("Jon Smyth")
+        self.assertEqual(candidates[0][0], self.john.id)
+        self.assertEqual([contact_id for contact_id, score in contact_index.candidates("Alice Martin")], [])
+
+    def test_email_evidence(self):
+        by_name = dict(contact_index.candidates("J Smith"))
+        self.assertEqual(by_name[self.john.id], by_name[self.jane.id])
+        by_email = dict(contact_index.candidates("J Smith", "jonathan.smith@other.org"))
+        self.assertGreater(by_email[self.john.id], by_email[self.jane.id])
+
+    def test_kept_in_sync_by_the_signals(self):
+        contact_index.refresh()
+        alice = Contact.objects.create(name="Alice Martin")
+        self.assertEqual(contact_index.candidates("alice martin")[0][0], alice.id)
+
+        alice.emails.add(EmailAddress.objects.create(email="alice@acme.com"))
+        self.assertIn("alice@acme.com", contact_index.emails[alice.id])
+        alice.emails.clear()
+        self.assertNotIn("alice@acme.com", contact_index.emails[alice.id])
+
+        alice.name = "Alice Durand"
+        alice.save()
+        self.assertEqual(contact_index.candidates("Alice Martin")[0][1], 0.5)
+
+        alice.delete()
+        self.assertEqual(contact_index.candidates("Alice Durand"), [])
+
+    def test_search_checks_the_database(self):
+        contact_index.refresh()
+        # Changes which send no signal
+        Contact.objects.filter(id=self.jane.id).update(name="Jane Doe")
+        Contact.objects.filter(id=self.john.id).delete()
+        self.assertEqual(list(Contact.objects.search_similar_names("Jane Doe")), [self.jane])
+        self.assertEqual(list(Contact.objects.search_similar_names("Jonathan Smith")), [])
+
+class SearchSimilarContactsTest(TestCase):
+    def setUp(self):
+        contact_index.clear()
+        self.john = Contact.objects.create(name="Jonathan Smith")
+        self.john.emails.add(EmailAddress.objects.create(email="jonathan.smith@acme.com"))
+
+    def test_same_name(self):
+        self.assertEqual(search_similar_contacts("jonathan smith", "js@example.com"), self.john)
+        other = Contact.objects.create(name="Jonathan Smith")
+        self.assertIsNone(search_similar_contacts("Jonathan Smith", "js@example.com"))
+        self.assertEqual(search_similar_contacts("Jonathan Smith", "jonathan.smith@acme.com"), self.john)
+        other.emails.add(EmailAddress.objects.create(email="js@example.com"))
+        self.assertEqual(search_similar_contacts("Jonathan Smith", "js@example.com"), other)
+
+    def test_same_name_created_by_another_process(self):
+        contact_index.refresh()
+        # bulk_create sends no signal, like a contact created by another process before the next refresh
+        jane, = Contact.objects.bulk_create([Contact(name="Jane Doe")])
+        self.assertEqual(search_similar_contacts("Jane Doe", "jane@example.com"), jane)
+
+    def test_similar_name_needs_email_evidence(self):
+        self.assertIsNone(search_similar_contacts("Jon Smith", "jon@gmail.com"))
+        self.assertEqual(search_similar_contacts("Jon Smith", "jon@acme.com"), self.john)
+        self.assertEqual(search_similar_contacts("J. Smith", "jonathan.smith@acme.com"), self.john)
+
+    def test_similar_name_must_be_unambiguous(self):
+        Contact.objects.create(name="Jonathan Smyth").emails.add(EmailAddress.objects.create(email="jsmyth@acme.com"))
+        self.assertIsNone(search_similar_contacts("Jon Smith", "jon@acme.com"))
+
+    def test_email_string_is_linked_to_the_similar_contact(self):
+        email_string = EmailString.objects.create(original_string="Jon Smith <jon@acme.com>")
+        self.assertEqual(email_string.contact, self.john)
+        self.assertIn("jon@acme.com", contact_index.emails[self.john.id])
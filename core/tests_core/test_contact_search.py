@@ -1,11 +1,13 @@
 from django.test import TestCase, Client
 from django.urls import reverse
 from core.models import Contact, EmailAddress
+from core.utils.contact_index import contact_index
 import json
 
 class ContactSearchTests(TestCase):
     def setUp(self):
         """Set up test data"""
+        contact_index.clear()
         # Create test contacts
         self.contact1 = Contact.objects.create(name="Raphael Smith")
         self.contact2 = Contact.objects.create(name="John Doe")
@@ -44,4 +46,12 @@ class ContactSearchTests(TestCase):
         
         data = json.loads(response.content)
         self.assertIn('results', data)
-        self.assertEqual(len(data['results']), 0) 
\ No newline at end of file
+        self.assertEqual(len(data['results']), 0)
+
+    def test_search_contacts_similar_names(self):
+        """Test that the contact review search (q parameter) also finds similar names"""
+        response = self.client.get('/contact-review/search-contacts/?q=Jon%20Do')
+        self.assertEqual(response.status_code, 200)
+
+        data = json.loads(response.content)
+        self.assertEqual(data['results'][0]['name'], 'John Doe')
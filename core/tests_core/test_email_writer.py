@@ -0,0 +1,85 @@
+from django.test import TestCase
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from core.email_writer import EmailBatchWriter
+from core.models import Email, EmailString, Label, Thread
+from core.tests_core.fake_gmail import FakeGmailServer, make_message
+
+def parsed_message(message_id, thread_id, **kwargs):
+    """A message as returned by GmailHelper, with the headers and body extracted"""
+    message = make_message(message_id, thread_id=thread_id, **kwargs)
+    headers = {h['name']: h['value'] for h in message['payload']['headers']}
+    message.update(headers)
+    message['Body'] = kwargs.get('body', "Body")
+    return message
+
+class EmailBatchWriterTest(TestCase):
+    def setUp(self):
+        self.server = FakeGmailServer().start()
+        self.writer = EmailBatchWriter(self.server.helper(), chunk_size=10)
+        self.thread = Thread.objects.create(gmail_thread_id="t1")
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_emails_and_relations_are_stored(self):
+        self.writer.add(parsed_message("m1", "t1", to="A <a@x.com>, B <b@x.com>", label_ids=["INBOX", "UNREAD"],
+                                       internal_date=1700000000000), self.thread)
+        self.writer.add(parsed_message("m2", "t1", to="A <a@x.com>", internal_date=1700000001000), self.thread)
+        self.writer.flush()
+
+        self.assertEqual(Email.objects.count(), 2)
+        email = Email.objects.get(gmail_message_id="m1")
+        self.assertEqual(email.sender_str.original_string, "Sender <sender@example.com>")
+        self.assertEqual(sorted(email.to_str.values_list('original_string', flat=True)), ["A <a@x.com>", "B <b@x.com>"])
+        self.assertEqual(sorted(email.labels.values_list('gmail_label_id', flat=True)), ["INBOX", "UNREAD"])
+        self.assertEqual(EmailString.objects.count(), 3)
+        self.thread.refresh_from_db()
+        self.assertEqual(self.thread.last_email.gmail_message_id, "m2")
+
+    def test_quoted_names_with_commas(self):
+        self.writer.add(parsed_message("m1", "t1", to='"Doe, John" <john@x.com>, B <b@x.com>'), self.thread)
+        self.writer.flush()
+
+        email = Email.objects.get(gmail_message_id="m1")
+        self.assertEqual(sorted(email.to_str.values_list('original_string', flat=True)), ['"Doe, John" <john@x.com>', "B <b@x.com>"])
+        self.assertEqual(EmailString.objects.get(original_string='"Doe, John" <john@x.com>').name, "Doe, John")
+
+    def test_last_email_only_moves_forward(self):
+        self.writer.add(parsed_message("m2", "t1", internal_date=1700000001000), self.thread)
+        self.writer.flush()
+        self.writer.add(parsed_message("m1", "t1", internal_date=1700000000000), self.thread)
+        self.writer.flush()
+        self.thread.refresh_from_db()
+        self.assertEqual(self.thread.last_email.gmail_message_id, "m2")
+
+    def test_calendar_invites_get_the_calendar_label(self):
+        self.writer.add(parsed_message("m1", "t1", subject="Accepted: Weekly"), self.thread)
+        self.writer.flush()
+        self.assertTrue(Email.objects.get(gmail_message_id="m1").labels.filter(name="Calendar").exists())
+
+    def test_writing_twice_is_harmless(self):
+        message = parsed_message("m1", "t1", to="A <a@x.com>")
+        self.writer.add(message, self.thread)
+        self.writer.flush()
+        self.writer.add(message, self.thread)
+        self.writer.flush()
+        self.assertEqual(Email.objects.count(), 1)
+        self.assertEqual(Email.objects.get().to_str.count(), 1)
+
+    def test_chunks_are_written_when_full(self):
+        for i in range(25):
+            self.writer.add(parsed_message(f"m{i}", "t1"), self.thread)
+        self.assertEqual(Email.objects.count(), 20)
+        self.writer.flush()
+        self.assertEqual(Email.objects.count(), 25)
+
+    def test_query_count_does_not_grow_with_the_chunk(self):
+        # known strings and labels
+        self.writer.add(parsed_message("m0", "t1", to="A <a@x.com>, B <b@x.com>"), self.thread)
+        self.writer.flush()
+        for i in range(1, 10):
+            self.writer.add(parsed_message(f"m{i}", "t1", to="A <a@x.com>, B <b@x.com>"), self.thread)
+        with CaptureQueriesContext(connection) as queries:
+            self.writer.flush()
+        self.assertLess(len(queries), 15)
@@ -0,0 +1,52 @@
+from django.test import TestCase
+from core.tests_core.fake_gmail import FakeGmailServer, make_message
+
+class GmailBatchFetchTest(TestCase):
+    def setUp(self):
+        messages = {f"m{i:04d}": make_message(f"m{i:04d}", subject=f"Subject {i}", body=f"Body {i}") for i in range(250)}
+        self.server = FakeGmailServer(messages).start()
+        self.helper = self.server.helper()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_results_are_in_input_order(self):
+        ids = ["m0042", "m0007", "m0199", "m0001"]
+        emails = self.helper.fetch_emails(ids)
+        self.assertEqual([e['id'] for e in emails], ids)
+        self.assertEqual(emails[0]['Subject'], "Subject 42")
+        self.assertEqual(emails[0]['Body'], "Body 42")
+
+    def test_requests_are_grouped_up_to_the_batch_limit(self):
+        ids = sorted(self.server.messages)
+        emails = self.helper.fetch_emails(ids)
+        self.assertEqual(len(emails), 250)
+        # 250 messages fit in 3 batches of at most 100 calls
+        self.assertEqual(self.server.batch_requests, 3)
+        self.assertEqual(self.server.http_requests, 3)
+
+    def test_smaller_batch_size(self):
+        self.helper.fetch_emails(["m0001", "m0002", "m0003", "m0004", "m0005"], batch_size=2)
+        self.assertEqual(self.server.batch_requests, 3)
+
+    def test_failed_sub_requests_are_retried_individually(self):
+        self.server.fail_in_batch = {"m0003", "m0005"}
+        ids = ["m0001", "m0003", "m0004", "m0005"]
+        emails = self.helper.fetch_emails(ids)
+        self.assertEqual([e['id'] for e in emails], ids)
+        # one batch plus one single request per failed message
+        self.assertEqual(self.server.batch_requests, 1)
+        self.assertEqual(self.server.http_requests, 3)
+
+    def test_deleted_messages_are_skipped(self):
+        del self.server.messages["m0003"]
+        emails = self.helper.fetch_emails(["m0001", "m0003", "m0004"])
+        self.assertEqual([e['id'] for e in emails], ["m0001", "m0004"])
+
+    def test_duplicated_ids(self):
+        emails = self.helper.fetch_emails(["m0001", "m0002", "m0001"])
+        self.assertEqual([e['id'] for e in emails], ["m0001", "m0002", "m0001"])
+
+    def test_empty_list(self):
+        self.assertEqual(self.helper.fetch_emails([]), [])
+        self.assertEqual(self.server.http_requests, 0)
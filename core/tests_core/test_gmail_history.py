@@ -0,0 +1,152 @@
+import time
+from io import StringIO
+from unittest import mock
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from core.gmail_helper import HistoryExpiredError
+from core.models import Email, Label, SystemParameter, Thread
+from core.tests_core.fake_gmail import FakeGmailServer, make_message
+
+class GmailHistoryTest(TestCase):
+    def setUp(self):
+        self.server = FakeGmailServer({
+            "m1": make_message("m1", thread_id="t1"),
+            "m2": make_message("m2", thread_id="t2"),
+        }).start()
+        self.helper = self.server.helper()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_get_history_id(self):
+        self.assertEqual(self.helper.get_history_id(), "100")
+
+    def test_no_changes(self):
+        history_id, added, label_changes = self.helper.fetch_history("100")
+        self.assertEqual(history_id, "100")
+        self.assertEqual(added, [])
+        self.assertEqual(label_changes, [])
+
+    def test_added_messages_and_label_changes(self):
+        self.server.record_history(messages_added=[make_message("m3", thread_id="t1")])
+        self.server.record_history(labels_added=[("m1", ["STARRED"])])
+        self.server.record_history(labels_removed=[("m2", ["INBOX"])], labels_added=[("m3", ["IMPORTANT"])])
+
+        history_id, added, label_changes = self.helper.fetch_history("100")
+        self.assertEqual(history_id, "103")
+        self.assertEqual(added, [{'id': "m3", 'threadId': "t1"}])
+        self.assertEqual(label_changes, [
+            ("m1", ["STARRED"], []),
+            ("m3", ["IMPORTANT"], []),
+            ("m2", [], ["INBOX"]),
+        ])
+
+    def test_only_changes_after_start_history_id(self):
+        self.server.record_history(labels_added=[("m1", ["STARRED"])])
+        self.server.record_history(labels_added=[("m2", ["STARRED"])])
+        history_id, added, label_changes = self.helper.fetch_history("101")
+        self.assertEqual(label_changes, [("m2", ["STARRED"], [])])
+
+    def test_pages_are_followed(self):
+        self.server.page_size = 2
+        for i in range(5):
+            self.server.record_history(messages_added=[make_message(f"n{i}")])
+        history_id, added, label_changes = self.helper.fetch_history("100")
+        self.assertEqual([m['id'] for m in added], ["n0", "n1", "n2", "n3", "n4"])
+        self.assertEqual(history_id, "105")
+
+    def test_expired_history_id(self):
+        self.server.oldest_history_id = 50
+        with self.assertRaises(HistoryExpiredError):
+            self.helper.fetch_history("10")
+
+    def test_deleted_and_excluded_messages(self):
+        # A draft autosave adds a message then deletes it
+        self.server.record_history(messages_added=[make_message("d1", thread_id="t1", label_ids=["DRAFT"])])
+        self.server.record_history(messages_deleted=["d1"])
+        self.server.record_history(messages_added=[make_message("m3", thread_id="t1")])
+        self.server.record_history(messages_deleted=["m3"])
+        self.server.record_history(messages_added=[make_message("s1", label_ids=["SPAM"]), make_message("m4", thread_id="t2")])
+        history_id, added, label_changes = self.helper.fetch_history("100")
+        self.assertEqual(added, [{'id': "m4", 'threadId': "t2"}])
+
+
+@override_settings(HTML_CONVERSION_CACHE_FILE=None)
+class FetchEmailHistorySyncTest(TestCase):
+    def setUp(self):
+        self.server = FakeGmailServer({"m1": make_message("m1", thread_id="t1")}).start()
+        self.helper = self.server.helper()
+        Thread.objects.create(gmail_thread_id="t1")
+        SystemParameter.objects.create(key="last_history_id", value="100")
+
+    def tearDown(self):
+        self.server.stop()
+
+    def sync(self, *args):
+        with mock.patch('core.management.commands.fetch_email.get_gmail_helper', return_value=self.helper):
+            call_command('fetch_email', '--no-archive', *args, stdout=StringIO())
+
+    def labels(self, gmail_message_id):
+        return sorted(Email.objects.get(gmail_message_id=gmail_message_id).labels.values_list('gmail_label_id', flat=True))
+
+    def test_message_deleted_before_it_is_fetched(self):
+        self.server.record_history(messages_added=[make_message("m2", thread_id="t1")])
+        self.server.record_history(messages_added=[make_message("m3", thread_id="t1")])
+        # Deleted after the history was read: Gmail answers 404 to messages.get
+        self.server.record_history(messages_added=[make_message("m4", thread_id="t1")])
+        del self.server.messages["m3"]
+        self.sync()
+        self.assertEqual(sorted(Email.objects.values_list('gmail_message_id', flat=True)), ["m2", "m4"])
+        self.assertEqual(SystemParameter.objects.get(key="last_history_id").value, "103")
+
+    def test_message_deleted_before_it_is_fetched_without_batch(self):
+        self.server.record_history(messages_added=[make_message("m2", thread_id="t1")])
+        del self.server.messages["m2"]
+        self.sync('--no-batch')
+        self.assertEqual(Email.objects.count(), 0)
+        self.assertEqual(SystemParameter.objects.get(key="last_history_id").value, "101")
+
+    def test_added_then_deleted_message(self):
+        self.server.record_history(messages_added=[make_message("d1", thread_id="t1")])
+        self.server.record_history(messages_deleted=["d1"])
+        self.sync()
+        self.assertEqual(Email.objects.count(), 0)
+        self.assertEqual(SystemParameter.objects.get(key="last_history_id").value, "102")
+
+    def test_label_changes(self):
+        self.server.record_history(messages_added=[make_message("m2", thread_id="t1", label_ids=["INBOX", "UNREAD"])])
+        self.sync()
+        self.assertEqual(self.labels("m2"), ["INBOX", "UNREAD"])
+
+        self.server.labels["Label_7"] = {'id': "Label_7", 'name': "Projects", 'type': "user"}
+        self.server.record_history(labels_added=[("m2", ["Label_7"])], labels_removed=[("m2", ["UNREAD"])])
+        self.server.record_history(labels_removed=[("m2", ["INBOX"])])
+        with mock.patch.object(self.helper, 'fetch_label', wraps=self.helper.fetch_label) as fetch_label:
+            self.sync()
+        self.assertEqual(self.labels("m2"), ["Label_7"])
+        # The label unknown to the database is created from the Gmail label
+        fetch_label.assert_any_call("Label_7")
+        self.assertEqual(Label.objects.get(gmail_label_id="Label_7").name, "Projects")
+        self.assertEqual(SystemParameter.objects.get(key="last_history_id").value, "103")
+
+    def test_label_changes_of_messages_fetched_in_the_same_run(self):
+        self.server.record_history(messages_added=[make_message("m2", thread_id="t1")])
+        self.server.record_history(labels_added=[("m2", ["STARRED"])])
+        self.server.record_history(labels_removed=[("m2", ["INBOX"])])
+        # The message is fetched with its current labels, the changes are not applied to it again
+        with mock.patch('core.management.commands.fetch_email._get_label') as get_label:
+            self.sync()
+        get_label.assert_not_called()
+        self.assertEqual(self.labels("m2"), ["STARRED"])
+
+    def test_expired_history_falls_back_to_a_search(self):
+        now = int(time.time())
+        self.server.record_history(messages_added=[make_message("m2", thread_id="t1", internal_date=now * 1000)])
+        self.server.record_history(labels_added=[("m1", ["STARRED"])])
+        # Only found by the search: not in the history
+        self.server.messages["m3"] = make_message("m3", thread_id="t1", internal_date=now * 1000)
+        # Gmail no longer has the history since the stored id
+        self.server.oldest_history_id = 102
+        self.sync()
+        self.assertEqual(sorted(Email.objects.values_list('gmail_message_id', flat=True)), ["m2", "m3"])
+        self.assertEqual(SystemParameter.objects.get(key="last_history_id").value, "102")
@@ -0,0 +1,40 @@
+from django.test import TestCase
+from core.identity_resolver import reconcile_labels
+from core.models import Label
+from core.tests_core.fake_gmail import FakeGmailServer, make_message
+
+class GmailLabelCatalogueTest(TestCase):
+    def setUp(self):
+        self.server = FakeGmailServer({"m1": make_message("m1", label_ids=["INBOX", "UNREAD"])}).start()
+        self.server.labels["Label_1"] = {'id': "Label_1", 'name': "Work", 'type': 'user'}
+        self.helper = self.server.helper()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_catalogue_is_loaded_with_one_call(self):
+        self.assertEqual(self.helper.fetch_label("INBOX")['name'], "INBOX")
+        self.assertEqual(self.helper.fetch_label("Label_1")['name'], "Work")
+        self.assertEqual(self.helper.fetch_label("UNREAD")['name'], "UNREAD")
+        self.assertEqual(self.server.http_requests, 1)
+
+    def test_unknown_label_reloads_the_catalogue(self):
+        self.helper.fetch_labels()
+        self.server.labels["Label_2"] = {'id': "Label_2", 'name': "Travel", 'type': 'user'}
+        self.assertEqual(self.helper.fetch_label("Label_2")['name'], "Travel")
+        self.assertEqual(self.helper.fetch_label("Label_1")['name'], "Work")
+        self.assertEqual(self.server.http_requests, 2)
+
+    def test_reconcile_labels(self):
+        Label.objects.create(gmail_label_id="Label_1", name="Old name")
+        calendar = Label.objects.create(gmail_label_id="CALENDAR", name="Calendar")
+        self.assertEqual(reconcile_labels(self.helper.fetch_labels()), (2, 1))
+        self.assertEqual(dict(Label.objects.values_list('gmail_label_id', 'name')), {
+            "CALENDAR": "Calendar",
+            "INBOX": "INBOX",
+            "Label_1": "Work",
+            "UNREAD": "UNREAD",
+        })
+        self.assertEqual(reconcile_labels(self.helper.fetch_labels()), (0, 0))
+        calendar.refresh_from_db()
+        self.assertEqual(calendar.name, "Calendar")
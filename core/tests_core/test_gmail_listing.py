@@ -0,0 +1,39 @@
+from django.test import TestCase
+from core.tests_core.fake_gmail import FakeGmailServer, make_message
+
+class GmailListingTest(TestCase):
+    def setUp(self):
+        messages = {f"m{i:03d}": make_message(f"m{i:03d}", internal_date=(1700000000 + i) * 1000) for i in range(250)}
+        self.server = FakeGmailServer(messages).start()
+        self.helper = self.server.helper()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_pages_have_a_consistent_size(self):
+        pages = list(self.helper.iter_email_pages(1700000000 - 2, page_size=100))
+        self.assertEqual([len(page) for page, token in pages], [100, 100, 50])
+        self.assertIsNotNone(pages[0][1])
+        self.assertIsNone(pages[-1][1])
+        # newest first
+        self.assertEqual(pages[0][0][0]['id'], "m249")
+        self.assertEqual(pages[-1][0][-1]['id'], "m000")
+
+    def test_resume_from_page_token(self):
+        pages = self.helper.iter_email_pages(1700000000 - 2, page_size=100)
+        first_page, token = next(pages)
+        pages.close()
+        resumed = list(self.helper.iter_email_pages(1700000000 - 2, page_token=token, page_size=100))
+        ids = [m['id'] for page, t in resumed for m in page]
+        self.assertEqual(len(ids), 150)
+        self.assertFalse(set(ids) & {m['id'] for m in first_page})
+
+    def test_only_newer_emails(self):
+        ids = [m['id'] for m in self.helper.fetch_emails_since(1700000000 + 246)]
+        self.assertEqual(ids, ["m248", "m249"])
+
+    def test_pages_are_requested_lazily(self):
+        pages = self.helper.iter_email_pages(1700000000 - 2, page_size=10)
+        next(pages)
+        next(pages)
+        self.assertEqual(self.server.http_requests, 2)
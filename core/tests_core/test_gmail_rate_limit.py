@@ -0,0 +1,91 @@
+from django.test import TestCase
+from googleapiclient.errors import HttpError
+from core.gmail_helper import RequestScheduler
+from core.tests_core.fake_gmail import FakeGmailServer, make_message
+
+class FakeClock:
+    """A clock that only moves forward when sleep is called"""
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+class TokenBucketTest(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.scheduler = RequestScheduler(units_per_second=10, burst=10, clock=self.clock, sleep=self.clock.sleep)
+
+    def test_burst_does_not_wait(self):
+        self.scheduler.acquire(5)
+        self.scheduler.acquire(5)
+        self.assertEqual(self.clock.sleeps, [])
+        self.assertEqual(self.scheduler.stats['throttled'], 0)
+
+    def test_waits_for_missing_units(self):
+        self.scheduler.acquire(10)
+        self.scheduler.acquire(5)
+        self.assertEqual(self.clock.sleeps, [0.5])
+        self.assertEqual(self.scheduler.stats['throttled'], 1)
+        self.assertEqual(self.scheduler.stats['units'], 15)
+
+    def test_bucket_refills_over_time(self):
+        self.scheduler.acquire(10)
+        self.clock.now += 1
+        self.scheduler.acquire(10)
+        self.assertEqual(self.clock.sleeps, [])
+
+class RetryTest(TestCase):
+    def setUp(self):
+        self.server = FakeGmailServer({"m1": make_message("m1")}).start()
+        self.clock = FakeClock()
+        self.helper = self.server.helper()
+        self.helper.scheduler = RequestScheduler(max_retries=3, clock=self.clock, sleep=self.clock.sleep)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_retry_after_429(self):
+        self.server.errors = [(429, 'rateLimitExceeded', 7)]
+        self.assertEqual(self.helper.fetch_email("m1")['id'], "m1")
+        stats = self.helper.scheduler.stats
+        self.assertEqual(stats['retried'], 1)
+        self.assertEqual(stats['rate_limited'], 1)
+        self.assertGreaterEqual(max(self.clock.sleeps), 7)
+        self.assertLess(self.helper.scheduler.rate, self.helper.scheduler.max_rate)
+
+    def test_retry_403_rate_limit(self):
+        self.server.errors = [(403, 'userRateLimitExceeded', None), (403, 'rateLimitExceeded', None)]
+        self.assertEqual(self.helper.fetch_email("m1")['id'], "m1")
+        self.assertEqual(self.helper.scheduler.stats['retried'], 2)
+
+    def test_retry_server_error(self):
+        self.server.errors = [(503, 'backendError', None)]
+        self.assertEqual(self.helper.fetch_email("m1")['id'], "m1")
+        self.assertEqual(self.helper.scheduler.stats['retried'], 1)
+        self.assertEqual(self.helper.scheduler.stats['rate_limited'], 0)
+
+    def test_other_errors_are_not_retried(self):
+        self.server.errors = [(403, 'insufficientPermissions', None)]
+        with self.assertRaises(HttpError):
+            self.helper.fetch_email("m1")
+        self.assertEqual(self.helper.scheduler.stats['retried'], 0)
+
+    def test_gives_up_after_max_retries(self):
+        self.server.errors = [(429, 'rateLimitExceeded', None)] * 5
+        with self.assertRaises(HttpError):
+            self.helper.fetch_email("m1")
+        self.assertEqual(self.helper.scheduler.stats['retried'], 3)
+
+    def test_quota_units_per_method(self):
+        self.helper.fetch_email("m1")
+        self.helper.fetch_thread("m1")
+        self.assertEqual(self.helper.scheduler.stats['units'], 15)
+
+    def test_copies_share_the_scheduler(self):
+        self.assertIs(self.helper.copy().scheduler, self.helper.scheduler)
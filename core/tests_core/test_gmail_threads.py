@@ -0,0 +1,73 @@
+import threading
+from django.test import TestCase
+from core.tests_core.fake_gmail import FakeGmailServer, make_message
+
+class GmailConcurrentThreadFetchTest(TestCase):
+    def setUp(self):
+        messages = {}
+        for t in range(20):
+            for m in range(3):
+                message_id = f"t{t:02d}m{m}"
+                messages[message_id] = make_message(message_id, thread_id=f"t{t:02d}", internal_date=1700000000000 + m)
+        self.server = FakeGmailServer(messages, latency=0.01).start()
+        self.helper = self.server.helper()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_all_threads_are_returned(self):
+        thread_ids = [f"t{t:02d}" for t in range(20)]
+        threads = list(self.helper.iter_threads(thread_ids, workers=4))
+        self.assertEqual(sorted(t['id'] for t in threads), thread_ids)
+        for thread in threads:
+            self.assertEqual([m['id'] for m in thread['messages']], [f"{thread['id']}m{m}" for m in range(3)])
+            self.assertEqual(thread['messages'][0]['Body'], "Body")
+
+    def test_workers_use_their_own_client(self):
+        fetching_threads = set()
+        services = set()
+        original_copy = self.helper.copy
+
+        def copy():
+            helper = original_copy()
+            services.add(id(helper.service))
+            original_fetch = helper.fetch_thread
+
+            def fetch_thread(thread_id, **kwargs):
+                fetching_threads.add(threading.get_ident())
+                return original_fetch(thread_id, **kwargs)
+            helper.fetch_thread = fetch_thread
+            return helper
+
+        self.helper.copy = copy
+        list(self.helper.iter_threads([f"t{t:02d}" for t in range(20)], workers=3))
+        self.assertEqual(len(services), 3)
+        self.assertNotIn(id(self.helper.service), services)
+        self.assertNotIn(threading.get_ident(), fetching_threads)
+
+    def test_single_worker(self):
+        threads = list(self.helper.iter_threads(["t01", "t02"], workers=1))
+        self.assertEqual([t['id'] for t in threads], ["t01", "t02"])
+
+    def test_errors_are_raised_to_the_consumer(self):
+        with self.assertRaises(Exception):
+            list(self.helper.iter_threads(["t01", "unknown", "t02"], workers=2))
+
+    def test_no_threads(self):
+        self.assertEqual(list(self.helper.iter_threads([], workers=4)), [])
+
+    def test_minimal_format(self):
+        thread = self.helper.fetch_thread("t01", format='minimal')
+        self.assertEqual([m['id'] for m in thread['messages']], ["t01m0", "t01m1", "t01m2"])
+        self.assertNotIn('payload', thread['messages'][0])
+        self.assertNotIn('Body', thread['messages'][0])
+
+    def test_iter_thread_emails(self):
+        wanted = {"t01": ["t01m2", "t01m0"], "t02": ["t02m1"], "t03": ["t03m0", "t03m1"]}
+        results = dict(self.helper.iter_thread_emails(wanted, workers=2))
+        self.assertEqual(set(results), set(wanted))
+        for thread_id, emails in results.items():
+            self.assertEqual([e['id'] for e in emails], wanted[thread_id])
+        # one batch request per thread, and nothing else is downloaded
+        self.assertEqual(self.server.batch_requests, 3)
+        self.assertEqual(self.server.http_requests, 3)
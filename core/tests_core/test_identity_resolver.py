@@ -0,0 +1,73 @@
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from core.identity_resolver import IdentityResolver, LRUMap
+from core.models import Contact, EmailAddress, EmailString, Label
+
+class LRUMapTest(TestCase):
+    def test_least_recently_used_keys_are_forgotten(self):
+        lru_map = LRUMap(max_size=2)
+        lru_map["a"] = 1
+        lru_map["b"] = 2
+        lru_map.get("a")
+        lru_map["c"] = 3
+        self.assertIn("a", lru_map)
+        self.assertNotIn("b", lru_map)
+        self.assertEqual(len(lru_map), 2)
+
+class IdentityResolverTest(TestCase):
+    def setUp(self):
+        self.known = EmailString.objects.create(original_string="John Doe <john@example.com>")
+        self.label = Label.objects.create(gmail_label_id="INBOX", name="INBOX")
+        self.resolver = IdentityResolver()
+        self.resolver.warm()
+
+    def test_warm_cache_needs_no_query(self):
+        with CaptureQueriesContext(connection) as queries:
+            strings = self.resolver.email_string_ids({"John Doe <john@example.com>"})
+            labels = self.resolver.label_ids({"INBOX"}, fetch_label=None)
+        self.assertEqual(strings, {"John Doe <john@example.com>": self.known.id})
+        self.assertEqual(labels, {"INBOX": self.label.id})
+        self.assertEqual(len(queries), 0)
+
+    def test_new_string_of_a_known_contact(self):
+        ids = self.resolver.email_string_ids({"John Doe <john.doe@work.com>"})
+        email_string = EmailString.objects.get(id=ids["John Doe <john.doe@work.com>"])
+        self.assertEqual(email_string.contact, self.known.contact)
+        self.assertEqual(email_string.email.email, "john.doe@work.com")
+        self.assertEqual(sorted(self.known.contact.emails.values_list('email', flat=True)), ["john.doe@work.com", "john@example.com"])
+        # the new row is written back to the cache
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.resolver.email_string_ids({"John Doe <john.doe@work.com>"}), ids)
+        self.assertEqual(len(queries), 0)
+
+    def test_new_string_of_a_new_contact(self):
+        ids = self.resolver.email_string_ids({"Jane <jane@example.com>"})
+        email_string = EmailString.objects.get(id=ids["Jane <jane@example.com>"])
+        self.assertEqual(email_string.contact.name, "Jane")
+        self.assertEqual(list(email_string.contact.emails.all()), [email_string.email])
+        self.assertEqual(Contact.objects.count(), 2)
+
+    def test_same_contact_rules_as_search_similar_contacts(self):
+        homonym = Contact.objects.create(name="John Doe")
+        self.resolver.warm()
+        # two contacts have the name: the one with the address is chosen
+        ids = self.resolver.email_string_ids({'"John Doe" <john@example.com>'})
+        self.assertEqual(EmailString.objects.get(id=ids['"John Doe" <john@example.com>']).contact, self.known.contact)
+        # none of them has the address: a new contact is created
+        ids = self.resolver.email_string_ids({"John Doe <other@example.com>"})
+        contact = EmailString.objects.get(id=ids["John Doe <other@example.com>"]).contact
+        self.assertNotIn(contact, [self.known.contact, homonym])
+
+    def test_strings_created_outside_the_cache(self):
+        other = EmailString.objects.create(original_string="Bob <bob@example.com>")
+        self.assertEqual(self.resolver.email_string_ids({"Bob <bob@example.com>"}), {"Bob <bob@example.com>": other.id})
+        self.assertEqual(EmailString.objects.filter(original_string="Bob <bob@example.com>").count(), 1)
+
+    def test_new_label(self):
+        ids = self.resolver.label_ids({"Label_1"}, fetch_label=lambda label_id: {"id": label_id, "name": "Work"})
+        self.assertEqual(Label.objects.get(id=ids["Label_1"]).name, "Work")
+
+    def test_email_address_is_not_looked_up_again(self):
+        self.resolver.email_string_ids({"Ann <ann@example.com>"})
+        self.assertEqual(EmailAddress.objects.filter(email="ann@example.com").count(), 1)
@@ -0,0 +1,86 @@
+from unittest import mock
+from django.test import TestCase, override_settings
+from core.llm.chunks import estimate_tokens, split_messages
+from core.models import ThreadSummary
+from core.tests_core import test_summary_cache
+
+class FakeChunkSummaryChain:
+    """Stands for the Ollama chain summarizing the chunks of a long conversation"""
+
+    def __init__(self):
+        self.batches = []
+
+    def batch(self, inputs, config=None):
+        self.batches.append((inputs, config))
+        return [f"Summary of a part of {len(prompt_input['conversation'])} characters" for prompt_input in inputs]
+
+    async def abatch(self, inputs, config=None):
+        return self.batch(inputs, config)
+
+class ChunksTest(TestCase):
+    def test_estimate_tokens(self):
+        self.assertEqual(estimate_tokens(""), 0)
+        self.assertEqual(estimate_tokens("abcde"), 2)
+
+    def test_split_messages(self):
+        self.assertEqual(split_messages(["a" * 10, "b" * 10, "c" * 10], max_tokens=6), ["a" * 10 + "\n" + "b" * 10, "c" * 10])
+        self.assertEqual(split_messages([], max_tokens=6), [])
+
+    def test_long_message_is_split(self):
+        message = " ".join(["word"] * 100)
+        chunks = split_messages([message], max_tokens=25)
+        self.assertTrue(all(len(chunk) <= 100 for chunk in chunks))
+        self.assertEqual(" ".join(chunks).split(), message.split())
+
+class MapReduceSummaryTest(TestCase):
+    """The graph with a conversation over the token budget"""
+
+    # Same thread and fake summary chain as the cache tests
+    create_thread = test_summary_cache.SummaryCacheTest.create_thread
+    create_email = test_summary_cache.SummaryCacheTest.create_email
+
+    def setUp(self):
+        test_summary_cache.SummaryCacheTest.setUp(self)
+        self.chunk_chain = FakeChunkSummaryChain()
+        for day in range(21, 27):
+            self.create_email(self.thread, f"m{day}", f"Reply of day {day}: " + "details " * 150, day=day)
+
+    def summarize(self, thread, force_refresh=False):
+        with mock.patch('core.llm.nodes.get_chunk_summary_chain', return_value=self.chunk_chain):
+            return test_summary_cache.SummaryCacheTest.summarize(self, thread, force_refresh)
+
+    @override_settings(SUMMARY_TOKEN_BUDGET=1000, SUMMARY_CHUNK_TOKENS=700, SUMMARY_MAP_CONCURRENCY=3)
+    def test_long_conversation_is_summarized_by_chunks(self):
+        result = self.summarize(self.thread)
+        self.assertGreater(result["conversation_tokens"], 1000)
+        inputs, config = self.chunk_chain.batches[0]
+        self.assertGreater(len(inputs), 1)
+        self.assertEqual(config, {"max_concurrency": 3})
+        self.assertTrue(all(estimate_tokens(prompt_input["conversation"]) <= 700 for prompt_input in inputs))
+        # The chunks cover the conversation in order
+        self.assertIn("Reply of day 21", inputs[0]["conversation"])
+        self.assertIn("Reply of day 26", inputs[-1]["conversation"])
+
+        # The reduce call gets the partial summaries instead of the conversation
+        conversation = self.chain.prompt_inputs[-1]["conversation"]
+        self.assertIn("Part 1:\nSummary of a part of", conversation)
+        self.assertNotIn("details details", conversation)
+        self.assertEqual(result["thread_summary"]["summary"], "Alice asks for the budget")
+        self.assertEqual(ThreadSummary.objects.count(), 1)
+
+        # The cache is keyed on the conversation, not on the partial summaries
+        self.assertTrue(self.summarize(self.thread)["cached"])
+        self.assertEqual(len(self.chunk_chain.batches), 1)
+
+    @override_settings(SUMMARY_TOKEN_BUDGET=100000)
+    def test_short_conversation_is_summarized_at_once(self):
+        result = self.summarize(self.thread)
+        self.assertEqual(result["chunks"], [])
+        self.assertEqual(self.chunk_chain.batches, [])
+        self.assertIn("Reply of day 26", self.chain.prompt_inputs[-1]["conversation"])
+
+    @override_settings(SUMMARY_TOKEN_BUDGET=30, SUMMARY_CHUNK_TOKENS=400)
+    def test_partial_summaries_over_the_budget_are_summarized_again(self):
+        self.summarize(self.thread)
+        self.assertEqual(len(self.chunk_chain.batches), 2)
+        self.assertEqual(len(self.chunk_chain.batches[1][0]), 1)
@@ -0,0 +1,134 @@
+import os
+import tempfile
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from core.email_writer import EmailBatchWriter
+from core.message_archive import MessageArchive, CODEC_ZLIB, INDEX_FILE, PACK_FILE
+from core.models import Email, Thread
+from core.tests_core.fake_gmail import FakeGmailServer, make_message
+
+class MessageArchiveTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.archive = MessageArchive(self.directory.name)
+
+    def tearDown(self):
+        self.archive.close()
+        self.directory.cleanup()
+
+    def reopen(self):
+        self.archive.close()
+        self.archive = MessageArchive(self.directory.name)
+
+    def test_messages_are_read_back(self):
+        messages = [make_message(f"m{i}", body=f"Body {i}") for i in range(20)]
+        for message in messages:
+            self.assertTrue(self.archive.append(message))
+        self.assertEqual(self.archive.get("m7"), messages[7])
+        self.assertIsNone(self.archive.get("unknown"))
+        self.reopen()
+        self.assertEqual(len(self.archive), 20)
+        self.assertEqual(self.archive.get("m19"), messages[19])
+
+    def test_parsed_fields_are_not_archived(self):
+        message = make_message("m1")
+        self.archive.append({**message, 'From': "Sender", 'Body': "Body"})
+        self.assertEqual(self.archive.get("m1"), message)
+
+    def test_messages_are_archived_once(self):
+        self.assertTrue(self.archive.append(make_message("m1")))
+        self.assertFalse(self.archive.append(make_message("m1", body="Other")))
+        self.reopen()
+        self.assertFalse(self.archive.append(make_message("m1")))
+
+    def test_zlib_codec(self):
+        directory = os.path.join(self.directory.name, "zlib")
+        with MessageArchive(directory, codec=CODEC_ZLIB) as archive:
+            archive.append(make_message("m1"))
+        with MessageArchive(directory) as archive:
+            self.assertEqual(archive.codec, CODEC_ZLIB)
+            self.assertEqual(archive.get("m1"), make_message("m1"))
+
+    def test_index_is_rebuilt_from_the_pack(self):
+        for i in range(3):
+            self.archive.append(make_message(f"m{i}"))
+        self.archive.close()
+        # lose the last index line and write half of a record, as in a crash
+        index_path = os.path.join(self.directory.name, INDEX_FILE)
+        with open(index_path) as index_file:
+            lines = index_file.readlines()
+        with open(index_path, 'w') as index_file:
+            index_file.writelines(lines[:2])
+        pack_path = os.path.join(self.directory.name, PACK_FILE)
+        size = os.path.getsize(pack_path)
+        with open(pack_path, 'ab') as pack:
+            pack.write(b'\x00\x02\x00\x00\x10\x00m3')
+
+        self.reopen()
+        self.assertEqual(len(self.archive), 3)
+        self.assertEqual(self.archive.get("m2"), make_message("m2"))
+        self.assertEqual(os.path.getsize(pack_path), size)
+        self.archive.append(make_message("m3"))
+        self.reopen()
+        self.assertEqual(self.archive.get("m3"), make_message("m3"))
+
+    def test_partly_written_index_line_is_dropped(self):
+        for i in range(3):
+            self.archive.append(make_message(f"m{i}"))
+        self.archive.close()
+        index_path = os.path.join(self.directory.name, INDEX_FILE)
+        with open(index_path) as index_file:
+            lines = index_file.readlines()
+        with open(index_path, 'w') as index_file:
+            index_file.writelines(lines[:2] + [lines[2][:4]])
+
+        for _ in range(2):
+            self.reopen()
+        self.archive.append(make_message("m3"))
+        self.reopen()
+        self.assertEqual(self.archive.get("m2"), make_message("m2"))
+        self.assertEqual(self.archive.get("m3"), make_message("m3"))
+        with open(index_path) as index_file:
+            self.assertEqual([line.split()[0] for line in index_file], ["m0", "m1", "m2", "m3"])
+
+class ReparseEmailsTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.settings = override_settings(MESSAGE_ARCHIVE_DIR=self.directory.name)
+        self.settings.enable()
+        self.server = FakeGmailServer({
+            "m1": make_message("m1", thread_id="t1", body="First"),
+            "m2": make_message("m2", thread_id="t1", subject="Accepted: Meeting", body="Second"),
+        }).start()
+        helper = self.server.helper()
+        thread = Thread.objects.create(gmail_thread_id="t1")
+        writer = EmailBatchWriter(helper)
+        with MessageArchive(self.directory.name) as archive:
+            for message in helper.fetch_emails(["m1", "m2"]):
+                archive.append(message)
+                writer.add(message, thread)
+        writer.flush()
+
+    def tearDown(self):
+        self.server.stop()
+        self.settings.disable()
+        self.directory.cleanup()
+
+    def test_bodies_and_calendar_label_are_regenerated(self):
+        Email.objects.filter(gmail_message_id="m1").update(body="Old parser output")
+        Email.objects.get(gmail_message_id="m2").labels.clear()
+        call_command('reparse_emails', workers=2, batch_size=1, stdout=open(os.devnull, 'w'))
+        self.assertEqual(Email.objects.get(gmail_message_id="m1").body, "First")
+        self.assertEqual(
+            sorted(Email.objects.get(gmail_message_id="m2").labels.values_list('name', flat=True)),
+            ["Calendar"]
+        )
+
+    def test_restore_labels(self):
+        Email.objects.get(gmail_message_id="m1").labels.clear()
+        call_command('reparse_emails', workers=1, restore_labels=True, stdout=open(os.devnull, 'w'))
+        self.assertEqual(list(Email.objects.get(gmail_message_id="m1").labels.values_list('gmail_label_id', flat=True)), ["INBOX"])
+        self.assertEqual(
+            sorted(Email.objects.get(gmail_message_id="m2").labels.values_list('name', flat=True)),
+            ["Calendar", "INBOX"]
+        )
@@ -0,0 +1,140 @@
+import os
+import tempfile
+import base64
+from django.test import TestCase
+from core.utils import extract_body, html_to_text
+from core.utils import mime
+
+def encode(text, charset='utf-8'):
+    return base64.urlsafe_b64encode(text.encode(charset)).decode('ascii')
+
+def part(mime_type, text, headers=None, **extra):
+    return {'mimeType': mime_type, 'headers': headers or [], 'body': {'data': encode(text)}, **extra}
+
+def multipart(mime_type, *parts):
+    return {'mimeType': mime_type, 'headers': [], 'body': {'size': 0}, 'parts': list(parts)}
+
+class ExtractBodyTest(TestCase):
+    def test_single_part_plain_text(self):
+        self.assertEqual(extract_body(part('text/plain', "Hello\n\n\n\nWorld")), "Hello\n\nWorld")
+
+    def test_single_part_html(self):
+        self.assertEqual(extract_body(part('text/html', "<p>Hello <b>World</b></p>")), "Hello **World**")
+
+    def test_alternative_prefers_plain_text(self):
+        payload = multipart('multipart/alternative', part('text/plain', "Plain"), part('text/html', "<p>Html</p>"))
+        self.assertEqual(extract_body(payload), "Plain")
+
+    def test_multipart_html_only_is_converted(self):
+        payload = multipart('multipart/mixed',
+                            multipart('multipart/related', part('text/html', "<div>Newsletter</div>")),
+                            part('application/pdf', "%PDF", filename="a.pdf"))
+        self.assertEqual(extract_body(payload), "Newsletter")
+
+    def test_empty_plain_part_falls_back_to_html(self):
+        payload = multipart('multipart/alternative', part('text/plain', "  \n"), part('text/html', "<p>Html</p>"))
+        self.assertEqual(extract_body(payload), "Html")
+
+    def test_attachments_are_ignored(self):
+        payload = multipart('multipart/mixed',
+                            part('text/plain', "notes", headers=[{'name': 'Content-Disposition', 'value': 'attachment; filename="notes.txt"'}]),
+                            part('text/plain', "Message"))
+        self.assertEqual(extract_body(payload), "Message")
+
+    def test_only_the_selected_part_is_decoded(self):
+        payload = multipart('multipart/alternative', part('text/plain', "Plain"), part('text/html', "<p>Html</p>"))
+        payload['parts'][1]['body']['data'] = "not base64 !"
+        self.assertEqual(extract_body(payload), "Plain")
+
+    def test_charset(self):
+        payload = {'mimeType': 'text/plain', 'body': {'data': encode("Café", 'latin-1')},
+                   'headers': [{'name': 'Content-Type', 'value': 'text/plain; charset="ISO-8859-1"'}]}
+        self.assertEqual(extract_body(payload), "Café")
+
+    def test_unpadded_body(self):
+        for text in ("Thanks!", "See you at 10."):
+            payload = part('text/plain', text)
+            payload['body']['data'] = payload['body']['data'].rstrip('=')
+            self.assertEqual(extract_body(payload), text)
+
+    def test_no_body(self):
+        self.assertEqual(extract_body({'mimeType': 'multipart/mixed', 'parts': []}), "")
+
+class HtmlToTextTest(TestCase):
+    def test_hidden_elements_are_dropped(self):
+        html = """<html><head><title>Title</title><style>.a { color: red }</style></head><body>
+        <div style="display:none;max-height:0">Preheader <span>text</span></div>
+        <span style="font-size:0">tracking</span><p hidden>hidden</p><script>var a = 1;</script>
+        <p>Visible</p></body></html>"""
+        self.assertEqual(html_to_text(html), "Visible")
+
+    def test_structure(self):
+        html = "<h2>Title</h2><p>A <a href='https://example.com'>link</a><br>next</p><ul><li>one</li><li>two</li></ul>"
+        self.assertEqual(html_to_text(html), "## Title\n\nA [link](https://example.com)\nnext\n\n- one\n- two")
+
+    def test_entities_and_whitespace(self):
+        self.assertEqual(html_to_text("<p>Tom &amp;   Jerry\n  &lt;3</p>"), "Tom & Jerry <3")
+
+    def test_unclosed_and_stray_tags(self):
+        self.assertEqual(html_to_text("<div><p>One<p>Two</span></div><div>Three"), "One\n\nTwo\n\nThree")
+
+    def test_size_cap(self):
+        text = html_to_text("<p>" + "word " * 100000 + "</p>", max_size=1000)
+        self.assertLessEqual(len(text), 1000)
+        self.assertTrue(text.startswith("word word"))
+
+    def test_html_size_cap(self):
+        html = "<p>start</p>" + "<div>" + "x" * (mime.MAX_HTML_SIZE) + "</div><p>end</p>"
+        self.assertNotIn("end", html_to_text(html, max_size=mime.MAX_HTML_SIZE * 2))
+
+class HtmlConversionCacheTest(TestCase):
+    def setUp(self):
+        self.cache = mime.HtmlConversionCache(max_size=2)
+        self.conversions = []
+        original = mime.html_to_text
+
+        def html_to_text(html, max_size=mime.MAX_BODY_SIZE):
+            self.conversions.append(html)
+            return original(html, max_size)
+        mime.html_to_text = html_to_text
+        self.addCleanup(setattr, mime, 'html_to_text', original)
+
+    def test_same_html_is_converted_once(self):
+        self.assertEqual(self.cache.convert(b"<p>Hello</p>", 'utf-8'), "Hello")
+        self.assertEqual(self.cache.convert(b"<p>Hello</p>", 'utf-8'), "Hello")
+        self.assertEqual(self.conversions, ["<p>Hello</p>"])
+        self.assertEqual(self.cache.stats, {'hits': 1, 'file_hits': 0, 'misses': 1})
+
+    def test_memory_is_bounded(self):
+        for html in (b"<p>1</p>", b"<p>2</p>", b"<p>3</p>", b"<p>1</p>"):
+            self.cache.convert(html, 'utf-8')
+        self.assertEqual(len(self.cache.memory), 2)
+        self.assertEqual(self.cache.stats['misses'], 4)
+
+    def test_charset_and_size_are_part_of_the_key(self):
+        self.cache.convert(b"<p>caf\xe9</p>", 'latin-1')
+        self.assertEqual(self.cache.convert(b"<p>caf\xe9</p>", 'utf-8'), "caf�")
+        self.cache.convert(b"<p>long text</p>", 'utf-8', max_size=4)
+        self.assertEqual(self.cache.convert(b"<p>long text</p>", 'utf-8'), "long text")
+        self.assertEqual(self.cache.stats['hits'], 0)
+
+    def test_file_backed_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "conversions.sqlite3")
+            self.cache.open_file(path)
+            self.cache.convert(b"<p>Hello</p>", 'utf-8')
+            self.cache.close()
+
+            cache = mime.HtmlConversionCache()
+            cache.open_file(path)
+            self.assertEqual(cache.convert(b"<p>Hello</p>", 'utf-8'), "Hello")
+            self.assertEqual(cache.stats, {'hits': 0, 'file_hits': 1, 'misses': 0})
+            cache.close()
+        self.assertEqual(len(self.conversions), 1)
+
+    def test_extract_body_uses_the_cache(self):
+        mime.conversion_cache.stats['hits'] = 0
+        payload = part('text/html', "<p>Newsletter template</p>")
+        extract_body(payload)
+        extract_body(payload)
+        self.assertGreaterEqual(mime.conversion_cache.stats['hits'], 1)
@@ -0,0 +1,86 @@
+from datetime import datetime, timezone
+from django.test import TestCase, override_settings
+from core.llm.compaction import (abbreviate_recipients, compact_messages, compaction_stats, restore_knowledge,
+                                 strip_footer, trim_knowledge)
+from core.models import Contact
+from core.tests_core import test_summary_cache
+
+def email_values(subject="Budget", to_list=("Bob <bob@example.com>",), content="Hello", labels="INBOX"):
+    return {"sender": "Alice <alice@example.com>", "to_list": list(to_list), "cc_list": [], "labels": labels,
+            "subject": subject, "date": datetime(2024, 5, 20, 9, 30, tzinfo=timezone.utc), "content": content}
+
+class CompactionTest(TestCase):
+    def test_strip_footer(self):
+        self.assertEqual(strip_footer("See you Monday.\n--\nAlice Martin\nCEO"), "See you Monday.")
+        self.assertEqual(strip_footer("OK\n\nSent from my iPhone"), "OK")
+        self.assertEqual(strip_footer("Agreed.\nThis email and any attachments are confidential and intended solely for..."), "Agreed.")
+        self.assertEqual(strip_footer("Merci.\nCe message et toutes les pièces jointes sont confidentiels"), "Merci.")
+        # Nothing is left before the footer: the body is kept
+        self.assertEqual(strip_footer("Disclaimer: the figures are estimates"), "Disclaimer: the figures are estimates")
+        self.assertEqual(strip_footer("This email is about the budget"), "This email is about the budget")
+
+    def test_abbreviate_recipients(self):
+        self.assertEqual(abbreviate_recipients(["a", "b"]), "a, b")
+        self.assertEqual(abbreviate_recipients(["a", "b", "c", "d", "e", "f"]), "a, b, c, d and 2 others")
+
+    def test_unchanged_headers_are_written_once(self):
+        first, second, third = compact_messages([
+            email_values(),
+            email_values(subject="Re: Budget", content="Thanks\n--\nBob"),
+            email_values(subject="Re: Budget", to_list=["Carol <carol@example.com>"]),
+        ])
+        self.assertIn("Date: 2024-05-20 09:30\nTo: Bob <bob@example.com>\nLabels: INBOX\nSubject: Budget", first)
+        self.assertNotIn("To:", second)
+        self.assertNotIn("Subject:", second)
+        self.assertIn("Email content: Thanks\n", second)
+        self.assertIn("To: Carol <carol@example.com>", third)
+        self.assertNotIn("Labels:", third)
+
+    def test_trim_knowledge(self):
+        knowledge = "Plays golf on Sundays. Works on the budget of Alphalog. Has two children.\nLikes Italian food."
+        self.assertEqual(trim_knowledge(knowledge, set(), 100), (knowledge, []))
+        kept, dropped = trim_knowledge(knowledge, {"budget", "alphalog"}, 12)
+        self.assertEqual(kept, "Works on the budget of Alphalog.")
+        self.assertEqual(dropped, ["Plays golf on Sundays.", "Has two children.", "Likes Italian food."])
+
+    def test_restore_knowledge(self):
+        self.assertEqual(restore_knowledge("Works on the budget.", ["Plays golf.", "Works on the budget."]),
+                         "Works on the budget. Plays golf.")
+        self.assertEqual(restore_knowledge(None, ["Plays golf."]), "Plays golf.")
+        self.assertIsNone(restore_knowledge(None, []))
+
+    def test_restored_knowledge_does_not_grow(self):
+        dropped = ["Plays golf.", "Has two children.", "Plays golf."]
+        knowledge = restore_knowledge("Works on the budget.\nplays  golf", dropped)
+        self.assertEqual(knowledge, "Works on the budget.\nplays  golf\nHas two children.")
+        self.assertEqual(restore_knowledge(knowledge, dropped), knowledge)
+
+class CompactPromptNodeTest(TestCase):
+    """The graph with a long knowledge and footers"""
+
+    create_thread = test_summary_cache.SummaryCacheTest.create_thread
+    create_email = test_summary_cache.SummaryCacheTest.create_email
+    summarize = test_summary_cache.SummaryCacheTest.summarize
+
+    def setUp(self):
+        test_summary_cache.SummaryCacheTest.setUp(self)
+        self.create_email(self.thread, "m2", "Here it is.\n\nSent from my iPhone", day=21)
+        Contact.objects.filter(id=self.sender.contact_id).update(
+            knowledge="Plays golf on Sundays. Prefers phone calls. Handles the budget of Alphalog."
+        )
+
+    @override_settings(SUMMARY_KNOWLEDGE_TOKENS=10)
+    def test_compacted_prompt(self):
+        prompts = compaction_stats.prompts
+        result = self.summarize(self.thread)
+        prompt_input = self.chain.prompt_inputs[-1]
+        self.assertNotIn("iPhone", prompt_input["conversation"])
+        self.assertEqual(prompt_input["conversation"].count("Subject: Budget"), 1)
+        self.assertIn("Existig knowledge: Handles the budget of Alphalog.\n", prompt_input["participants"])
+        self.assertLess(result["compaction"]["after"], result["compaction"]["before"])
+        self.assertEqual(compaction_stats.prompts, prompts + 1)
+
+        # The facts the LLM did not see are kept, and the next run is a cache hit
+        self.assertEqual(Contact.objects.get(id=self.sender.contact_id).knowledge,
+                         "Works on the budget\nPlays golf on Sundays. Prefers phone calls.")
+        self.assertTrue(self.summarize(self.thread)["cached"])
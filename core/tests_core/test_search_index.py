@@ -0,0 +1,154 @@
+from datetime import datetime, timezone
+from io import StringIO
+from unittest import mock
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase, TransactionTestCase
+from core import search_index
+from core.models import Email, EmailString, Thread, ThreadSummary
+
+class SearchIndexTest(TestCase):
+    def setUp(self):
+        self.sender = EmailString.objects.create(original_string="Alice Martin <alice@example.com>")
+        self.thread1 = Thread.objects.create(gmail_thread_id="t1")
+        self.thread2 = Thread.objects.create(gmail_thread_id="t2")
+
+    def create_email(self, gmail_message_id, thread, subject="Hello", body="Nothing to see"):
+        return Email.objects.create(
+            gmail_message_id=gmail_message_id,
+            gmail_thread_id=thread.gmail_thread_id,
+            date=datetime(2024, 5, 20, tzinfo=timezone.utc),
+            sender_str=self.sender,
+            subject=subject,
+            body=body,
+            snippet="",
+            thread=thread,
+        )
+
+    def thread_ids(self, text):
+        return [thread_id for thread_id, email_id in search_index.search_threads(text)]
+
+    def test_to_match_query(self):
+        self.assertEqual(search_index.to_match_query("budget meet"), '"budget" "meet"*')
+        self.assertEqual(search_index.to_match_query('"quarterly report" draft'), '"quarterly report" "draft"*')
+        self.assertEqual(search_index.to_match_query('draft "quarterly report"'), '"draft" "quarterly report"')
+        self.assertEqual(search_index.to_match_query('NEAR( OR "" -'), '"NEAR" "OR"')
+        self.assertEqual(search_index.to_match_query('" ()'), '')
+
+    def test_emails_are_indexed_on_insert_update_and_delete(self):
+        email = self.create_email("m1", self.thread1, body="The budget is approved")
+        self.assertEqual(self.thread_ids("budget"), [self.thread1.id])
+
+        email.body = "The plan is approved"
+        email.save()
+        self.assertEqual(self.thread_ids("budget"), [])
+        self.assertEqual(self.thread_ids("plan"), [self.thread1.id])
+
+        Email.objects.filter(id=email.id).update(thread=self.thread2)
+        self.assertEqual(self.thread_ids("plan"), [self.thread2.id])
+
+        email.delete()
+        self.assertEqual(self.thread_ids("plan"), [])
+
+    def test_quoted_text_and_sender(self):
+        self.create_email("m1", self.thread1, body="Sounds good.\n\nOn Mon, John wrote:\n> the budget")
+        self.assertEqual(self.thread_ids("budget"), [])
+        self.assertEqual(self.thread_ids("alice"), [self.thread1.id])
+        self.assertEqual(self.thread_ids("mart"), [self.thread1.id])
+
+    def test_ranking_and_snippet(self):
+        self.create_email("m1", self.thread1, body="A long email which mentions the invoice once among many other words")
+        self.create_email("m2", self.thread2, subject="Invoice 42", body="Please find it attached")
+        self.create_email("m3", self.thread2, subject="Re: Invoice 42", body="Thanks")
+        results = search_index.search_threads("invoice")
+        self.assertEqual([thread_id for thread_id, email_id in results], [self.thread2.id, self.thread1.id])
+        snippets = search_index.get_snippets("invoice", results)
+        self.assertIn(search_index.HIGHLIGHT_START + "Invoice" + search_index.HIGHLIGHT_END + " 42", snippets[self.thread2.id])
+        self.assertIn(search_index.HIGHLIGHT_START + "invoice" + search_index.HIGHLIGHT_END, snippets[self.thread1.id])
+
+    def test_latest_summary_is_indexed(self):
+        email = self.create_email("m1", self.thread1)
+        ThreadSummary.objects.create(thread=self.thread1, email=email, summary="About the offsite", rationale="")
+        results = search_index.search_threads("offsite")
+        self.assertEqual(results, [(self.thread1.id, None)])
+        self.assertIn("offsite", search_index.get_snippets("offsite", results)[self.thread1.id])
+        latest = ThreadSummary.objects.create(thread=self.thread1, email=email, summary="About the budget", rationale="")
+        self.assertEqual(self.thread_ids("offsite"), [])
+        self.assertEqual(self.thread_ids("budget"), [self.thread1.id])
+        latest.delete()
+        self.assertEqual(self.thread_ids("offsite"), [self.thread1.id])
+
+    def test_rebuild(self):
+        self.create_email("m1", self.thread1, body="The budget is approved")
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {search_index.EMAIL_TABLE}")
+        self.assertEqual(self.thread_ids("budget"), [])
+        call_command('rebuild_search_index', stdout=StringIO())
+        self.assertEqual(self.thread_ids("budget"), [self.thread1.id])
+
+    def test_highlight_escapes_the_text(self):
+        snippet = f"<b>{search_index.HIGHLIGHT_START}budget{search_index.HIGHLIGHT_END}</b>"
+        self.assertEqual(search_index.highlight(snippet), "&lt;b&gt;<mark>budget</mark>&lt;/b&gt;")
+
+class ThreadSearchViewTest(TestCase):
+    def setUp(self):
+        User.objects.create_user(username='testuser', password='testpass123')
+        self.client.login(username='testuser', password='testpass123')
+        sender = EmailString.objects.create(original_string="alice@example.com")
+        for i, (subject, body) in enumerate([("Budget", "Numbers"), ("Lunch", "The budget is fine"), ("Other", "Nothing")]):
+            thread = Thread.objects.create(gmail_thread_id=f"t{i}")
+            Email.objects.create(gmail_message_id=f"m{i}", gmail_thread_id=f"t{i}", date=datetime(2024, 5, 20, tzinfo=timezone.utc),
+                                 sender_str=sender, subject=subject, body=body, snippet="", thread=thread)
+
+    def test_search_by_relevance(self):
+        response = self.client.get('/threads/', {'search': 'budget'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['current_sort'], 'relevance')
+        self.assertEqual([t['subject'] for t in response.context['threads']], ["Budget", "Lunch"])
+        self.assertContains(response, "<mark>budget</mark> is fine")
+
+    def test_search_with_another_sort(self):
+        response = self.client.get('/threads/', {'search': 'budget', 'sort': 'subject'})
+        self.assertEqual([t['subject'] for t in response.context['threads']], ["Budget", "Lunch"])
+        response = self.client.get('/threads/', {'search': 'budget', 'sort': '-subject'})
+        self.assertEqual([t['subject'] for t in response.context['threads']], ["Lunch", "Budget"])
+
+    def test_other_sorts_are_not_limited_to_the_most_relevant(self):
+        with mock.patch('core.search_index.MAX_RESULTS', 1):
+            self.assertEqual(len(self.client.get('/threads/', {'search': 'budget'}).context['threads']), 1)
+            response = self.client.get('/threads/', {'search': 'budget', 'sort': '-subject'})
+        self.assertEqual([t['subject'] for t in response.context['threads']], ["Lunch", "Budget"])
+        self.assertContains(response, "<mark>budget</mark> is fine")
+
+
+class SearchIndexMigrationTest(TransactionTestCase):
+    """The migrations rolled back and applied again keep the triggers of the full-text index"""
+
+    TRIGGERS = ['core_email_fts_delete', 'core_email_fts_insert', 'core_email_fts_update',
+                'core_summary_fts_delete', 'core_summary_fts_insert', 'core_summary_fts_update']
+
+    def migrate(self, name):
+        executor = MigrationExecutor(connection)
+        executor.migrate([('core', name)])
+
+    def triggers(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' ORDER BY name")
+            return [name for name, in cursor.fetchall()]
+
+    def test_migrations_keep_the_triggers(self):
+        # Every migration since 0004, so a later one rebuilding core_email or core_threadsummary is checked too
+        graph = MigrationExecutor(connection).loader.graph
+        names = [name for app, name in graph.forwards_plan(graph.leaf_nodes('core')[0]) if app == 'core']
+        names = names[names.index('0004_search_index'):]
+        try:
+            for name in reversed(names):
+                self.migrate(name)
+                self.assertEqual(self.triggers(), self.TRIGGERS, f"rolled back to {name}")
+            for name in names[1:]:
+                self.migrate(name)
+                self.assertEqual(self.triggers(), self.TRIGGERS, f"migrated to {name}")
+        finally:
+            self.migrate(names[-1])
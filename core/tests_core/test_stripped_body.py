@@ -0,0 +1,45 @@
+import os
+from datetime import datetime, timezone
+from django.core.management import call_command
+from django.test import TestCase
+from core.models import Email, EmailString
+
+BODY = "Sounds good.\n\nOn Mon, May 20, 2024 at 10:00 AM, John <john@example.com> wrote:\n> Shall we meet?"
+
+class StrippedBodyTest(TestCase):
+    def setUp(self):
+        self.sender = EmailString.objects.create(original_string="John <john@example.com>")
+
+    def create_email(self, gmail_message_id, body=BODY):
+        return Email.objects.create(
+            gmail_message_id=gmail_message_id,
+            gmail_thread_id="t1",
+            date=datetime(2024, 5, 20, tzinfo=timezone.utc),
+            sender_str=self.sender,
+            subject="Meeting",
+            body=body,
+            snippet="",
+        )
+
+    def test_computed_on_save(self):
+        email = self.create_email("m1")
+        self.assertEqual(Email.objects.get(id=email.id).stripped_body, "Sounds good.")
+        email.body = "Changed\n> quote"
+        email.save()
+        self.assertEqual(Email.objects.get(id=email.id).truncated_body, "Changed")
+
+    def test_not_backfilled_yet(self):
+        email = self.create_email("m1")
+        Email.objects.filter(id=email.id).update(stripped_body=None)
+        self.assertEqual(Email.objects.get(id=email.id).truncated_body, "Sounds good.")
+
+    def test_backfill(self):
+        for i in range(5):
+            self.create_email(f"m{i}")
+        Email.objects.update(stripped_body=None)
+        Email.objects.filter(gmail_message_id="m4").update(stripped_body="stale")
+        call_command('backfill_stripped_body', batch_size=2, stdout=open(os.devnull, "w"))
+        self.assertEqual(list(Email.objects.order_by('id').values_list('stripped_body', flat=True)), ["Sounds good."] * 4 + ["stale"])
+
+        call_command('backfill_stripped_body', all=True, stdout=open(os.devnull, "w"))
+        self.assertEqual(set(Email.objects.values_list('stripped_body', flat=True)), {"Sounds good."})
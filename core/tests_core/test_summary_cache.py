@@ -0,0 +1,149 @@
+import json
+from datetime import datetime, timezone
+from unittest import mock
+from django.test import TestCase
+from core.llm.cache import SummaryCache, summary_cache
+from core.llm.helper import build_graph
+from core.llm.nodes import FULL_SUMMARY_EVERY
+from core.models import Contact, Email, EmailString, Thread, ThreadSummary
+
+class FakeSummaryChain:
+    """Stands for the Ollama chain: answers with a summary which updates the knowledge of Alice"""
+
+    def __init__(self):
+        self.calls = 0
+        self.prompt_inputs = []
+
+    def invoke(self, prompt_input):
+        self.calls += 1
+        self.prompt_inputs.append(prompt_input)
+        return "Here is the JSON: " + json.dumps({
+            "summary": "Alice asks for the budget",
+            "rationale": "A question",
+            "action": "NEED_TO_RESPOND",
+            "participants": [{"name": "Alice Martin", "email": "alice@example.com", "id": self.alice_id,
+                              "role in the thread": "Sender", "updated_knowledge": "Works on the budget"}],
+        })
+
+class SummaryCacheTest(TestCase):
+    def setUp(self):
+        self.sender = EmailString.objects.create(original_string="Alice Martin <alice@example.com>")
+        self.thread = self.create_thread("t1")
+        self.chain = FakeSummaryChain()
+        self.chain.alice_id = self.sender.contact_id
+        summary_cache.stats = {'hits': 0, 'misses': 0, 'refreshed': 0}
+
+    def create_thread(self, gmail_thread_id):
+        thread = Thread.objects.create(gmail_thread_id=gmail_thread_id)
+        self.create_email(thread, f"m-{gmail_thread_id}", "Can you send me the budget?", day=20)
+        return thread
+
+    def create_email(self, thread, gmail_message_id, body, day):
+        return Email.objects.create(gmail_message_id=gmail_message_id, gmail_thread_id=thread.gmail_thread_id,
+                                    date=datetime(2024, 5, day, tzinfo=timezone.utc), sender_str=self.sender,
+                                    subject="Budget", body=body, snippet="", thread=thread)
+
+    def summarize(self, thread, force_refresh=False):
+        from core.utils import sanitize_json, llm
+        # The same fake chain answers the full and the incremental prompts
+        llm_utils = (sanitize_json, llm, self.chain, self.chain, lambda **kwargs: None)
+        with mock.patch('core.llm.nodes.get_llm_utils', return_value=llm_utils):
+            return build_graph().invoke({"thread": thread, "force_refresh": force_refresh})
+
+    def test_unchanged_thread_is_not_summarized_again(self):
+        result = self.summarize(self.thread)
+        self.assertFalse(result["cached"])
+        self.assertEqual(Contact.objects.get(id=self.sender.contact_id).knowledge, "Works on the budget")
+
+        # The knowledge updated by the first summary is in the prompt of the second one
+        result = self.summarize(self.thread)
+        self.assertTrue(result["cached"])
+        self.assertEqual(result["thread_summary"]["summary"], "Alice asks for the budget")
+        self.assertEqual(self.chain.calls, 1)
+        self.assertEqual(ThreadSummary.objects.count(), 1)
+        self.assertEqual(summary_cache.stats, {'hits': 1, 'misses': 1, 'refreshed': 0})
+
+    def test_next_prompt_is_not_extracted_again(self):
+        # The graph holds its own references to the nodes, only a second extraction would call this one
+        with mock.patch('core.llm.nodes.extract_thread_node', side_effect=AssertionError("thread extracted again")):
+            self.assertFalse(self.summarize(self.thread)["cached"])
+        self.assertTrue(self.summarize(self.thread)["cached"])
+
+    def test_force_refresh(self):
+        self.summarize(self.thread)
+        result = self.summarize(self.thread, force_refresh=True)
+        self.assertFalse(result["cached"])
+        self.assertEqual(self.chain.calls, 2)
+        self.assertEqual(ThreadSummary.objects.count(), 2)
+        self.assertEqual(summary_cache.stats['refreshed'], 1)
+
+    def test_changed_knowledge_is_a_miss(self):
+        self.summarize(self.thread)
+        Contact.objects.filter(id=self.sender.contact_id).update(knowledge="Works on the budget, moved to Sydney")
+        self.assertFalse(self.summarize(self.thread)["cached"])
+        self.assertEqual(self.chain.calls, 2)
+
+    def test_same_conversation_in_another_thread(self):
+        self.summarize(self.thread)
+        other = self.create_thread("t2")
+        result = self.summarize(other)
+        self.assertTrue(result["cached"])
+        self.assertEqual(ThreadSummary.objects.filter(thread=other).get().summary, "Alice asks for the budget")
+
+    def test_copied_summary_is_attached_to_the_last_email(self):
+        self.summarize(self.thread)
+        key = ThreadSummary.objects.get().prompt_hash
+        # The newest email of the thread was stored first
+        other = Thread.objects.create(gmail_thread_id="t2")
+        newest = self.create_email(other, "m-new", "Any news?", day=22)
+        self.create_email(other, "m-old", "Can you send me the budget?", day=19)
+        other.last_email = newest
+        other.save()
+        self.assertEqual(SummaryCache().lookup(key, other).email, newest)
+
+    def test_new_emails_update_the_previous_summary(self):
+        self.summarize(self.thread)
+        self.create_email(self.thread, "m2", "Here is the budget", day=21)
+        self.create_email(self.thread, "m3", "Thanks, approved", day=22)
+        result = self.summarize(self.thread)
+        self.assertFalse(result["cached"])
+        prompt_input = self.chain.prompt_inputs[-1]
+        self.assertEqual(prompt_input["previous_summary"], "Alice asks for the budget")
+        self.assertEqual(prompt_input["previous_action"], "NEED_TO_RESPOND")
+        self.assertNotIn("Can you send me the budget?", prompt_input["conversation"])
+        self.assertLess(prompt_input["conversation"].index("Here is the budget"), prompt_input["conversation"].index("Thanks, approved"))
+        latest = ThreadSummary.objects.order_by('-id').first()
+        self.assertEqual((latest.incremental_count, latest.email.gmail_message_id), (1, "m3"))
+
+        # Nothing new: the latest summary is reused
+        self.assertTrue(self.summarize(self.thread)["cached"])
+        self.assertEqual(self.chain.calls, 2)
+
+    def test_full_summary_after_incremental_ones(self):
+        self.summarize(self.thread)
+        for day in range(21, 21 + FULL_SUMMARY_EVERY):
+            self.create_email(self.thread, f"m{day}", f"Reply of day {day}", day=day)
+            self.summarize(self.thread)
+        counts = list(ThreadSummary.objects.order_by('id').values_list('incremental_count', flat=True))
+        self.assertEqual(counts, list(range(FULL_SUMMARY_EVERY)) + [0])
+        self.assertNotIn("previous_summary", self.chain.prompt_inputs[-1])
+        self.assertIn("Can you send me the budget?", self.chain.prompt_inputs[-1]["conversation"])
+
+    def test_force_refresh_summarizes_the_whole_conversation(self):
+        self.summarize(self.thread)
+        self.create_email(self.thread, "m2", "Here is the budget", day=21)
+        self.summarize(self.thread, force_refresh=True)
+        self.assertNotIn("previous_summary", self.chain.prompt_inputs[-1])
+        self.assertIn("Can you send me the budget?", self.chain.prompt_inputs[-1]["conversation"])
+
+    def test_key_and_report(self):
+        key = SummaryCache.key({"conversation": "Hello {name}", "participants": ""})
+        self.assertEqual(len(key), 64)
+        self.assertEqual(key, SummaryCache.key({"conversation": "Hello {name}", "participants": ""}))
+        self.assertNotEqual(key, SummaryCache.key({"conversation": "Hello", "participants": ""}))
+        cache = SummaryCache()
+        self.assertEqual(cache.report(), "Summary cache: 0 hits, 0 misses (n/a hit rate), 0 forced refreshes")
+        cache.count('hits')
+        cache.count('misses')
+        cache.count('hits')
+        self.assertIn("2 hits, 1 misses (67% hit rate)", cache.report())
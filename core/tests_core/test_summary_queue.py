@@ -0,0 +1,215 @@
+from datetime import datetime, timedelta, timezone
+from io import StringIO
+from unittest import mock
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import IntegrityError, OperationalError
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone as django_timezone
+from core import summary_queue
+from core.models import Email, EmailString, SummaryJob, Thread, ThreadSummary
+from core.summary_queue import MAX_ATTEMPTS, QueueWorkers, backoff, claim, complete, enqueue, fail, heartbeat, requeue_stale
+from core.tests_core import test_summary_cache
+
+def create_thread(gmail_thread_id):
+    sender, _ = EmailString.objects.get_or_create(original_string="Alice Martin <alice@example.com>")
+    thread = Thread.objects.create(gmail_thread_id=gmail_thread_id)
+    Email.objects.create(gmail_message_id=f"m-{gmail_thread_id}", gmail_thread_id=gmail_thread_id,
+                         date=datetime(2024, 5, 20, tzinfo=timezone.utc), sender_str=sender,
+                         subject="Budget", body="Can you send me the budget?", snippet="", thread=thread)
+    return thread
+
+class FakeSummarizer:
+    """Stands for the LangGraph pipeline: saves a ThreadSummary, or fails for the given threads"""
+
+    def __init__(self, failing_ids=()):
+        self.failing_ids = set(failing_ids)
+        self.calls = []
+
+    def __call__(self, thread_id, force_refresh):
+        self.calls.append((thread_id, force_refresh))
+        if thread_id in self.failing_ids:
+            raise RuntimeError("Ollama is not responding")
+        thread = Thread.objects.get(id=thread_id)
+        return ThreadSummary.objects.create(thread=thread, email=thread.email_set.first(), summary=f"Summary of {thread_id}",
+                                            action="NEED_TO_KNOW", rationale="").id
+
+class SummaryQueueTest(TestCase):
+    def setUp(self):
+        self.thread = create_thread("t1")
+
+    def test_duplicate_jobs_are_coalesced(self):
+        job, created = enqueue(self.thread)
+        self.assertTrue(created)
+        same_job, created = enqueue(self.thread, force_refresh=True)
+        self.assertEqual((same_job.id, created), (job.id, False))
+        self.assertTrue(SummaryJob.objects.get(id=job.id).force_refresh)
+
+        # A running job is also reused, a finished one is not
+        claim("worker")
+        self.assertEqual(enqueue(self.thread)[0].id, job.id)
+        SummaryJob.objects.filter(id=job.id).update(status=SummaryJob.DONE)
+        self.assertNotEqual(enqueue(self.thread)[0].id, job.id)
+
+    def test_competing_job_finished_before_it_is_read(self):
+        create = SummaryJob.objects.create
+        calls = []
+
+        def raced_once(**kwargs):
+            calls.append(kwargs)
+            if len(calls) == 1:
+                # Another request queued a job for the thread, which is done by the time this request reads it
+                raise IntegrityError("UNIQUE constraint failed: core_summaryjob.thread_id")
+            return create(**kwargs)
+
+        with mock.patch.object(SummaryJob.objects, 'create', side_effect=raced_once):
+            job, created = enqueue(self.thread)
+        self.assertEqual((created, job.status, len(calls)), (True, SummaryJob.PENDING, 2))
+
+    def test_failed_job_is_retried_with_backoff(self):
+        self.assertEqual([backoff(attempts) for attempts in (1, 2, 3)], [30, 60, 120])
+        self.assertEqual(backoff(20), summary_queue.BACKOFF_MAX)
+
+        job, _ = enqueue(self.thread)
+        job = claim("worker")
+        self.assertEqual((job.status, job.attempts, job.locked_by), (SummaryJob.RUNNING, 1, "worker"))
+        self.assertIsNone(claim("other worker"))
+
+        fail(job, RuntimeError("Ollama is not responding"))
+        job.refresh_from_db()
+        self.assertEqual(job.status, SummaryJob.PENDING)
+        self.assertIn("Ollama is not responding", job.error)
+        self.assertGreater(job.run_after, django_timezone.now() + timedelta(seconds=25))
+        # Not due yet
+        self.assertIsNone(claim("worker"))
+
+        for attempts in range(2, MAX_ATTEMPTS + 1):
+            SummaryJob.objects.filter(id=job.id).update(run_after=django_timezone.now())
+            job = claim("worker")
+            self.assertEqual(job.attempts, attempts)
+            fail(job, RuntimeError("Ollama is not responding"))
+        self.assertEqual(SummaryJob.objects.get(id=job.id).status, SummaryJob.FAILED)
+
+    def test_stale_job_is_queued_again(self):
+        job, _ = enqueue(self.thread)
+        claim("worker")
+        self.assertEqual(requeue_stale(), 0)
+        long_ago = django_timezone.now() - timedelta(hours=1)
+        # A long summary keeps its job as long as the heartbeat goes on
+        SummaryJob.objects.filter(id=job.id).update(locked_at=long_ago, heartbeat_at=long_ago)
+        heartbeat([job.id])
+        self.assertEqual(requeue_stale(), 0)
+        SummaryJob.objects.filter(id=job.id).update(heartbeat_at=long_ago)
+        self.assertEqual(requeue_stale(), 1)
+        job = SummaryJob.objects.get(id=job.id)
+        self.assertEqual((job.status, job.error), (SummaryJob.PENDING, "worker lost"))
+        # After the backoff of a failed attempt
+        self.assertGreater(job.run_after, django_timezone.now() + timedelta(seconds=backoff(1) - 5))
+        self.assertIsNone(claim("worker"))
+        SummaryJob.objects.filter(id=job.id).update(run_after=long_ago)
+        self.assertEqual(claim("worker").id, job.id)
+
+    def test_stale_job_fails_after_max_attempts(self):
+        job, _ = enqueue(self.thread)
+        claim("worker")
+        SummaryJob.objects.filter(id=job.id).update(attempts=MAX_ATTEMPTS, heartbeat_at=django_timezone.now() - timedelta(hours=1))
+        self.assertEqual(requeue_stale(), 1)
+        job = SummaryJob.objects.get(id=job.id)
+        self.assertEqual((job.status, job.attempts, job.error), (SummaryJob.FAILED, MAX_ATTEMPTS, "worker lost"))
+        self.assertIsNone(claim("worker"))
+
+    def test_stale_claim_does_not_overwrite_the_new_one(self):
+        enqueue(self.thread)
+        stale_job = claim("worker")
+        SummaryJob.objects.filter(id=stale_job.id).update(heartbeat_at=django_timezone.now() - timedelta(hours=1))
+        requeue_stale()
+        SummaryJob.objects.filter(id=stale_job.id).update(run_after=django_timezone.now())
+        job = claim("other worker")
+        complete(stale_job, None)
+        self.assertEqual(SummaryJob.objects.get(id=job.id).status, SummaryJob.RUNNING)
+        complete(job, None)
+        self.assertEqual(SummaryJob.objects.get(id=job.id).status, SummaryJob.DONE)
+
+    def test_status_write_is_retried(self):
+        enqueue(self.thread)
+        job = claim("worker")
+        workers = QueueWorkers(count=1, summarize=FakeSummarizer())
+        writes = []
+
+        def locked_once(job, thread_summary_id):
+            writes.append(thread_summary_id)
+            if len(writes) == 1:
+                raise OperationalError("database table is locked")
+            complete(job, thread_summary_id)
+
+        with mock.patch('core.summary_queue.complete', locked_once), mock.patch('core.summary_queue.WRITE_RETRY_DELAY', 0):
+            workers._run_job(job)
+        self.assertEqual(len(writes), 2)
+        self.assertEqual(SummaryJob.objects.get(id=job.id).status, SummaryJob.DONE)
+
+        # A write failing every time leaves the job running for the stale sweep, and the worker goes on
+        enqueue(create_thread("t2"))
+        job = claim("worker")
+        with mock.patch('core.summary_queue.complete', side_effect=OperationalError("database table is locked")), \
+                mock.patch('core.summary_queue.WRITE_RETRY_DELAY', 0):
+            workers._run_job(job)
+        self.assertEqual(SummaryJob.objects.get(id=job.id).status, SummaryJob.RUNNING)
+        self.assertEqual((workers.done_count, workers.running), (2, set()))
+
+class QueueWorkersTest(TransactionTestCase):
+    """The workers run in other threads, which only see the committed data.
+    A single worker is used: the in-memory test database of SQLite is locked per table between threads"""
+
+    def test_queued_threads_are_summarized(self):
+        threads = [create_thread(f"t{i}") for i in range(5)]
+        for thread in threads:
+            enqueue(thread)
+        summarizer = FakeSummarizer(failing_ids=[threads[2].id])
+        stats = QueueWorkers(count=1, summarize=summarizer).run(once=True)
+        self.assertEqual(stats, {'done': 4, 'failed': 1})
+        self.assertEqual(sorted(thread_id for thread_id, force_refresh in summarizer.calls), [thread.id for thread in threads])
+        self.assertEqual(SummaryJob.objects.filter(status=SummaryJob.DONE, thread_summary__isnull=False).count(), 4)
+        failed = SummaryJob.objects.get(thread=threads[2])
+        self.assertEqual((failed.status, failed.attempts), (SummaryJob.PENDING, 1))
+
+    def test_command(self):
+        from core.utils import sanitize_json, llm
+        thread = create_thread("t1")
+        enqueue(thread)
+        chain = test_summary_cache.FakeSummaryChain()
+        chain.alice_id = EmailString.objects.get().contact_id
+        out = StringIO()
+        with mock.patch('core.llm.nodes.get_llm_utils', return_value=(sanitize_json, llm, chain, chain, lambda **kwargs: None)):
+            call_command('run_workers', '--once', '--workers', '1', stdout=out)
+        self.assertIn("1 jobs done, 0 attempts failed", out.getvalue())
+        job = SummaryJob.objects.get()
+        self.assertEqual((job.status, job.thread_summary.summary), (SummaryJob.DONE, "Alice asks for the budget"))
+
+class SummaryQueueViewTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_superuser(username='testuser', password='testpass123')
+        self.client.login(username='testuser', password='testpass123')
+        self.thread = create_thread("t1")
+
+    def test_summarize_and_poll(self):
+        response = self.client.post(f'/threads/{self.thread.id}/summarize/')
+        self.assertEqual(response.status_code, 202)
+        job = response.json()
+        self.assertEqual((job['status'], job['queued']), (SummaryJob.PENDING, True))
+        self.assertEqual(self.client.post(f'/threads/{self.thread.id}/summarize/').json()['job_id'], job['job_id'])
+
+        self.assertEqual(self.client.get(job['status_url']).json()['status'], SummaryJob.PENDING)
+        claimed = claim("worker")
+        summary_queue.complete(claimed, FakeSummarizer()(self.thread.id, False))
+        status = self.client.get(job['status_url']).json()
+        self.assertEqual((status['status'], status['summary']), (SummaryJob.DONE, f"Summary of {self.thread.id}"))
+
+    def test_admin_action(self):
+        other = create_thread("t2")
+        enqueue(other)
+        response = self.client.post('/admin/core/thread/', {
+            'action': 'create_thread_summary',
+            '_selected_action': [self.thread.id, other.id],
+        }, follow=True)
+        self.assertContains(response, "1 threads queued for summary, 1 already queued")
+        self.assertEqual(SummaryJob.objects.count(), 2)
@@ -0,0 +1,78 @@
+import json
+import threading
+import time
+from django.test import TestCase
+from core.models import SystemParameter
+from core.summary_worker import CHECKPOINT_KEY, SummaryWorker, percentile
+
+class FakeSummarizer:
+    """Stands for the LangGraph pipeline: waits a little, records how many summaries run at once"""
+
+    def __init__(self, failing_ids=(), delay=0.02):
+        self.failing_ids = set(failing_ids)
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+        self.summarized_ids = []
+
+    def __call__(self, thread_id):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(self.delay)
+        with self.lock:
+            self.running -= 1
+            self.summarized_ids.append(thread_id)
+        if thread_id in self.failing_ids:
+            raise RuntimeError("Ollama is not responding")
+        return {"summary": f"Summary of {thread_id}"}
+
+class SummaryWorkerTest(TestCase):
+    def test_all_threads_are_summarized_concurrently(self):
+        summarizer = FakeSummarizer()
+        worker = SummaryWorker(concurrency=3, summarize=summarizer)
+        stats = worker.run(range(1, 11))
+        self.assertEqual(sorted(summarizer.summarized_ids), list(range(1, 11)))
+        self.assertEqual(summarizer.max_running, 3)
+        self.assertEqual(stats['summarized'], 10)
+        self.assertEqual(stats['failed'], 0)
+        self.assertGreater(stats['threads_per_minute'], 0)
+        self.assertGreaterEqual(stats['p95'], stats['p50'])
+        self.assertFalse(SystemParameter.objects.filter(key=CHECKPOINT_KEY).exists())
+
+    def test_failed_threads_are_skipped_by_the_next_run(self):
+        worker = SummaryWorker(concurrency=2, summarize=FakeSummarizer(failing_ids=[2]))
+        stats = worker.run([1, 2, 3])
+        self.assertEqual((stats['summarized'], stats['failed']), (2, 1))
+        checkpoint = json.loads(SystemParameter.objects.get(key=CHECKPOINT_KEY).value)
+        self.assertEqual(checkpoint, {'summarized': 2, 'failed': [2]})
+
+        summarizer = FakeSummarizer()
+        SummaryWorker(summarize=summarizer).run([2, 4])
+        self.assertEqual(summarizer.summarized_ids, [4])
+
+        summarizer = FakeSummarizer()
+        SummaryWorker(summarize=summarizer).run([2], retry_failed=True)
+        self.assertEqual(summarizer.summarized_ids, [2])
+        self.assertFalse(SystemParameter.objects.filter(key=CHECKPOINT_KEY).exists())
+
+    def test_stop_completes_the_summaries_in_progress(self):
+        summarizer = FakeSummarizer()
+        done = []
+        def on_done(thread_id, summary, error, seconds):
+            done.append(thread_id)
+            worker.stop()
+        worker = SummaryWorker(concurrency=2, summarize=summarizer, on_done=on_done)
+        stats = worker.run(range(1, 11))
+        # The two summaries started before the stop complete, no other one starts
+        self.assertEqual(sorted(done), [1, 2])
+        self.assertEqual(stats['summarized'], 2)
+        checkpoint = json.loads(SystemParameter.objects.get(key=CHECKPOINT_KEY).value)
+        self.assertEqual(checkpoint['summarized'], 2)
+
+    def test_percentile(self):
+        self.assertIsNone(percentile([], 0.5))
+        self.assertEqual(percentile([3, 1, 2], 0.5), 2)
+        self.assertEqual(percentile(list(range(1, 101)), 0.95), 95)
+        self.assertEqual(percentile([5], 0.95), 5)
@@ -1,5 +1,5 @@
 from django.test import TestCase
-from core.utils import remove_quoted_text
+from core.utils import extract_email_and_name, normalize_whitespace, remove_quoted_text, split_addresses
 
 class TestRemoveQuotedText(TestCase):
     def test_gmail_quote_pattern(self):
@@ -77,4 +77,44 @@ with no quoted content."""
         self.assertEqual(remove_quoted_text(body), body)
 
     def test_empty_body(self):
-        self.assertEqual(remove_quoted_text(""), "") 
\ No newline at end of file
+        self.assertEqual(remove_quoted_text(""), "") 
+
+    def test_quote_marker_only_at_line_start(self):
+        body = "A score of 3 > 2\n> quoted"
+        self.assertEqual(remove_quoted_text(body), "A score of 3 > 2")
+
+    def test_earliest_pattern_wins(self):
+        body = "Reply\n-----Original Message-----\nOn Mon, John wrote:\n> old"
+        self.assertEqual(remove_quoted_text(body), "Reply")
+
+
+class TestNormalizeWhitespace(TestCase):
+    def test_ascii_text(self):
+        self.assertEqual(normalize_whitespace("Hello&nbsp;world\n\n\n\nBye"), "Hello world\n\nBye")
+
+    def test_unicode_spaces(self):
+        text = "Caf\u00e9\u00a0au\u202flait\u200b!\u2029Next\u2028line\ufeff"
+        self.assertEqual(normalize_whitespace(text), "Caf\u00e9 au lait!\n\nNext\nline")
+
+    def test_unicode_text_with_nbsp_and_empty_lines(self):
+        text = "R\u00e9sum\u00e9&nbsp;ready\u2028\u3000\n\nThanks"
+        self.assertEqual(normalize_whitespace(text), "R\u00e9sum\u00e9 ready\n\nThanks")
+
+
+class TestAddresses(TestCase):
+    def test_split_simple_list(self):
+        self.assertEqual(split_addresses("A <a@x.com>, b@x.com,"), ("A <a@x.com>", "b@x.com"))
+        self.assertEqual(split_addresses(""), ())
+
+    def test_split_keeps_commas_of_quoted_names_and_comments(self):
+        header = '"Doe, John" <john@x.com>, (Sales, EMEA) jane@x.com, Bob <bob@x.com>'
+        self.assertEqual(split_addresses(header), ('"Doe, John" <john@x.com>', '(Sales, EMEA) jane@x.com', 'Bob <bob@x.com>'))
+
+    def test_split_groups(self):
+        self.assertEqual(split_addresses("undisclosed-recipients:;"), ())
+        self.assertEqual(split_addresses('Team: a@x.com, "B, b" <b@x.com>; c@x.com'), ("a@x.com", '"B, b" <b@x.com>', "c@x.com"))
+
+    def test_extract_email_and_name(self):
+        self.assertEqual(extract_email_and_name('"Doe, John" <john@x.com>'), ("Doe, John", "john@x.com"))
+        self.assertEqual(extract_email_and_name("jean-pierre.dupont@x.fr"), ("Jean Pierre Dupont", "jean-pierre.dupont@x.fr"))
+        self.assertEqual(extract_email_and_name("Zo\u00eb O'Neil <z@x.com>"), ("Zoe O Neil", "z@x.com"))
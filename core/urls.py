@@ -1,7 +1,7 @@
 from django.urls import path
 from core.views.contact_review import ContactReviewListView, ContactReviewUpdateView, complete_review, search_contacts, update_contact_details
 from core.views.orphaned_contacts import OrphanedContactsListView, delete_contact, delete_all_orphaned_contacts
-from core.views.thread_list import thread_list, summarize_thread, get_labels, thread_detail
+from core.views.thread_list import thread_list, summarize_thread, summary_job_status, get_labels, thread_detail
 from core.views.home import HomeView
 from core.views.contact_list import ContactListView, ContactDetailView
 from core.views.email_string_list import email_string_list, update_email_string_contact, create_contact
@@ -31,6 +31,7 @@ urlpatterns = [
     path('threads/', thread_list, name='thread_list'),
     path('threads/<int:thread_id>/', thread_detail, name='thread_detail'),
     path('threads/<int:thread_id>/summarize/', summarize_thread, name='summarize_thread'),
+    path('threads/jobs/<int:job_id>/', summary_job_status, name='summary_job_status'),
     path('threads/labels/', get_labels, name='get_labels'),
     path('timeframe-threads/', timeframe_threads, name='timeframe_threads'),
     
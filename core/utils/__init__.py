@@ -2,22 +2,30 @@
 Utility functions for the email assistant application.
 """
 
-from .email import is_calendar_invite, remove_quoted_text
+from .email import is_calendar_invite, classify_calendar_invites, has_calendar_part, remove_quoted_text
 from .text import normalize_whitespace
-from .contacts import extract_email_and_name, search_similar_contacts
+from .mime import extract_body, html_to_text
+from .contacts import extract_email_and_name, split_addresses, search_similar_contacts
 from .thread import get_thread_participants, enhance_thread_data
-from .llm import sanitize_json, llm, summary_chain, log_llm_prompt
+from .llm import sanitize_json, llm, summary_chain, incremental_summary_chain, chunk_summary_chain, log_llm_prompt
 
 __all__ = [
     'is_calendar_invite',
+    'classify_calendar_invites',
+    'has_calendar_part',
     'remove_quoted_text',
     'normalize_whitespace',
+    'extract_body',
+    'html_to_text',
     'extract_email_and_name',
+    'split_addresses',
     'search_similar_contacts',
     'get_thread_participants',
     'enhance_thread_data',
     'sanitize_json',
     'llm',
     'summary_chain',
+    'incremental_summary_chain',
+    'chunk_summary_chain',
     'log_llm_prompt',
 ] 
\ No newline at end of file
@@ -0,0 +1,264 @@
+import re
+import threading
+import time
+import unicodedata
+from collections import defaultdict
+from functools import lru_cache
+
+# Candidates scoring less are not returned
+MIN_SCORE = 0.3
+# Contacts scored by a lookup: the keys shared by the fewest contacts (a last name) are used first,
+# and the common ones (a first name, a prefix) only while there are few candidates
+MAX_CANDIDATES = 100
+# Seconds between two checks of the Contact table for the changes made by other processes
+REFRESH_INTERVAL = 30
+
+# Tokens ignored when comparing names
+NAME_SUFFIXES = frozenset(['jr', 'sr', 'ii', 'iii', 'iv', 'phd', 'md', 'mr', 'mrs', 'ms', 'dr'])
+# Email providers shared by unrelated people: the same domain is no evidence of the same person
+PUBLIC_DOMAINS = frozenset(['gmail.com', 'googlemail.com', 'yahoo.com', 'yahoo.fr', 'hotmail.com', 'hotmail.fr',
+                            'outlook.com', 'live.com', 'msn.com', 'icloud.com', 'me.com', 'aol.com', 'gmx.com',
+                            'protonmail.com', 'proton.me', 'orange.fr', 'free.fr'])
+
+# Similarity of two name tokens
+EXACT = 1.0
+PHONETIC = 0.85   # Jon / John, Smyth / Smith, Steven / Stephen
+PREFIX = 0.8      # Jon / Jonathan, Raph / Raphael
+INITIAL = 0.6     # W / William
+# Bonus of a candidate for the evidence given by the email address
+SAME_EMAIL = 0.3
+SAME_LOCAL_PART = 0.15
+SAME_DOMAIN = 0.05
+
+TOKEN = re.compile(r'[a-z0-9]+')
+# Spelling variants removed by phonetic_key, applied in this order
+PHONETIC_RULES = [(re.compile(pattern), replacement) for pattern, replacement in [
+    (r'ph', 'f'),
+    (r'v', 'f'),
+    (r'c(?=[eiy])', 's'),
+    (r'ck|c|q', 'k'),
+    (r'y', 'i'),
+    (r'(?<=.)h', ''),
+    (r'(.)\1+', r'\1'),
+]]
+
+def name_tokens(name):
+    """Return the lowercase ASCII words of a name: "José-María García" gives ('jose', 'maria', 'garcia')"""
+    if not name.isascii():
+        name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode('ascii')
+    return tuple(token for token in TOKEN.findall(name.lower()) if token not in NAME_SUFFIXES)
+
+@lru_cache(maxsize=20000)
+def phonetic_key(token):
+    """Spell a name token the way it sounds, roughly: John and Jon, Stephen and Steven give the same key"""
+    for pattern, replacement in PHONETIC_RULES:
+        token = pattern.sub(replacement, token)
+    return token
+
+def token_similarity(a, b):
+    if a == b:
+        return EXACT
+    if len(a) == 1 or len(b) == 1:
+        return INITIAL if a[0] == b[0] else 0.0
+    if phonetic_key(a) == phonetic_key(b):
+        return PHONETIC
+    if len(a) >= 3 and len(b) >= 3 and (a.startswith(b) or b.startswith(a)):
+        return PREFIX
+    return 0.0
+
+def name_similarity(tokens, other_tokens):
+    """Score in [0, 1] of two names given as tokens, in any order. Each word of a name is paired with
+    the most similar word of the other one, and both names must be covered to get a high score."""
+    if not tokens or not other_tokens:
+        return 0.0
+    pairs = sorted(
+        ((token_similarity(a, b), i, j) for i, a in enumerate(tokens) for j, b in enumerate(other_tokens)),
+        reverse=True
+    )
+    used, other_used, total = set(), set(), 0.0
+    for similarity, i, j in pairs:
+        if similarity == 0.0:
+            break
+        if i not in used and j not in other_used:
+            used.add(i)
+            other_used.add(j)
+            total += similarity
+    return (total / len(tokens) + total / len(other_tokens)) / 2
+
+def split_email(email):
+    """Return the local part and the domain of an email address, lowercase"""
+    local_part, _, domain = email.lower().rpartition('@')
+    return local_part, domain
+
+class ContactIndex:
+    """In-memory index of the contact names and email addresses, to find the contacts similar to a name.
+
+    Usage:
+        candidates = contact_index.candidates("Jon Smith", "jon.smith@example.com")
+
+    The names are indexed by word, phonetic key and 3 letter prefix, so finding the candidates only looks
+    at the contacts sharing one of them (the rarest ones first, see MAX_CANDIDATES), or sharing the email
+    address or its local part. The index is
+    built from the database on first use, kept up to date by the Contact signals of this process
+    (see CoreConfig.ready), and picks up the changes of other processes every REFRESH_INTERVAL seconds.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        """Forget everything, the index is built again on next use"""
+        with self.lock:
+            self.names = {}                    # contact id -> name tokens
+            self.emails = defaultdict(set)     # contact id -> email addresses
+            self.keys = defaultdict(set)       # name key -> contact ids
+            self.by_email = defaultdict(set)   # email address -> contact ids
+            self.by_local_part = defaultdict(set)  # local part of the email addresses -> contact ids
+            self.built = False
+            self.checked_at = 0.0
+            self.synced_at = None
+
+    @staticmethod
+    def _name_keys(tokens):
+        keys = set()
+        for token in tokens:
+            if len(token) > 1:
+                keys.add('w:' + token)
+                keys.add('p:' + phonetic_key(token))
+                if len(token) >= 3:
+                    keys.add('x:' + token[:3])
+        return keys
+
+    def add(self, contact_id, name, emails=()):
+        """Index (or index again) a contact. Its known email addresses are kept"""
+        with self.lock:
+            self._remove_name(contact_id)
+            tokens = name_tokens(name or '')
+            self.names[contact_id] = tokens
+            for key in self._name_keys(tokens):
+                self.keys[key].add(contact_id)
+            for email in emails:
+                self.add_email(contact_id, email)
+
+    def add_email(self, contact_id, email):
+        with self.lock:
+            email = email.lower()
+            self.emails[contact_id].add(email)
+            self.by_email[email].add(contact_id)
+            self.by_local_part[split_email(email)[0]].add(contact_id)
+
+    def remove_email(self, contact_id, email):
+        with self.lock:
+            email = email.lower()
+            self.emails[contact_id].discard(email)
+            self.by_email[email].discard(contact_id)
+            if not any(split_email(e)[0] == split_email(email)[0] for e in self.emails[contact_id]):
+                self.by_local_part[split_email(email)[0]].discard(contact_id)
+
+    def remove(self, contact_id):
+        with self.lock:
+            self._remove_name(contact_id)
+            self.names.pop(contact_id, None)
+            for email in list(self.emails.pop(contact_id, ())):
+                self.by_email[email].discard(contact_id)
+                self.by_local_part[split_email(email)[0]].discard(contact_id)
+
+    def _remove_name(self, contact_id):
+        for key in self._name_keys(self.names.get(contact_id, ())):
+            self.keys[key].discard(contact_id)
+
+    def build(self):
+        """Index all the contacts, with two queries"""
+        from core.models import Contact
+        with self.lock:
+            self.clear()
+            self.synced_at = Contact.objects.order_by('-updated_at').values_list('updated_at', flat=True).first()
+            for contact_id, name in Contact.objects.values_list('id', 'name').iterator():
+                self.add(contact_id, name)
+            for contact_id, email in Contact.emails.through.objects.values_list('contact_id', 'emailaddress__email').iterator():
+                self.add_email(contact_id, email)
+            self.built = True
+            self.checked_at = time.monotonic()
+
+    def refresh(self):
+        """Build the index on first use, then index again the contacts changed by other processes"""
+        from core.models import Contact
+        with self.lock:
+            if not self.built:
+                self.build()
+                return
+            if time.monotonic() - self.checked_at < REFRESH_INTERVAL:
+                return
+            self.checked_at = time.monotonic()
+            if Contact.objects.count() < len(self.names):
+                self.build()  # contacts were deleted
+                return
+            changed = Contact.objects.prefetch_related('emails')
+            if self.synced_at is not None:
+                changed = changed.filter(updated_at__gte=self.synced_at)
+            for contact in changed:
+                self.add(contact.id, contact.name, [email.email for email in contact.emails.all()])
+                if self.synced_at is None or contact.updated_at > self.synced_at:
+                    self.synced_at = contact.updated_at
+
+    def candidates(self, name, email=None, limit=10, min_score=MIN_SCORE):
+        """Return the contacts similar to a name (and email address) as (contact id, score) tuples,
+        best first. The score is the name similarity, from 0 to 1, plus a bonus when the email address,
+        its local part or its (non public) domain is already known for the contact."""
+        self.refresh()
+        tokens = name_tokens(name or '')
+        local_part, domain = split_email(email) if email else ('', '')
+        with self.lock:
+            contact_ids = set()
+            if email:
+                contact_ids |= self.by_email.get(email.lower(), set())
+                if local_part:
+                    contact_ids |= self.by_local_part.get(local_part, set())
+            postings = sorted((self.keys[key] for key in self._name_keys(tokens) if self.keys.get(key)), key=len)
+            for posting in postings:
+                if contact_ids and len(contact_ids) + len(posting) > MAX_CANDIDATES:
+                    break
+                contact_ids |= posting
+
+            scored = []
+            for contact_id in contact_ids:
+                score = name_similarity(tokens, self.names[contact_id])
+                if email:
+                    emails = self.emails.get(contact_id, ())
+                    if email.lower() in emails:
+                        score += SAME_EMAIL
+                    elif local_part and any(split_email(e)[0] == local_part for e in emails):
+                        score += SAME_LOCAL_PART
+                    elif domain not in PUBLIC_DOMAINS and any(split_email(e)[1] == domain for e in emails):
+                        score += SAME_DOMAIN
+                if score >= min_score:
+                    scored.append((contact_id, score))
+        scored.sort(key=lambda candidate: (-candidate[1], candidate[0]))
+        return scored[:limit]
+
+    def search(self, name, email=None, limit=10, min_score=MIN_SCORE):
+        """Same as candidates, but return the Contact objects, each with its score in a rank attribute.
+        The candidates are checked against the database: contacts which no longer exist are dropped,
+        renamed ones are indexed again."""
+        from core.models import Contact
+        candidates = self.candidates(name, email, limit, min_score)
+        contacts = Contact.objects.in_bulk([contact_id for contact_id, score in candidates])
+        results = []
+        stale = False
+        for contact_id, score in candidates:
+            contact = contacts.get(contact_id)
+            if contact is None:
+                self.remove(contact_id)
+            elif name_tokens(contact.name) != self.names.get(contact_id):
+                self.add(contact_id, contact.name)
+                stale = True
+            else:
+                contact.rank = score
+                results.append(contact)
+        if stale:
+            return self.search(name, email, limit, min_score)
+        return results
+
+# Index used by search_similar_contacts and the contact review
+contact_index = ContactIndex()
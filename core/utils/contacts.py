@@ -1,10 +1,69 @@
 import re
 import unicodedata
+from functools import lru_cache
 from django.db import models
 from core.models import Contact
+from .contact_index import contact_index
 
+# Number of parsed address strings and headers remembered: the same correspondents come back in every sync
+ADDRESS_CACHE_SIZE = 20000
+
+# A contact with a similar but not identical name is only used above this score, so the email address
+# must support the name (e.g. same address, or same company domain for "Jon" and "Jonathan") ...
+AUTO_LINK_SCORE = 0.95
+# ... and when no other candidate is that close
+AUTO_LINK_MARGIN = 0.1
+# Number of candidates with a similar name considered
+AUTO_LINK_CANDIDATES = 10
+
+# Tokens of an RFC 5322 address list: quoted strings and comments (which may contain commas),
+# angle addresses, runs of plain text, and the separators
+ADDRESS_TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"?|\((?:[^()\\]|\\.)*\)?|<[^>]*>?|[^,;:"(<]+|[,;:]')
+# Characters which need the tokenizer, without them a header can be split on commas
+ADDRESS_SPECIALS = ('"', '(', ':', ';')
+
+# Separators replaced by a space in names
+NAME_SEPARATORS = str.maketrans({'-': ' ', '.': ' ', '_': ' ', "'": ' ', '"': None})
+WHITESPACE = re.compile(r'\s+')
+
+@lru_cache(maxsize=ADDRESS_CACHE_SIZE)
+def split_addresses(header):
+    """Split an address list header (To, Cc...) into the individual address strings.
+
+    Commas inside quoted names and comments do not separate addresses, so
+    '"Doe, John" <john@example.com>, jane@example.com' gives two addresses.
+    Group names are dropped ("Team: a@example.com, b@example.com;" gives the two addresses).
+
+    Args:
+        header (str): The value of the header
+
+    Returns:
+        tuple: The address strings, stripped, in the order of the header
+    """
+    if not any(special in header for special in ADDRESS_SPECIALS):
+        return tuple(address.strip() for address in header.split(",") if address.strip())
+
+    addresses = []
+    current = []
+    for token in ADDRESS_TOKEN.findall(header):
+        if token == ':' and not any('@' in t for t in current):
+            current = []  # the text before was the name of a group
+        elif token in (',', ';'):
+            address = ''.join(current).strip()
+            if address:
+                addresses.append(address)
+            current = []
+        else:
+            current.append(token)
+    address = ''.join(current).strip()
+    if address:
+        addresses.append(address)
+    return tuple(addresses)
+
+@lru_cache(maxsize=ADDRESS_CACHE_SIZE)
 def extract_email_and_name(original_string):
     """Extract email and name from the email string.
+    The results are memoized, the string is only parsed the first time it is seen.
     
     Args:
         original_string (str): A string with the format "Name <email>"
@@ -16,8 +75,10 @@ def extract_email_and_name(original_string):
     email = ""
 
     if "<" in original_string:
-        name = original_string.split("<")[0].strip()
-        email = original_string.split("<")[1].split(">")[0].strip()
+        # The last < starts the address, a quoted name may contain one
+        name, _, email = original_string.rpartition("<")
+        name = name.strip()
+        email = email.split(">")[0].strip()
     else:
         email = original_string.strip()
 
@@ -27,28 +88,26 @@ def extract_email_and_name(original_string):
     if "@" in name:
         name = name.split("@")[0]
 
-    # Normalize the name
-    name = re.sub(r'-', ' ', name)
-    name = re.sub(r'\.', ' ', name)
-    name = re.sub(r'_', ' ', name)
-    name = re.sub(r'\'', ' ', name)  # in some languages, ' is used as an apostrophe
-
-    # Remove quotes from name
-    name = re.sub(r'"', '', name)
-    name = name.strip()
+    # Normalize the name: - . _ and ' (used as an apostrophe in some languages) become spaces, quotes are removed
+    name = name.translate(NAME_SEPARATORS).strip()
 
     # Remove any non-ascii characters and replace them by their ascii equivalent
-    name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode('ascii')
+    if not name.isascii():
+        name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode('ascii')
 
     # Remove double spaces in name
-    name = re.sub(r'\s+', ' ', name)
+    name = WHITESPACE.sub(' ', name)
     # Capitalize each word in name
     name = name.title()
 
     return (name, email)
 
 def search_similar_contacts(name, email):
-    """Search for similar contacts based on name and email.
+    """Search for the contact of a name and email, e.g. to link a new email string to it.
+
+    A contact with the same name is used when it is the only one, or the only one with this email.
+    Otherwise a contact with a similar name ("Jon Smith" for "Jonathan Smith") is used when the email
+    address supports it and no other contact is nearly as close (see contact_index).
     
     Args:
         name (str): The contact's name
@@ -57,21 +116,23 @@ def search_similar_contacts(name, email):
     Returns:
         Contact or None: The matching contact if found, None otherwise
     """
-    # First search for the same normalized name and email
-    possible_contacts = Contact.objects.filter(name=name, emails__email=email)
-    if len(possible_contacts) == 1:
-        contact = possible_contacts.first()
-        return contact
-    elif len(possible_contacts) > 1:
-        return None
+    # First search for the same name and email, then for the same name. The database is read rather than
+    # the index, which does not have the contacts created by other processes since its last refresh
+    possible_contacts = list(Contact.objects.filter(name=name, emails__email=email).distinct()[:2])
+    if possible_contacts:
+        return possible_contacts[0] if len(possible_contacts) == 1 else None
+    possible_contacts = list(Contact.objects.filter(name=name)[:2])
+    if possible_contacts:
+        return possible_contacts[0] if len(possible_contacts) == 1 else None
 
-    # If not found, search for the same normalized name
-    possible_contacts = Contact.objects.filter(name=name)
-    if len(possible_contacts) == 1:
-        contact = possible_contacts.first()
-        return contact
-    elif len(possible_contacts) > 1:
+    candidates = contact_index.search(name, email, limit=AUTO_LINK_CANDIDATES)
+    if not candidates:
         return None
 
+    # Then for a similar name
+    best = candidates[0]
+    if best.rank >= AUTO_LINK_SCORE and (len(candidates) == 1 or best.rank - candidates[1].rank >= AUTO_LINK_MARGIN):
+        return best
+
     # If we have not found anyone
-    return None 
\ No newline at end of file
+    return None
@@ -1,70 +1,37 @@
 import re
 
-def is_calendar_invite(subject, body, headers=None):
-    """Check if an email is a calendar invite or attendance notification.
-    
-    Args:
-        subject (str): The email subject
-        body (str): The email body
-        headers (list, optional): List of header dicts with 'name' and 'value' keys
-        
-    Returns:
-        bool: True if the email appears to be a calendar-related message
-    """
-    # Check headers if available
-    if headers:
-        for header in headers:
-            header_name = header.get('name', '').lower()
-            header_value = header.get('value', '').lower()
-            
-            # Check Microsoft calendar headers
-            if header_name in [
-                'x-microsoft-cdo-busystatus',
-                'x-microsoft-cdo-intendedbusystatus',
-                'x-microsoft-cdo-all-day-event',
-                'x-microsoft-cdo-instance-type',
-                'x-microsoft-cdo-importance',
-                'x-microsoft-cdo-appt-sequence',
-                'x-microsoft-cdo-appt-state'
-            ]:
-                return True
-                
-            # Check content class
-            if header_name == 'content-class' and header_value == 'urn:content-classes:calendarmessage':
-                return True
-                
-            # Check message class
-            if header_name == 'x-microsoft-cdo-message-class' and 'calendar' in header_value:
-                return True
+# Headers only set on calendar messages (Microsoft Exchange)
+CALENDAR_HEADERS = frozenset([
+    'x-microsoft-cdo-busystatus',
+    'x-microsoft-cdo-intendedbusystatus',
+    'x-microsoft-cdo-all-day-event',
+    'x-microsoft-cdo-instance-type',
+    'x-microsoft-cdo-importance',
+    'x-microsoft-cdo-appt-sequence',
+    'x-microsoft-cdo-appt-state',
+])
 
-    # Check subject for calendar response indicators
-    subject = subject.lower().strip()
-    subject_indicators = [
-        'accepted',
-        'declined',
-        'tentative',
-        'canceled',
-        'cancelled',
-        'updated',
-        'rescheduled',
-        're-scheduled',
-        'postponed',
-        'moved',
-        'changed',
-    ]
-    
-    # Check if subject starts with any of the indicators (with or without colon)
-    for indicator in subject_indicators:
-        if subject.startswith(indicator) or subject.startswith(f"{indicator}:"):
-            return True
+# Calendar responses start their subject with one of these words (with or without colon)
+CALENDAR_SUBJECT_PREFIXES = (
+    'accepted',
+    'declined',
+    'tentative',
+    'canceled',
+    'cancelled',
+    'updated',
+    'rescheduled',
+    're-scheduled',
+    'postponed',
+    'moved',
+    'changed',
+)
 
-    # Check body for calendar-related content
-    body = body.lower()
-    calendar_indicators = [
+# Body indicators, grouped by a substring they all contain: a group is only searched when the body contains
+# its anchor. This is faster than one combined regex, which cannot use the C substring search of str.
+CALENDAR_BODY_INDICATORS = {
+    'invit': (
         'calendar invitation',
-        'calendar event',
         'meeting invitation',
-        'meeting request',
         'invitation to',
         'invited you to',
         'invited to a meeting',
@@ -74,29 +41,113 @@ def is_calendar_invite(subject, body, headers=None):
         'has declined this invitation',
         'has tentatively accepted this invitation',
         'has responded to this invitation',
-        'accepted:',
-        'declined:',
-        'tentative:',
-        'when:',
-        'where:',
-        'organizer:',
-        'attendees:',
+    ),
+    'calendar': (
+        'calendar event',
         'calendar.ics',
         'calendar.ical',
         'calendar.vcs',
         'calendar.vcal',
-    ]
+    ),
+    'meeting request': (
+        'meeting request',
+    ),
+}
+# Indicators followed by a colon, e.g. "When: Monday 10:00"
+CALENDAR_COLON_INDICATORS = ('accepted:', 'declined:', 'tentative:', 'when:', 'where:', 'organizer:', 'attendees:')
+
+# MIME types and attachment extensions of calendar data
+CALENDAR_MIME_TYPES = frozenset(['text/calendar', 'application/ics'])
+CALENDAR_EXTENSIONS = ('.ics', '.ical', '.ifb', '.vcs', '.vcal')
 
-    for indicator in calendar_indicators:
-        if indicator in body:
+def _has_calendar_headers(headers):
+    for header in headers:
+        header_name = header.get('name', '').lower()
+        if header_name in CALENDAR_HEADERS:
+            return True
+        if header_name == 'content-class' and header.get('value', '').lower() == 'urn:content-classes:calendarmessage':
+            return True
+        if header_name == 'x-microsoft-cdo-message-class' and 'calendar' in header.get('value', '').lower():
             return True
+    return False
 
-    # Check for calendar file attachments
-    if 'calendar.ics' in body or 'calendar.ical' in body:
-        return True
+def has_calendar_part(payload):
+    """Check if a Gmail message payload has a text/calendar part or a calendar file attachment.
+
+    Args:
+        payload (dict): The payload of a Gmail message resource
 
+    Returns:
+        bool: True if one of the MIME parts carries calendar data
+    """
+    parts = [payload]
+    while parts:
+        part = parts.pop()
+        if part.get('mimeType', '').lower() in CALENDAR_MIME_TYPES:
+            return True
+        if part.get('filename', '').lower().endswith(CALENDAR_EXTENSIONS):
+            return True
+        parts.extend(part.get('parts', []))
+    return False
+
+def _has_calendar_text(body):
+    """body must be lowercase"""
+    for anchor, indicators in CALENDAR_BODY_INDICATORS.items():
+        if anchor in body:
+            for indicator in indicators:
+                if indicator in body:
+                    return True
+    if ':' in body:
+        for indicator in CALENDAR_COLON_INDICATORS:
+            if indicator in body:
+                return True
     return False
 
+def is_calendar_invite(subject, body, headers=None, payload=None):
+    """Check if an email is a calendar invite or attendance notification.
+    
+    Args:
+        subject (str): The email subject
+        body (str): The email body
+        headers (list, optional): List of header dicts with 'name' and 'value' keys
+        payload (dict, optional): The Gmail message payload, to look for calendar MIME parts
+        
+    Returns:
+        bool: True if the email appears to be a calendar-related message
+    """
+    if headers and _has_calendar_headers(headers):
+        return True
+    if payload and has_calendar_part(payload):
+        return True
+    if subject.lower().strip().startswith(CALENDAR_SUBJECT_PREFIXES):
+        return True
+    return _has_calendar_text(body.lower())
+
+def classify_calendar_invites(emails):
+    """Check several emails at once, see is_calendar_invite.
+
+    Args:
+        emails (iterable): dicts with the keys 'subject' and 'body', and optionally 'headers' and 'payload'
+
+    Returns:
+        list: a bool for each email, True if it appears to be a calendar-related message
+    """
+    return [
+        is_calendar_invite(email['subject'], email['body'], email.get('headers'), email.get('payload'))
+        for email in emails
+    ]
+
+# Start of the quoted text from previous emails, see remove_quoted_text
+QUOTE_PATTERN = re.compile(
+    r"On.*wrote:"  # Gmail style
+    r"|From:.*\nSent:.*\nTo:.*\n(?:Cc:.*\n)?Subject:"  # Outlook header pattern, with or without Cc
+    r"|-----Original Message-----"  # Outlook style
+    r"|>(?<=^>)",  # Common quote marker, at the start of a line
+    re.MULTILINE
+)
+# Every alternative starts with a literal character, so the regex engine can skip quickly to the
+# positions starting with one of them (written "^>", the last one would disable this optimization)
+
 def remove_quoted_text(body: str) -> str:
     """Removes quoted text from email body.
     
@@ -113,21 +164,10 @@ def remove_quoted_text(body: str) -> str:
     Returns:
         str: The email body without quoted text
     """
-    # First, try to find the last occurrence of common quote markers
-    patterns = [
-        r"On.*wrote:",  # Gmail style
-        r"From:.*\nSent:.*\nTo:.*\nSubject:",  # Outlook style
-        r"-----Original Message-----",  # Outlook style
-        r"^>.*$",  # Common quote marker
-        r"From:.*\nSent:.*\nTo:.*\n(?:Cc:.*\n)?Subject:",  # Outlook header pattern
-    ]
-    
-    # Find the earliest occurrence of any quote pattern
-    earliest_quote = len(body)
-    for pattern in patterns:
-        matches = list(re.finditer(pattern, body, re.MULTILINE))
-        if matches:
-            earliest_quote = min(earliest_quote, matches[0].start())
-    
+    # The earliest match of the alternation is the earliest quote, whichever pattern it comes from
+    match = QUOTE_PATTERN.search(body)
+    if match is None:
+        return body.strip()
+
     # Return only the content before the first quote
-    return body[:earliest_quote].strip() 
\ No newline at end of file
+    return body[:match.start()].strip()
@@ -13,21 +13,34 @@ logging.basicConfig(
     encoding='utf-8'  # Explicitly set UTF-8 encoding
 )
 
+# Ollama model used for the summaries
+SUMMARY_MODEL = "gemma3:12b-it-qat"
+
 def get_llm_instances():
     """Get LLM instances lazily to avoid circular imports"""
-    from core.llm.prompts import PROMPT_SUMMARY
+    from core.llm.prompts import PROMPT_SUMMARY, PROMPT_INCREMENTAL_SUMMARY, PROMPT_CHUNK_SUMMARY
     
-    llm = OllamaLLM(model="gemma3:12b-it-qat")
+    llm = OllamaLLM(model=SUMMARY_MODEL)
     summary_prompt = PromptTemplate(
         input_variables=["conversation", "participants"],
         template=PROMPT_SUMMARY
     )
     summary_chain = summary_prompt | llm
+    incremental_summary_prompt = PromptTemplate(
+        input_variables=["conversation", "participants", "previous_summary", "previous_action", "previous_rationale"],
+        template=PROMPT_INCREMENTAL_SUMMARY
+    )
+    incremental_summary_chain = incremental_summary_prompt | llm
+    chunk_summary_prompt = PromptTemplate(
+        input_variables=["conversation"],
+        template=PROMPT_CHUNK_SUMMARY
+    )
+    chunk_summary_chain = chunk_summary_prompt | llm
     
-    return llm, summary_chain
+    return llm, summary_chain, incremental_summary_chain, chunk_summary_chain
 
 # Initialize LLM instances
-llm, summary_chain = get_llm_instances()
+llm, summary_chain, incremental_summary_chain, chunk_summary_chain = get_llm_instances()
 
 def log_llm_prompt(prompt_name, prompt_input, prompt_template=None):
     """Log LLM prompts to a file with timestamp and context.
@@ -0,0 +1,315 @@
+import base64
+import binascii
+import codecs
+import hashlib
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+from html.parser import HTMLParser
+from .text import normalize_whitespace
+
+# Size caps of each stage, so a huge newsletter or a mislabeled attachment cannot stall the ingest
+MAX_PART_SIZE = 4 * 1024 * 1024   # base64 characters decoded from the selected part
+MAX_HTML_SIZE = 1024 * 1024       # HTML characters fed to the parser
+MAX_BODY_SIZE = 200 * 1024        # characters of extracted text
+
+# Part of the conversion cache keys: bump it when html_to_text changes, so cached texts are not reused
+CONVERTER_VERSION = 1
+# Number of conversions kept in memory
+CONVERSION_CACHE_SIZE = 2000
+
+# The HTML is fed to the parser by pieces, so we can stop as soon as enough text has been produced
+FEED_SIZE = 64 * 1024
+
+# Elements whose content is never displayed
+SKIPPED_TAGS = frozenset(['head', 'script', 'style', 'title', 'template', 'noscript', 'svg', 'object'])
+VOID_TAGS = frozenset(['area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source', 'track', 'wbr'])
+# Elements starting on a new line, and those separated from the next block by an empty line
+BLOCK_TAGS = frozenset(['address', 'article', 'aside', 'blockquote', 'center', 'dd', 'div', 'dl', 'dt', 'fieldset', 'figure',
+                        'footer', 'form', 'header', 'hr', 'li', 'main', 'nav', 'ol', 'section', 'table', 'tbody', 'thead',
+                        'tfoot', 'tr', 'ul'])
+PARAGRAPH_TAGS = frozenset(['p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'pre', 'table', 'blockquote'])
+EMPHASIS = {'b': '**', 'strong': '**', 'i': '*', 'em': '*'}
+
+HIDDEN_STYLE = re.compile(
+    r'display\s*:\s*none|visibility\s*:\s*hidden|(?<![\w-])(?:max-height|font-size|opacity)\s*:\s*0(?![.\d])',
+    re.IGNORECASE
+)
+WHITESPACE = re.compile(r'\s+')
+CHARSET = re.compile(r'charset\s*=\s*"?([\w.:-]+)', re.IGNORECASE)
+
+class HtmlToText(HTMLParser):
+    """Convert HTML to markdown-like text in a single streaming parse.
+    Hidden elements (display:none, visibility:hidden, hidden attribute, script, style...) are dropped
+    while parsing, and the parse stops once max_size characters of text have been produced."""
+
+    def __init__(self, max_size=MAX_BODY_SIZE):
+        super().__init__(convert_charrefs=True)
+        self.max_size = max_size
+        self.size = 0
+        self.chunks = []
+        self.stack = []        # (tag, hidden) of the open elements
+        self.hidden_depth = 0  # number of open elements hiding their content
+        self.pre_depth = 0
+        self.links = []        # (index of the first chunk of the link text, href) of the open links
+        self.pending_break = ''
+
+    @property
+    def done(self):
+        return self.size >= self.max_size
+
+    def _write(self, text):
+        if self.pending_break:
+            if self.chunks:
+                self.chunks.append(self.pending_break)
+            self.pending_break = ''
+        self.chunks.append(text)
+        self.size += len(text)
+
+    def _break(self, separator):
+        # Keep the widest break requested between two pieces of text
+        if len(separator) > len(self.pending_break):
+            self.pending_break = separator
+
+    def handle_starttag(self, tag, attrs):
+        if tag in VOID_TAGS:
+            if tag == 'br':
+                self._write('\n')
+            elif tag == 'hr':
+                self._break('\n\n')
+            return
+        attributes = dict(attrs)
+        hidden = (tag in SKIPPED_TAGS or 'hidden' in attributes
+                  or bool(HIDDEN_STYLE.search(attributes.get('style') or '')))
+        self.stack.append((tag, hidden))
+        if hidden:
+            self.hidden_depth += 1
+        if self.hidden_depth:
+            return
+
+        if tag in PARAGRAPH_TAGS:
+            self._break('\n\n')
+        elif tag in BLOCK_TAGS:
+            self._break('\n')
+        if tag[0] == 'h' and tag[1:].isdigit():
+            self._write('#' * int(tag[1:]) + ' ')
+        elif tag == 'li':
+            self._write('- ')
+        elif tag == 'pre':
+            self.pre_depth += 1
+        elif tag in ('td', 'th') and self.chunks and not self.pending_break:
+            self._write(' ')
+        elif tag in EMPHASIS:
+            self._write(EMPHASIS[tag])
+        elif tag == 'a':
+            self.links.append((len(self.chunks), attributes.get('href') or ''))
+
+    def handle_endtag(self, tag):
+        # Close the element and the ones left open inside it; ignore end tags without a start tag
+        for position in range(len(self.stack) - 1, -1, -1):
+            if self.stack[position][0] == tag:
+                break
+        else:
+            return
+        for closed_tag, hidden in reversed(self.stack[position:]):
+            self._close(closed_tag, hidden)
+        del self.stack[position:]
+
+    def _close(self, tag, hidden):
+        if hidden:
+            self.hidden_depth -= 1
+            return
+        if self.hidden_depth:
+            return
+        if tag == 'pre':
+            self.pre_depth -= 1
+        elif tag in EMPHASIS:
+            self._write(EMPHASIS[tag])
+        elif tag == 'a' and self.links:
+            start, href = self.links.pop()
+            text = ''.join(self.chunks[start:]).strip()
+            if href and not href.startswith(('#', 'mailto:')) and text and text != href:
+                self.chunks[start:] = ['[', text, '](', href, ')']
+                self.size += len(href) + 4
+        if tag in PARAGRAPH_TAGS:
+            self._break('\n\n')
+        elif tag in BLOCK_TAGS:
+            self._break('\n')
+
+    def handle_data(self, data):
+        if self.hidden_depth or self.done:
+            return
+        if not self.pre_depth:
+            data = WHITESPACE.sub(' ', data)
+            if data == ' ' and (not self.chunks or self.pending_break or self.chunks[-1].endswith((' ', '\n'))):
+                return
+        self._write(data)
+
+    def get_text(self):
+        text = ''.join(self.chunks)
+        # Remove the spaces left around line breaks by the inline elements
+        return re.sub(r' *\n *', '\n', text).strip()[:self.max_size]
+
+def html_to_text(html, max_size=MAX_BODY_SIZE):
+    """Convert an HTML document to markdown-like text, without its hidden elements.
+
+    Args:
+        html (str): The HTML document. Only its first MAX_HTML_SIZE characters are parsed
+        max_size (int): Maximum number of characters returned
+
+    Returns:
+        str: The visible text of the document
+    """
+    parser = HtmlToText(max_size)
+    html = html[:MAX_HTML_SIZE]
+    for start in range(0, len(html), FEED_SIZE):
+        parser.feed(html[start:start + FEED_SIZE])
+        if parser.done:
+            break
+    parser.close()
+    return parser.get_text()
+
+def _is_attachment(part):
+    if part.get('filename') or part.get('body', {}).get('attachmentId'):
+        return True
+    for header in part.get('headers', []):
+        if header['name'].lower() == 'content-disposition' and header['value'].lower().startswith('attachment'):
+            return True
+    return False
+
+def _select_parts(payload):
+    """Walk the MIME tree once and return the first text/plain and the first text/html parts (or None).
+    Nothing is decoded here."""
+    text_part = html_part = None
+    parts = [payload]
+    while parts and not (text_part and html_part):
+        part = parts.pop()
+        mime_type = part.get('mimeType', '')
+        if mime_type.startswith('multipart/'):
+            # reversed so that pop() visits the parts in document order
+            parts.extend(reversed(part.get('parts', [])))
+        elif not _is_attachment(part) and part.get('body', {}).get('data'):
+            if mime_type == 'text/plain' and text_part is None:
+                text_part = part
+            elif mime_type == 'text/html' and html_part is None:
+                html_part = part
+    return text_part, html_part
+
+class HtmlConversionCache:
+    """Memoize html_to_text, keyed by a hash of the decoded HTML part.
+
+    Newsletters and notifications often arrive with the same HTML, so their conversion is done once.
+    The last max_size conversions are kept in memory. With open_file, conversions are also stored
+    in a table of a SQLite file, so they survive the process. It can be shared between threads.
+    """
+
+    def __init__(self, max_size=CONVERSION_CACHE_SIZE):
+        self.max_size = max_size
+        self.memory = OrderedDict()
+        self.connection = None
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'file_hits': 0, 'misses': 0}
+
+    def open_file(self, path):
+        """Back the cache with the SQLite file at path"""
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+            self.connection = sqlite3.connect(str(path), isolation_level=None, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS html_conversion (content_hash TEXT PRIMARY KEY, text TEXT NOT NULL)")
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    @staticmethod
+    def key(raw, charset, max_size):
+        digest = hashlib.blake2b(raw, digest_size=16)
+        digest.update(f"{charset}:{max_size}:{CONVERTER_VERSION}".encode('ascii'))
+        return digest.hexdigest()
+
+    def convert(self, raw, charset, max_size=MAX_BODY_SIZE):
+        """Return html_to_text of the HTML part, given as bytes and their charset"""
+        key = self.key(raw, charset, max_size)
+        with self.lock:
+            text = self.memory.get(key)
+            if text is not None:
+                self.memory.move_to_end(key)
+                self.stats['hits'] += 1
+                return text
+            if self.connection is not None:
+                row = self.connection.execute("SELECT text FROM html_conversion WHERE content_hash = ?", (key,)).fetchone()
+                if row is not None:
+                    self.stats['file_hits'] += 1
+                    self._remember(key, row[0])
+                    return row[0]
+            self.stats['misses'] += 1
+
+        # Converted outside of the lock, so that threads do not wait for each other
+        text = html_to_text(raw.decode(charset, errors='replace'), max_size)
+        with self.lock:
+            self._remember(key, text)
+            if self.connection is not None:
+                self.connection.execute("INSERT OR IGNORE INTO html_conversion (content_hash, text) VALUES (?, ?)", (key, text))
+        return text
+
+    def _remember(self, key, text):
+        self.memory[key] = text
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
+
+# Conversion cache used by extract_body
+conversion_cache = HtmlConversionCache()
+
+def _decode_part(part):
+    """Return the bytes of a part and their charset"""
+    data = part['body']['data']
+    if len(data) > MAX_PART_SIZE:
+        # Cut on a boundary of 4 characters, which decode to whole bytes
+        data = data[:MAX_PART_SIZE - MAX_PART_SIZE % 4]
+    # Gmail often leaves out the padding. A last single character holds no whole byte
+    if len(data) % 4 == 1:
+        data = data[:-1]
+    data += '=' * (-len(data) % 4)
+    try:
+        raw = base64.urlsafe_b64decode(data)
+    except (binascii.Error, ValueError):
+        raw = b''
+    charset = 'utf-8'
+    for header in part.get('headers', []):
+        if header['name'].lower() == 'content-type':
+            match = CHARSET.search(header['value'])
+            if match:
+                charset = match.group(1).lower()
+    try:
+        codecs.lookup(charset)
+    except LookupError:
+        charset = 'utf-8'
+    return raw, charset
+
+def extract_body(payload):
+    """Extract the text of a Gmail message payload.
+
+    The text/plain part is used when there is one, otherwise the text/html part converted to text
+    (through conversion_cache). Only the selected part is decoded.
+
+    Args:
+        payload (dict): The payload of a Gmail message resource (format=full)
+
+    Returns:
+        str: The text of the message, with normalized whitespace
+    """
+    text_part, html_part = _select_parts(payload)
+    body = ''
+    if text_part is not None:
+        raw, charset = _decode_part(text_part)
+        body = raw.decode(charset, errors='replace')[:MAX_BODY_SIZE]
+    if not body.strip() and html_part is not None:
+        body = conversion_cache.convert(*_decode_part(html_part))
+    return normalize_whitespace(body)
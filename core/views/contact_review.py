@@ -5,6 +5,10 @@ from django.utils import timezone
 from django.db.models.functions import Lower
 from django.db.models import Q
 from ..models import EmailString, Contact, SystemParameter
+from ..utils.contact_index import contact_index
+
+# Number of similar contacts suggested for each email string
+SUGGESTIONS_COUNT = 3
 
 class ContactReviewListView(LoginRequiredMixin, ListView):
     template_name = 'core/contact_review_list.html'
@@ -37,6 +41,15 @@ class ContactReviewListView(LoginRequiredMixin, ListView):
         all_contacts = list(Contact.objects.all())
         sorted_contacts = sorted(all_contacts, key=lambda x: x.name.lower())
         context['contacts'] = sorted_contacts
+
+        # Suggest the contacts similar to each email string, other than the one it is linked to
+        contacts_by_id = {contact.id: contact for contact in all_contacts}
+        for email_string in context['email_strings']:
+            candidates = contact_index.candidates(email_string.name, email_string.email.email, limit=SUGGESTIONS_COUNT + 1)
+            email_string.suggestions = [
+                contacts_by_id[contact_id] for contact_id, score in candidates
+                if contact_id != email_string.contact_id and contact_id in contacts_by_id
+            ][:SUGGESTIONS_COUNT]
         
         return context
 
@@ -99,16 +112,25 @@ def complete_review(request):
 
 def search_contacts(request):
     """AJAX endpoint for searching contacts"""
-    query = request.GET.get('query', '')
+    # The contact review sends q, the email string list query
+    query = request.GET.get('query') or request.GET.get('q', '')
     limit = int(request.GET.get('limit', 10))
     
     if not query:
         return JsonResponse({'results': []})
     
     # Case-insensitive search
-    contacts = Contact.objects.filter(
+    contacts = list(Contact.objects.filter(
         name__icontains=query
-    ).order_by(Lower('name'))[:limit]
+    ).order_by(Lower('name'))[:limit])
+
+    # Then the similar names ("Jon Smyth" finds "John Smith")
+    found = {contact.id for contact in contacts}
+    for contact in contact_index.search(query, limit=limit):
+        if len(contacts) >= limit:
+            break
+        if contact.id not in found:
+            contacts.append(contact)
     
     results = [{'id': contact.id, 'name': contact.name} for contact in contacts]
     
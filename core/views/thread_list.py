@@ -1,12 +1,13 @@
 from django.shortcuts import render, get_object_or_404
 from django.http import JsonResponse
-from core.models import Thread, ThreadSummary, Label, Email
-from core.llm.helper import build_graph
+from django.urls import reverse
+from core.models import Thread, ThreadSummary, Label, Email, SummaryJob
 from django.core.paginator import Paginator
 from django.contrib.auth.decorators import login_required
 from django.db.models import Q
 from django.db import models
 from core.utils import enhance_thread_data
+from core import search_index, summary_queue
 
 @login_required
 def get_labels(request):
@@ -19,26 +20,39 @@ def thread_list(request):
     # Get search query
     search_query = request.GET.get('search', '').strip()
     
-    # Get sort parameter with default to newest first
-    sort_by = request.GET.get('sort', '-created_at')
+    # Get sort parameter with default to the most relevant first when searching, newest first otherwise
+    sort_by = request.GET.get('sort', 'relevance' if search_query else '-created_at')
     
     # Validate sort parameter to prevent SQL injection
     valid_sort_fields = ['created_at', '-created_at', 'subject', '-subject']
+    use_index = bool(search_query) and search_index.is_available()
+    if use_index:
+        valid_sort_fields.append('relevance')
     if sort_by not in valid_sort_fields:
         sort_by = '-created_at'
     
     # Base queryset
     threads = Thread.objects.all()
+    snippets = {}
     
     # Apply search filter if query exists
-    if search_query:
+    if use_index and sort_by == 'relevance':
+        # Ranked matches of the full-text index, see core/search_index.py
+        results = search_index.search_threads(search_query, limit=search_index.MAX_RESULTS)
+    elif use_index:
+        # All the matches, the other sorts are not limited to the most relevant threads
+        threads = threads.filter(id__in=search_index.matching_threads(search_query))
+    elif search_query:
         threads = threads.filter(
             Q(email__subject__icontains=search_query) |
             Q(email__body__icontains=search_query)
         ).distinct()
     
     # Apply sorting
-    if sort_by in ['subject', '-subject']:
+    if sort_by == 'relevance':
+        # The ids are already in the order of relevance, only the threads of the page are loaded
+        threads = [thread_id for thread_id, email_id in results]
+    elif sort_by in ['subject', '-subject']:
         # For subject sorting, we need to join with the email table
         threads = threads.annotate(
             first_subject=models.Subquery(
@@ -54,12 +68,25 @@ def thread_list(request):
     page_number = request.GET.get('page', 1)
     paginator = Paginator(threads, 10)  # Show 10 threads per page
     page_obj = paginator.get_page(page_number)
+    page_threads = page_obj.object_list
+    if sort_by == 'relevance':
+        loaded = Thread.objects.in_bulk(page_threads)
+        page_threads = [loaded[thread_id] for thread_id in page_threads if thread_id in loaded]
+    if use_index:
+        # Excerpts are only made for the threads of the page
+        if sort_by != 'relevance':
+            results = search_index.search_threads(search_query, limit=None, thread_ids=[thread.id for thread in page_threads])
+        page_ids = {thread.id for thread in page_threads}
+        snippets = search_index.get_snippets(search_query, [result for result in results if result[0] in page_ids])
     
     # Count all summarized threads, not just those on current page
     summarized_count = ThreadSummary.objects.values('thread').distinct().count()
     
     # Enhance thread data with additional information including summaries
-    thread_data = [enhance_thread_data(thread, include_summary=True) for thread in page_obj]
+    thread_data = [enhance_thread_data(thread, include_summary=True) for thread in page_threads]
+    for data in thread_data:
+        if data['id'] in snippets:
+            data['search_snippet'] = search_index.highlight(snippets[data['id']])
     
     return render(request, 'core/thread_list.html', {
         'threads': thread_data,
@@ -74,29 +101,23 @@ def thread_list(request):
 
 @login_required
 def summarize_thread(request, thread_id):
-    thread = Thread.objects.get(id=thread_id)
-    
-    # Get the compiled graph
-    graph = build_graph()
-    
-    # Run the graph with initial state
-    result = graph.invoke({
-        "thread": thread,
-        "conversation": "",
-        "message_headers": "",
-        "knowledge": "",
-        "participant_set": None
-    })
-    
-    # The summary data is nested under thread_summary
-    summary_data = result['thread_summary']
+    """Queue the summary of the thread for the run_workers command, and return the job to poll.
+    A thread already queued keeps its job. An unchanged thread gets its cached summary, unless force=1"""
+    thread = get_object_or_404(Thread, id=thread_id)
+    job, created = summary_queue.enqueue(thread, force_refresh=request.POST.get('force', request.GET.get('force')) == '1')
     
     return JsonResponse({
         'success': True,
-        'summary': summary_data['summary'],
-        'action': summary_data['action'],
-        'rationale': summary_data['rationale']
-    })
+        'job_id': job.id,
+        'status': job.status,
+        'queued': created,
+        'status_url': reverse('summary_job_status', args=[job.id])
+    }, status=202)
+
+@login_required
+def summary_job_status(request, job_id):
+    job = get_object_or_404(SummaryJob.objects.select_related('thread_summary'), id=job_id)
+    return JsonResponse(summary_queue.job_status(job))
 
 @login_required
 def thread_detail(request, thread_id):
@@ -126,3 +126,18 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 LOGIN_URL = '/accounts/login/'
 LOGIN_REDIRECT_URL = '/'
 LOGOUT_REDIRECT_URL = '/'
+
+# Directory of the archive of raw Gmail messages (see core/message_archive.py)
+MESSAGE_ARCHIVE_DIR = BASE_DIR / 'archive'
+
+# SQLite file keeping the HTML to text conversions of fetch_email (see core/utils/mime.py), None to keep them in memory only
+HTML_CONVERSION_CACHE_FILE = BASE_DIR / 'html_conversions.sqlite3'
+
+# Estimated tokens of the conversation sent in one summary prompt. Longer conversations are split in chunks
+# of SUMMARY_CHUNK_TOKENS, summarized SUMMARY_MAP_CONCURRENCY at a time, then combined (see core/llm/nodes.py).
+# Keep the budget and the instructions of the prompt within the context window of the Ollama model (num_ctx).
+SUMMARY_TOKEN_BUDGET = 3000
+SUMMARY_CHUNK_TOKENS = 2000
+SUMMARY_MAP_CONCURRENCY = 4
+# Estimated tokens of the knowledge of each participant in the summary prompt (see core/llm/compaction.py)
+SUMMARY_KNOWLEDGE_TOKENS = 200